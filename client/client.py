@@ -3,6 +3,64 @@ import json, datetime, requests, string
 API_URL = "http://127.0.0.1:5000"
 
 
+# request builders without prompts, used by the interactive menu and by loadtest.py
+# session can be a requests.Session for reusing connections, all return the response
+def make_headers(token=None, json_body=False):
+    headers = {}
+    if json_body:
+        headers["Content-type"] = "application/json"
+    if token:
+        headers["Authorization"] = "Basic {}".format(token)
+    return headers
+
+
+def request_events(session=requests, api_url=API_URL, path="/event"):
+    """GET one page of events, path can be the next link of the previous page"""
+    return session.get(api_url + path)
+
+
+def request_search_events(text, session=requests, api_url=API_URL):
+    return session.get(api_url + "/event/search", params={"q": text})
+
+
+def request_event(event_id, session=requests, api_url=API_URL, expand=None, token=None):
+    """GET event, expand is a list of related data to include, attendees require the creator token"""
+    params = {"expand": ",".join(expand)} if expand else None
+    return session.get(api_url + "/event/{}".format(event_id), params=params, headers=make_headers(token))
+
+
+def request_create_event(event_item, session=requests, api_url=API_URL):
+    return session.post(api_url + "/event", data=json.dumps(event_item), headers=make_headers(json_body=True))
+
+
+def request_modify_event(event_id, creator_token, event_item, session=requests, api_url=API_URL):
+    return session.put(api_url + "/event/{}".format(event_id), data=json.dumps(event_item), headers=make_headers(creator_token, True))
+
+
+def request_delete_event(event_id, creator_token, session=requests, api_url=API_URL):
+    return session.delete(api_url + "/event/{}".format(event_id), headers=make_headers(creator_token))
+
+
+def request_event_attendees(event_id, creator_token, session=requests, api_url=API_URL):
+    return session.get(api_url + "/event/{}/attendees".format(event_id), headers=make_headers(creator_token))
+
+
+def request_attendee(event_id, user_id, token, session=requests, api_url=API_URL):
+    return session.get(api_url + "/event/{}/attendees/{}".format(event_id, user_id), headers=make_headers(token))
+
+
+def request_create_attendee(event_id, user_item, session=requests, api_url=API_URL):
+    return session.post(api_url + "/event/{}/attendees".format(event_id), data=json.dumps(user_item), headers=make_headers(json_body=True))
+
+
+def request_modify_attendee(event_id, user_id, token, user_item, session=requests, api_url=API_URL):
+    return session.put(api_url + "/event/{}/attendees/{}".format(event_id, user_id), data=json.dumps(user_item), headers=make_headers(token, True))
+
+
+def request_delete_attendee(event_id, user_id, token, session=requests, api_url=API_URL):
+    return session.delete(api_url + "/event/{}/attendees/{}".format(event_id, user_id), headers=make_headers(token))
+
+
 def menu():
     """Menu loop""" #https://stackoverflow.com/questions/34192588/simple-menu-in-python-3
     choice ='0'
@@ -50,21 +108,27 @@ def menu():
 
 
 def get_events():
-    """Gets list of all events"""
-    resp = requests.get(API_URL + "/event")
+    """Gets list of all events, one page at a time"""
     print("--------------------------------")
     print("All events")
     print("--------------------------------")
-    body = resp.json()
-    for event in body:
-        print("Identifier: {}".format(event["identifier"]))
-        print("Title: {}".format(event["title"]))
-        print("Location: {}".format(event["location"]))
-        print("Time: {}".format(event["time"]))
-        print("Creator: {}".format(event["creator_name"]))
-        print("Description: {}".format(event["description"]))
-        print("Image: {}".format(event["image"]))
-        print("--------------------------------")
+    path = "/event"
+    while path:
+        resp = request_events(path=path)
+        body = resp.json()
+        for event in body:
+            print("Identifier: {}".format(event["identifier"]))
+            print("Title: {}".format(event["title"]))
+            print("Location: {}".format(event["location"]))
+            print("Time: {}".format(event["time"]))
+            print("Creator: {}".format(event["creator_name"]))
+            print("Description: {}".format(event["description"]))
+            print("Image: {}".format(event["image"]))
+            print("--------------------------------")
+        # follow the next page link until the last page
+        path = None
+        if "next" in resp.links:
+            path = resp.links["next"]["url"]
     return
 
 
@@ -75,7 +139,8 @@ def get_single_event():
         if event_id:
             break
 
-    resp = requests.get(API_URL + "/event/{}".format(event_id))
+    # attendee count comes in the same request
+    resp = request_event(event_id, expand=["attendee_count"])
     if resp.status_code == 200:
         event = resp.json()
         print("--------------------------------")
@@ -86,6 +151,7 @@ def get_single_event():
         print("Creator: {}".format(event["creator_name"]))
         print("Description: {}".format(event["description"]))
         print("Image: {}".format(event["image"]))
+        print("Attendees: {}".format(event["attendee_count"]))
         print("--------------------------------")
         return
     elif resp.status_code == 404:
@@ -140,7 +206,7 @@ def create_event():
     if event_image:
         event_item["image"] = event_image
 
-    resp = requests.post(API_URL + "/event", data=json.dumps(event_item), headers={"Content-type": "application/json"})
+    resp = request_create_event(event_item)
     if resp.status_code == 201:
         event = resp.json()
         print("--------------------------------")
@@ -205,7 +271,7 @@ def modify_event():
     if event_image:
         event_item["image"] = event_image
 
-    resp = requests.put(API_URL + "/event/{}".format(event_id), data=json.dumps(event_item), headers={"Content-type": "application/json", "Authorization": "Basic {}".format(creator_token)})
+    resp = request_modify_event(event_id, creator_token, event_item)
     
     if resp.status_code == 200:
         event = resp.json()
@@ -242,7 +308,7 @@ def delete_event():
         if creator_token:
             break
 
-    resp = requests.delete(API_URL + "/event/{}".format(event_id), headers={"Authorization": "Basic {}".format(creator_token)})
+    resp = request_delete_event(event_id, creator_token)
 
     if resp.status_code == 204:
         print("Success! Event deleted.\n")
@@ -268,7 +334,7 @@ def get_event_attendees():
         if creator_token:
             break
 
-    resp = requests.get(API_URL + "/event/{}/attendees".format(event_id), headers={"Authorization": "Basic {}".format(creator_token)})
+    resp = request_event_attendees(event_id, creator_token)
     if resp.status_code == 200:
         body = resp.json()
         print("--------------------------------")
@@ -310,7 +376,7 @@ def get_attendee():
         if user_token:
             break
 
-    resp = requests.get(API_URL + "/event/{}/attendees/{}".format(event_id, user_id), headers={"Authorization": "Basic {}".format(user_token)})
+    resp = request_attendee(event_id, user_id, user_token)
     if resp.status_code == 200:
         user = resp.json()
         print("Identifier: {}".format(user["user_identifier"]))
@@ -364,7 +430,7 @@ def create_attendee():
     if phone:
         user_item["phone"] = phone
 
-    resp = requests.post(API_URL + "/event/{}/attendees".format(event_id), data=json.dumps(user_item), headers={"Content-type": "application/json"})
+    resp = request_create_attendee(event_id, user_item)
     if resp.status_code == 201:
         attendee = resp.json()
         print("--------------------------------")
@@ -422,13 +488,14 @@ def modify_attendee():
     if phone:
         user_item["phone"] = phone
 
-    resp = requests.put(API_URL + "/event/{}/attendees/{}".format(event_id, user_id), data=json.dumps(user_item), headers={"Content-type": "application/json", "Authorization": "Basic {}".format(user_token)})
+    resp = request_modify_attendee(event_id, user_id, user_token, user_item)
     if resp.status_code == 200:
         attendee = resp.json()
 
         print("Success! Attendee info modified.")
         print("Identifier: {}".format(attendee["user_identifier"]))
-        print("User token: {}".format(attendee["user_token"]))
+        if "user_token" in attendee:
+            print("User token: {}".format(attendee["user_token"]))
         print("Username: {}".format(attendee["user_name"]))
         print("First name: {}".format(attendee["first_name"]))
         print("Last name: {}".format(attendee["last_name"]))
@@ -464,7 +531,7 @@ def delete_attendee():
         if user_token:
             break
 
-    resp = requests.delete(API_URL + "/event/{}/attendees/{}".format(event_id, user_id), headers={"Authorization": "Basic {}".format(user_token)})
+    resp = request_delete_attendee(event_id, user_id, user_token)
 
     if resp.status_code == 204:
         print("Success! Attendee deleted.\n")
@@ -519,4 +586,5 @@ def get_event_time(event_id):
     return
 
 
-menu()
\ No newline at end of file
+if __name__ == "__main__":
+    menu()
\ No newline at end of file
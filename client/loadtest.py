@@ -0,0 +1,284 @@
+"""HTTP load generator for a running Notikums API built on the request builders of client.py
+events and attendees are created first, then N workers send a random read/write mix of requests
+until the duration or number of requests is reached, throughput and latency are reported per route
+
+python loadtest.py --url http://127.0.0.1:5000 --workers 8 --duration 30 --write-ratio 0.1
+python loadtest.py --workers 16 --duration 0 --requests 10000 --weights event_get=10,event_search=0 --output results.json
+"""
+import argparse, datetime, itertools, json, random, statistics, sys, threading, time
+import requests
+import client
+
+WORDS = ["python", "meetup", "board", "games", "music", "running", "coffee", "workshop", "sauna", "hackathon", "lecture", "party"]
+LOCATIONS = ["Oulu", "Helsinki", "Tampere", "Turku", "Rovaniemi"]
+START_TIME = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+
+# operation name: (route, default weight within reads or writes)
+READS = {
+    "event_list": ("GET /event", 2),
+    "event_search": ("GET /event/search", 1),
+    "event_get": ("GET /event/<event_id>", 6),
+    "event_detail": ("GET /event/<event_id>?expand=attendees,attendee_count", 1),
+    "attendee_list": ("GET /event/<event_id>/attendees", 2),
+    "attendee_get": ("GET /event/<event_id>/attendees/<user_id>", 3),
+}
+WRITES = {
+    "event_create": ("POST /event", 2),
+    "event_update": ("PUT /event/<event_id>", 2),
+    "attendee_create": ("POST /event/<event_id>/attendees", 4),
+    "attendee_update": ("PUT /event/<event_id>/attendees/<user_id>", 2),
+}
+ROUTES = {name: route for name, (route, weight) in list(READS.items()) + list(WRITES.items())}
+
+
+def random_event(rng):
+    return {
+        "title": " ".join(rng.choices(WORDS, k=3)),
+        "time": (START_TIME + datetime.timedelta(minutes=rng.randrange(525600))).strftime(TIME_FORMAT),
+        "location": rng.choice(LOCATIONS),
+        "creator_name": "loadtest",
+        "description": " ".join(rng.choices(WORDS, k=12)),
+    }
+
+
+def random_attendee(rng, user_name):
+    return {
+        "user_name": user_name,
+        "first_name": rng.choice(WORDS),
+        "last_name": rng.choice(WORDS),
+        "email": "{}@example.com".format(user_name),
+    }
+
+
+class Pool:
+    """events and attendees known to the workers, grows with the created ones"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.events = []  # (identifier, creator_token)
+        self.attendees = []  # (event identifier, user identifier, user token)
+
+    def add_event(self, resp):
+        if resp.status_code == 201:
+            body = resp.json()
+            with self._lock:
+                self.events.append((body["identifier"], body["creator_token"]))
+
+    def add_attendee(self, event_id, resp):
+        if resp.status_code == 201:
+            body = resp.json()
+            with self._lock:
+                self.attendees.append((event_id, body["user_identifier"], body["user_token"]))
+
+    def event(self, rng):
+        # lists are only appended to, so reading a random item without the lock is safe
+        return self.events[rng.randrange(len(self.events))]
+
+    def attendee(self, rng):
+        return self.attendees[rng.randrange(len(self.attendees))]
+
+
+def prepare(pool, events, attendees, seed_value, session, api_url):
+    """create events with attendees each before the run"""
+    rng = random.Random(seed_value)
+    for i in range(events):
+        resp = client.request_create_event(random_event(rng), session, api_url)
+        if resp.status_code != 201:
+            raise RuntimeError("creating event failed with status {}: {}".format(resp.status_code, resp.text))
+        pool.add_event(resp)
+        event_id = pool.events[-1][0]
+        for j in range(attendees):
+            pool.add_attendee(event_id, client.request_create_attendee(event_id, random_attendee(rng, "setup{}".format(j)), session, api_url))
+
+
+def send(name, pool, rng, session, api_url, counter):
+    """send one request of operation name, returns the response"""
+    if name == "event_list":
+        return client.request_events(session, api_url)
+    if name == "event_search":
+        return client.request_search_events(rng.choice(WORDS), session, api_url)
+    if name == "event_get":
+        return client.request_event(pool.event(rng)[0], session, api_url)
+    if name == "event_detail":
+        event_id, token = pool.event(rng)
+        return client.request_event(event_id, session, api_url, ["attendees", "attendee_count"], token)
+    if name == "attendee_list":
+        event_id, token = pool.event(rng)
+        return client.request_event_attendees(event_id, token, session, api_url)
+    if name == "attendee_get":
+        event_id, user_id, token = pool.attendee(rng)
+        return client.request_attendee(event_id, user_id, token, session, api_url)
+    if name == "event_create":
+        resp = client.request_create_event(random_event(rng), session, api_url)
+        pool.add_event(resp)
+        return resp
+    if name == "event_update":
+        event_id, token = pool.event(rng)
+        return client.request_modify_event(event_id, token, {"title": " ".join(rng.choices(WORDS, k=3))}, session, api_url)
+    if name == "attendee_create":
+        event_id = pool.event(rng)[0]
+        resp = client.request_create_attendee(event_id, random_attendee(rng, counter()), session, api_url)
+        pool.add_attendee(event_id, resp)
+        return resp
+    if name == "attendee_update":
+        event_id, user_id, token = pool.attendee(rng)
+        return client.request_modify_attendee(event_id, user_id, token, {"phone": str(rng.randrange(10 ** 9))}, session, api_url)
+    raise ValueError("unknown operation {}".format(name))
+
+
+def worker(number, pool, mix, write_ratio, deadline, budget, seed_value, api_url, results):
+    """send requests until deadline or until budget of requests is used, records into results[number]"""
+    rng = random.Random("{}-{}".format(seed_value, number))
+    session = requests.Session()
+    reads, writes = mix
+    names = itertools.count()
+    counter = lambda: "w{}u{}".format(number, next(names))
+    timings = {}
+    while time.perf_counter() < deadline and budget():
+        group = writes if writes[0] and (not reads[0] or rng.random() < write_ratio) else reads
+        name = rng.choices(group[0], weights=group[1])[0]
+        start = time.perf_counter()
+        try:
+            status = send(name, pool, rng, session, api_url, counter).status_code
+        except requests.RequestException:
+            status = "error"
+        timings.setdefault(name, []).append((time.perf_counter() - start, status))
+    session.close()
+    results[number] = timings
+
+
+def summarize(samples, seconds):
+    """return throughput and latency statistics in milliseconds of (duration, status) samples"""
+    durations = sorted(duration for duration, status in samples)
+    statuses = [status for duration, status in samples]
+    quantiles = statistics.quantiles(durations, n=100, method="inclusive") if len(durations) > 1 else durations * 99
+    return {
+        "n": len(durations),
+        "rps": round(len(durations) / seconds, 1),
+        "errors": sum(1 for status in statuses if status == "error" or status >= 400),
+        "mean_ms": round(statistics.mean(durations) * 1e3, 2),
+        "p50_ms": round(quantiles[49] * 1e3, 2),
+        "p95_ms": round(quantiles[94] * 1e3, 2),
+        "p99_ms": round(quantiles[98] * 1e3, 2),
+        "max_ms": round(durations[-1] * 1e3, 2),
+        "status": {str(status): statuses.count(status) for status in sorted(set(statuses), key=str)}
+    }
+
+
+def build_mix(weights, exclude=()):
+    """return ((read names, weights), (write names, weights)) with default weights overridden by weights dict"""
+    mix = []
+    for group in (READS, WRITES):
+        names = [name for name, (route, weight) in group.items() if weights.get(name, weight) > 0 and name not in exclude]
+        mix.append((names, [weights.get(name, group[name][1]) for name in names]))
+    return tuple(mix)
+
+
+def run(api_url, workers, duration, total=None, write_ratio=0.1, weights=None, events=20, attendees=10, seed_value=0):
+    """prepare data and run workers against api_url, returns results dict"""
+    pool = Pool()
+    with requests.Session() as session:
+        prepare(pool, events, attendees, seed_value, session, api_url)
+
+    lock = threading.Lock()
+    remaining = [total]
+
+    def budget():
+        if total is None:
+            return True
+        with lock:
+            remaining[0] -= 1
+            return remaining[0] >= 0
+
+    # without prepared attendees there is nothing to read or update
+    mix = build_mix(weights or {}, () if pool.attendees else ("attendee_get", "attendee_update"))
+    if not mix[0][0] and not mix[1][0]:
+        raise ValueError("all operations have zero weight")
+    results = [None] * workers
+    started = time.perf_counter()
+    deadline = started + duration if duration else float("inf")
+    threads = [threading.Thread(target=worker, args=(number, pool, mix, write_ratio, deadline, budget, seed_value, api_url, results))
+               for number in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    samples = {}
+    for timings in results:
+        for name, values in timings.items():
+            samples.setdefault(name, []).extend(values)
+    routes = {name: dict(route=ROUTES[name], **summarize(values, seconds)) for name, values in sorted(samples.items())}
+    every = [sample for values in samples.values() for sample in values]
+    return {
+        "url": api_url,
+        "workers": workers,
+        "write_ratio": write_ratio,
+        "seconds": round(seconds, 2),
+        "total": summarize(every, seconds) if every else {"n": 0},
+        "routes": routes,
+    }
+
+
+def print_table(results, stream=sys.stderr):
+    print("{:<18}{:<44}{:>8}{:>9}{:>8}{:>9}{:>9}{:>9}".format("operation", "route", "n", "rps", "errors", "p50 ms", "p95 ms", "p99 ms"), file=stream)
+    rows = list(results["routes"].items())
+    if results["total"]["n"]:
+        rows.append(("total", dict(results["total"], route="")))
+    for name, row in rows:
+        print("{:<18}{:<44}{:>8}{:>9.1f}{:>8}{:>9.2f}{:>9.2f}{:>9.2f}".format(
+            name, row["route"], row["n"], row["rps"], row["errors"], row["p50_ms"], row["p95_ms"], row["p99_ms"]), file=stream)
+
+
+def parse_weights(text):
+    weights = {}
+    for item in filter(None, text.split(",")):
+        name, _, weight = item.partition("=")
+        if name not in ROUTES:
+            raise argparse.ArgumentTypeError("unknown operation {}, choose from {}".format(name, ", ".join(ROUTES)))
+        weights[name] = float(weight)
+    return weights
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test a running Notikums API with a read/write mix of requests")
+    parser.add_argument("--url", default=client.API_URL, help="address of the API")
+    parser.add_argument("--workers", type=int, default=4, help="number of concurrent workers")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run, 0 for no limit with --requests")
+    parser.add_argument("--requests", type=int, help="stop after this many requests in total")
+    parser.add_argument("--write-ratio", type=float, default=0.1, help="share of write requests between 0 and 1")
+    parser.add_argument("--weights", type=parse_weights, default={},
+                        help="comma separated operation=weight overriding default weights within reads or writes, e.g. event_get=10,event_search=0")
+    parser.add_argument("--events", type=int, default=20, help="events created before the run")
+    parser.add_argument("--attendees", type=int, default=10, help="attendees created for each event before the run")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random requests")
+    parser.add_argument("--output", help="write results as JSON to file instead of stdout")
+    args = parser.parse_args(argv)
+
+    if not 0 <= args.write_ratio <= 1:
+        parser.error("--write-ratio must be between 0 and 1")
+    if args.events < 1:
+        parser.error("at least one event is required")
+    if not args.duration and not args.requests:
+        parser.error("--duration or --requests is required")
+    try:
+        results = run(args.url.rstrip("/"), args.workers, args.duration, args.requests, args.write_ratio, args.weights,
+                      args.events, args.attendees, args.seed)
+    except (requests.RequestException, RuntimeError, ValueError) as err:
+        print("Load test failed: {}".format(err), file=sys.stderr)
+        return 2
+
+    print_table(results)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+import argparse, os, sys, threading
+import pytest
+from werkzeug.serving import make_server
+import loadtest
+
+# the API is served from the app package next to the client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "notikums", "app"))
+
+
+@pytest.fixture
+def api_url():
+    import app
+    flask_app = app.create_app({"TESTING": True, "STORAGE_BACKEND": "memory", "METRICS_ENABLED": False})
+    server = make_server("127.0.0.1", 0, flask_app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_port)
+    server.shutdown()
+    thread.join()
+
+
+def test_parse_weights():
+    assert loadtest.parse_weights("event_get=10,event_search=0,") == {"event_get": 10.0, "event_search": 0.0}
+    with pytest.raises(argparse.ArgumentTypeError):
+        loadtest.parse_weights("nope=1")
+    with pytest.raises(ValueError):
+        loadtest.parse_weights("event_get=many")
+
+
+def test_build_mix():
+    reads, writes = loadtest.build_mix({"event_get": 10, "event_search": 0}, exclude=("attendee_get",))
+    assert "event_search" not in reads[0] and "attendee_get" not in reads[0]
+    assert reads[1][reads[0].index("event_get")] == 10
+    assert reads[1][reads[0].index("event_list")] == loadtest.READS["event_list"][1]
+    assert writes[0] == list(loadtest.WRITES)
+
+
+def test_summarize():
+    samples = [(i / 1000, 200) for i in range(1, 101)] + [(0.5, 404), (0.2, "error")]
+    summary = loadtest.summarize(samples, seconds=2)
+    assert summary["n"] == 102
+    assert summary["rps"] == 51.0
+    assert summary["errors"] == 2
+    assert summary["max_ms"] == 500.0
+    assert summary["p50_ms"] <= summary["p95_ms"] <= summary["p99_ms"] <= summary["max_ms"]
+    assert summary["status"] == {"200": 100, "404": 1, "error": 1}
+    # one sample is every percentile
+    assert loadtest.summarize([(0.01, 200)], 1)["p99_ms"] == 10.0
+
+
+def test_run(api_url):
+    results = loadtest.run(api_url, workers=2, duration=0, total=60, write_ratio=0.3, events=3, attendees=2)
+    assert results["total"]["n"] == 60
+    assert results["total"]["errors"] == 0
+    assert set(results["routes"]) <= set(loadtest.ROUTES)
+    for name, route in results["routes"].items():
+        assert route["route"] == loadtest.ROUTES[name]
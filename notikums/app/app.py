@@ -1,46 +1,153 @@
-import json, datetime, random, string, jsonschema, logging
-from flask import Flask, request, redirect
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.exc import IntegrityError, OperationalError
+import json, datetime, string, logging, base64, csv, os
+import click
+from flask import Flask, Response, current_app, request, redirect, url_for, stream_with_context
+from werkzeug.local import LocalProxy
 from flask_restful import Resource, Api
-from jsonschema import validate
-
-# init flask app
-app = Flask(__name__)
-api = Api(app)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///notikums.db"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-db = SQLAlchemy(app)
-
-# basic user authentication, check that auth type is 'Basic' and compare token in request to token in db
-def authenticate_user(client_token, stored_token):
-    """compare token stored in db with token given in request"""
+from jsonschema import Draft7Validator
+from serializers import event_to_dict, user_to_dict, dumps, EVENT_FIELDS, USER_FIELDS
+from cache import LRUCache
+from logconfig import setup_logging
+from metrics import RequestMetrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from profiling import RequestProfiler
+from tokens import TokenHasher
+from models import db, to_utc
+from repository import create_repository, StorageError, ConflictError, ConcurrentUpdateError, IdentifierConflictError, NotFoundError
+
+# default configuration, can be overridden with the config given to create_app
+DEFAULT_CONFIG = {
+    "SQLALCHEMY_DATABASE_URI": "sqlite:///notikums.db",
+    "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+    "STORAGE_BACKEND": "sqlalchemy",  # or "memory" to keep events and attendees in this process only
+    "EVENT_CACHE_SIZE": 1024,  # max number of cached events, 0 disables the cache
+    "EVENT_CACHE_TTL": 30,  # seconds, bounds staleness when running multiple workers
+    # create missing tables on first request, can be turned off when the schema is set up once with `flask init-db`
+    "AUTO_INIT_DB": True,
+    # request counts, latency, db time and SQL statement counts of the resources in Prometheus format at /metrics
+    "METRICS_ENABLED": True,
+}
+
+# storage of events and attendees of the current app, created from STORAGE_BACKEND in create_app
+def get_repository():
+    return current_app.extensions["notikums_repository"]
+
+repository = LocalProxy(get_repository)
+
+# Prometheus metrics of the current app
+def metrics_view():
+    return Response(current_app.extensions["notikums_metrics"].render(), content_type=METRICS_CONTENT_TYPE)
+
+# encode all JSON responses with the serializers module
+def output_json(data, code, headers=None):
+    resp = Response(dumps(data), code, mimetype="application/json")
+    resp.headers.extend(headers or {})
+    return resp
+
+# hashing and verification of secret tokens of the current app, keyed with TOKEN_HASH_KEY in create_app
+def get_token_hasher():
+    return current_app.extensions["notikums_tokens"]
+
+token_hasher = LocalProxy(get_token_hasher)
+
+def authorization_token(client_token):
+    """return token of 'Basic <token>' authorization header or None"""
+    if not client_token:
+        return None
     auth_type, auth_token = client_token.split(" ", 1)
     if auth_type != "Basic":
+        return None
+    return auth_token
+
+# basic user authentication, check that auth type is 'Basic' and compare token in request to hashed tokens in db
+def authenticate_user(client_token, *stored_tokens):
+    """check token given in request against hashes of tokens stored in db, e.g. creator and attendee tokens"""
+    auth_token = authorization_token(client_token)
+    if auth_token is None:
         return False
-    if auth_token != stored_token:
-        return False
-    return True
+    return token_hasher.verify(auth_token, *stored_tokens)
 
-# logging for the application
+# logging for the application, configured from app config and environment in logconfig.py
 logger = logging.getLogger("notikums")
-logger.setLevel("DEBUG")
-fh = logging.FileHandler(f"notikums_app.log")
-fh.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-fh.setFormatter(formatter)
-logger.addHandler(fh)
-logging.getLogger('sqlalchemy.engine').setLevel(logging.DEBUG)
-logging.getLogger('sqlalchemy').addHandler(fh)
-
-# schema validation for requests
-def validate_json(jsonData, jsonSchema):
+validation_logger = logging.getLogger("notikums.validation")
+
+# schema validation for requests, returns list of per-field errors which is empty if request is valid
+def validate_json(jsonData, validator):
+    errors = []
+    missing = set()
+    for err in validator.iter_errors(jsonData):
+        if err.validator == "required":
+            # report each missing property only once
+            for field in err.validator_value:
+                if field not in err.instance and field not in missing:
+                    missing.add(field)
+                    errors.append({"field": field, "message": "{!r} is a required property".format(field)})
+        else:
+            errors.append({"field": ".".join(str(p) for p in err.absolute_path), "message": err.message})
+    if errors:
+        validation_logger.info("validate_json(): schema validation resulted in %d error(s)", len(errors))
+    return errors
+
+# keyset pagination for event listing, cursor is an opaque token of the last row's (time, id)
+PAGE_SIZE_DEFAULT = 100
+PAGE_SIZE_MAX = 1000
+# rows fetched from the db at a time when streaming the full event list
+STREAM_BATCH_SIZE = 500
+# max number of events in one batch create request
+BATCH_SIZE_MAX = 1000
+# placeholder for NDJSON lines of a batch that can't be parsed, null is parsed as None and validated like other items
+INVALID_JSON = object()
+# rows inserted per transaction when importing attendees
+IMPORT_BATCH_SIZE = 500
+# inserts of a batch of events or imported attendees tried with new identifiers if a generated identifier is taken
+IDENTIFIER_RETRIES = 3
+
+def encode_cursor(event):
+    """create opaque cursor token pointing after given event"""
+    raw = json.dumps([event.time.isoformat(), event.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(token):
+    """return (time, id) from cursor token, raises ValueError if token is invalid"""
     try:
-        validate(instance=jsonData, schema=jsonSchema)
-    except jsonschema.exceptions.ValidationError as err:
-        logger.exception("validate_json(): schema validation resulted in error")
-        return False
-    return True
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        time, event_id = json.loads(raw)
+        return to_utc(datetime.datetime.fromisoformat(time)), int(event_id)
+    except (TypeError, json.JSONDecodeError, UnicodeDecodeError, base64.binascii.Error) as err:
+        raise ValueError("invalid cursor") from err
+
+def parse_time(value):
+    """return timezone-aware datetime in UTC from ISO8601 time of request, raises ValueError if format is invalid"""
+    # unencoded + of the offset is decoded as space in query strings
+    value = value.replace(" ", "+")
+    return to_utc(datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z"))
+
+def parse_page_size(value):
+    """return page size from limit parameter, raises ValueError if out of range"""
+    if value is None:
+        return PAGE_SIZE_DEFAULT
+    limit = int(value)
+    if limit < 1 or limit > PAGE_SIZE_MAX:
+        raise ValueError("limit out of range")
+    return limit
+
+# related data which can be included in the event response with ?expand=
+EVENT_EXPANSIONS = ("attendees", "attendee_count")
+
+def parse_expand(value):
+    """return set of expansions from comma separated expand parameter, raises ValueError if one is unknown"""
+    expand = set(filter(None, (value or "").split(",")))
+    if not expand <= set(EVENT_EXPANSIONS):
+        raise ValueError("unknown expansion")
+    return expand
+
+def parse_fields(value, allowed):
+    """return list of response fields from comma separated fields parameter, None if not given
+    raises ValueError if a field is unknown or none are given"""
+    if value is None:
+        return None
+    fields = list(dict.fromkeys(filter(None, value.split(","))))
+    if not fields or not set(fields) <= set(allowed):
+        raise ValueError("unknown field")
+    return fields
 
 # schemas for event, user and image
 def post_event_schema():
@@ -140,40 +247,58 @@ def put_user_schema():
         }
         return schema
 
-# create db model for users
-class User(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    event_id = db.Column(db.Integer, db.ForeignKey("event.id", ondelete='CASCADE'))
-    user_identifier = db.Column(db.String(8), unique=True, nullable=False) #this is exposed in API to identify users
-    user_token = db.Column(db.String(64), nullable=False)
-    user_name = db.Column(db.String(64), nullable=False)
-    first_name = db.Column(db.String(64), nullable=True)
-    last_name = db.Column(db.String(64), nullable=True)
-    email = db.Column(db.String(64), nullable=True)
-    phone = db.Column(db.String(16), nullable=True)
-
-    event = db.relationship("Event", back_populates="attendees")
-
-    def as_dict(self):
-       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
-
-# create db model for events
-class Event(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    identifier = db.Column(db.String(8), unique=True, nullable=False)  # this is exposed in API to identify events
-    creator_name = db.Column(db.String(64), nullable=True)
-    creator_token = db.Column(db.String(64), nullable=False)
-    title = db.Column(db.String(128), nullable=False)
-    description = db.Column(db.String(256), nullable=True)
-    time = db.Column(db.DateTime, nullable=False)
-    location = db.Column(db.String(64), nullable=False)
-    image =  db.Column(db.String(256), nullable=True)
-
-    attendees = db.relationship("User", back_populates="event")
-
-    # credit to https://stackoverflow.com/questions/5022066/how-to-serialize-sqlalchemy-result-to-json
-    def as_dict(self):
-       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+# validators are built once, schemas are checked against the metaschema at import
+def build_validator(schema):
+    Draft7Validator.check_schema(schema)
+    return Draft7Validator(schema)
+
+validators = {
+    "post_event": build_validator(post_event_schema()),
+    "put_event": build_validator(put_event_schema()),
+    "post_image": build_validator(image_post_schema()),
+    "post_user": build_validator(post_user_schema()),
+    "put_user": build_validator(put_user_schema()),
+}
+
+# conditional GET, strong ETag of a row is made of its identifier and version
+def make_etag(identifier, version):
+    return '"{}-{}"'.format(identifier, version)
+
+def event_not_modified(event_id):
+    """return ETag if it matches If-None-Match of request, the snapshot of the event is loaded once and cached
+    for the response in case the ETag doesn't match"""
+    if not request.if_none_match:
+        return None
+    snapshot = get_event_snapshot(event_id)
+    if not snapshot:
+        return None
+    etag = make_etag(event_id, snapshot["version"])
+    # If-None-Match is compared weakly, so W/"..." of the same ETag matches too
+    if request.if_none_match.contains_weak(etag.strip('"')):
+        return etag
+    return None
+
+# read-through cache of event snapshots of the current app keyed by identifier, invalidated when event is modified or deleted
+# created with size and ttl from app config in create_app, so apps with different storages don't share snapshots
+def get_event_cache():
+    return current_app.extensions["notikums_event_cache"]
+
+event_cache = LocalProxy(get_event_cache)
+
+def get_event_snapshot(event_id):
+    """return snapshot dict of event from cache or db, None if event doesn't exist"""
+    def load():
+        event_data = repository.get_event(event_id)
+        if not event_data:
+            return None
+        return {
+            "id": event_data.id,
+            "version": event_data.version,
+            "creator_token": event_data.creator_token,
+            "data": event_to_dict(event_data)
+        }
+    # a snapshot read before a concurrent update is not cached if the update invalidates the event meanwhile
+    return event_cache.get_or_load(event_id, load)
 
 
 # define resources
@@ -184,35 +309,117 @@ class ApiRoot(Resource):
         #return "Well hello there. API documentation is available in Apiary https://notikums.docs.apiary.io/#", 200
         return redirect("https://notikums.docs.apiary.io/#")
 
+def event_time_range(args):
+    """return (from, to) times of event list from from, to and upcoming parameters, None if not limited
+    raises ValueError if a parameter is invalid"""
+    time_from = parse_time(args["from"]) if args.get("from") else None
+    time_to = parse_time(args["to"]) if args.get("to") else None
+    if args.get("upcoming"):
+        # events from now until given number of days ahead
+        days = int(args["upcoming"])
+        if days < 0:
+            raise ValueError("upcoming must not be negative")
+        now = datetime.datetime.now(datetime.timezone.utc)
+        time_from = now if time_from is None else max(time_from, now)
+        time_to = now + datetime.timedelta(days=days) if time_to is None else min(time_to, now + datetime.timedelta(days=days))
+    return time_from, time_to
+
+def stream_event_list(events, fields=None):
+    """yield events as chunks of one JSON array, events are read from storage in batches"""
+    yield "["
+    chunk = []
+    separator = ""
+    for item in events:
+        chunk.append(separator + dumps(event_to_dict(item, fields=fields)))
+        separator = ","
+        # write one chunk per batch instead of one per row
+        if len(chunk) == STREAM_BATCH_SIZE:
+            yield "".join(chunk)
+            chunk = []
+    chunk.append("]")
+    yield "".join(chunk)
+
+
+TOKEN_ALPHABET = string.ascii_uppercase + string.digits
+
+def generate_token(length):
+    """create random string of uppercase letters and digits for secret tokens and identifiers"""
+    # draw random bytes in bulk instead of one SystemRandom call per character,
+    # bytes above the largest multiple of the alphabet size are skipped to keep the choice uniform
+    limit = 256 - 256 % len(TOKEN_ALPHABET)
+    token = []
+    while len(token) < length:
+        token.extend(TOKEN_ALPHABET[byte % len(TOKEN_ALPHABET)] for byte in os.urandom(length) if byte < limit)
+    return "".join(token[:length])
+
+def event_info_from_request(data):
+    """create dict of column values for new event from validated request data,
+    returns (event_info, creator_token), only the hash of the token is stored"""
+
+    # create dict with empty values for all keys
+    event_info = {"identifier": "", "creator_token": "", "title": "", "time": "", "location": "", "creator_name": "", "description": "", "image": ""}
+
+    # check if request contains info and save the info to dict
+    if "title" in data:
+        event_info["title"] = data["title"]
+    if "time" in data:
+        event_info["time"] = parse_time(data["time"])
+    if "location" in data:
+        event_info["location"] = data["location"]
+    if "creator_name" in data:
+        event_info["creator_name"] = data["creator_name"]
+    if "description" in data:
+        event_info["description"] = data["description"]
+    if "image" in data:
+        event_info["image"] = data["image"]
+
+    # create secret token for creator to modify or delete event later
+    creator_token = generate_token(64)
+    event_info["creator_token"] = token_hasher.hash(creator_token)
+
+    # create unique event identifier
+    event_info["identifier"] = generate_token(8)
+
+    # TODO: change request handling to not save empty strings if value is not given
+    return event_info, creator_token
+
+
 class EventCollection(Resource):
 
     def get(self):
-        """get list of all events as JSON array"""
+        """get page of events ordered by time as JSON array, next page is linked in Link header
+        events can be filtered by time with from and to (ISO8601) or upcoming (days from now)
+        with ?stream=1 all matching events are streamed as one chunked JSON array instead
+        with ?fields=identifier,title,time only the given fields are read and returned"""
         try:
-            response_data = []
-            response_template = json.dumps(
-                {
-                    "title":"",
-                    "identifier":"",
-                    "time":"",
-                    "location":"",
-                    "creator_name":"",
-                    "description":"",
-                    "image":""
-                })
-            event_list = Event.query.all()
-            for item in event_list:
-                response_json = json.loads(response_template)
-                response_json["title"] = item.title
-                response_json["identifier"] = item.identifier
-                response_json["time"] = (item.time).strftime("%Y-%m-%dT%H:%M:%S%z")
-                response_json["location"] = item.location
-                response_json["creator_name"] = item.creator_name
-                response_json["description"] = item.description
-                response_json["image"] = item.image
-                response_data.append(response_json)
-            return response_data, 200
-        except (KeyError, ValueError, IntegrityError, OperationalError):
+            try:
+                fields = parse_fields(request.args.get("fields"), EVENT_FIELDS)
+                time_from, time_to = event_time_range(request.args)
+                if request.args.get("stream") in ("1", "true"):
+                    events = repository.iter_events(time_from, time_to, STREAM_BATCH_SIZE, fields)
+                    return Response(stream_with_context(stream_event_list(events, fields)), mimetype="application/json")
+
+                limit = parse_page_size(request.args.get("limit"))
+                cursor = request.args.get("cursor")
+                after = decode_cursor(cursor) if cursor else None
+            except ValueError:
+                return "Invalid limit, cursor, fields or time filter", 400
+
+            # fetch one extra row to know if there is a next page
+            event_list = repository.list_events(time_from, time_to, after, limit + 1, fields)
+            response_data = [event_to_dict(item, fields=fields) for item in event_list[:limit]]
+
+            headers = {}
+            if len(event_list) > limit:
+                next_cursor = encode_cursor(event_list[limit - 1])
+                # keep the filters of this request in the next page link
+                next_args = {key: value for key, value in request.args.items() if key != "cursor"}
+                next_args.update(limit=limit, cursor=next_cursor)
+                next_url = url_for("eventcollection", **next_args)
+                headers["Link"] = '<{}>; rel="next"'.format(next_url)
+                headers["X-Next-Cursor"] = next_cursor
+            return response_data, 200, headers
+        except (KeyError, ValueError, StorageError):
             return "General error o7, please contact administrators", 400
 
 
@@ -220,121 +427,187 @@ class EventCollection(Resource):
         """create new event"""
 
         # check if request is json and follows correct schema
-        if not request.json or not validate_json(request.json, post_event_schema()):
+        if not request.json:
             return "Request content type must be JSON", 415
+        errors = validate_json(request.json, validators["post_event"])
+        if errors:
+            return {"message": "Request does not match schema", "errors": errors}, 415
 
         try:
+            # create new db entry for new event
+            event_info, creator_token = event_info_from_request(request.json)
+            new_event = repository.add_event(event_info)
 
-            # create dict with empty values for all keys
-            event_info = {"identifier": "", "creator_token": "", "title": "", "time": "", "location": "", "creator_name": "", "description": "", "image": ""}
+            # respond with the created object, no need to query it again
+            response_json = event_to_dict(new_event, creator_token=creator_token)
+            return response_json, 201
+        except (KeyError, ValueError, StorageError):
+            return "General error o7, please contact administrators", 400
 
-            # check if request contains info and save the info to dict
-            if "title" in request.json:
-                event_info["title"] = request.json["title"]
-            if "time" in request.json:
-                event_info["time"] = datetime.datetime.strptime(request.json["time"], "%Y-%m-%dT%H:%M:%S%z")
-            if "location" in request.json:
-                event_info["location"] = request.json["location"]
-            if "creator_name" in request.json:
-                event_info["creator_name"] = request.json["creator_name"]
-            if "description" in request.json:
-                event_info["description"] = request.json["description"]
-            if "image" in request.json:
-                event_info["image"] = request.json["image"]
 
-            # create secret token for creator to modify or delete event later
-            event_info["creator_token"] = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for i in range(64))
+class EventBatch(Resource):
 
-            # create unique event identifier
-            event_info["identifier"] = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for j in range(8))
+    def post(self):
+        """create many events in one transaction from JSON array or NDJSON (application/x-ndjson)
+        each event is validated with the event schema, response has identifier and creator_token
+        or errors for each event in the order of the request, status is 207 if some of the events had errors
+        and 400 if all of them had"""
+        try:
+            if request.mimetype == "application/x-ndjson":
+                items = []
+                for line in request.get_data(as_text=True).splitlines():
+                    if line.strip():
+                        try:
+                            items.append(json.loads(line))
+                        except ValueError:
+                            items.append(INVALID_JSON)
+            elif request.is_json:
+                items = request.get_json(silent=True)
+                if not isinstance(items, list):
+                    return "Request must be JSON array or NDJSON", 415
+            else:
+                return "Request must be JSON array or NDJSON", 415
+            if not items:
+                return "Request contains no events", 400
+            if len(items) > BATCH_SIZE_MAX:
+                return "At most {} events can be created at once".format(BATCH_SIZE_MAX), 413
 
-            # create new db entry for new event
-            # TODO: change request handling to not save empty strings if value is not given
-            new_event = Event(
-                title=event_info["title"],
-                identifier=event_info["identifier"],
-                time=event_info["time"],
-                location=event_info["location"],
-                creator_name=event_info["creator_name"],
-                creator_token=event_info["creator_token"],
-                description=event_info["description"],
-                image=event_info["image"]
-            )
-
-            # add and commit changes to db
-            db.session.add(new_event)
-            db.session.commit()
-
-            # db query to return information about created event in response
-            event_data = Event.query.filter_by(identifier=event_info["identifier"]).first()
-            response_template = json.dumps(
-                {
-                    "creator_token": "",
-                    "title":"",
-                    "identifier":"",
-                    "time":"",
-                    "location":"",
-                    "creator_name":"",
-                    "description":"",
-                    "image":""
-                })
-            response_json = json.loads(response_template)
-            response_json["creator_token"] = event_data.creator_token
-            response_json["title"] = event_data.title
-            response_json["identifier"] = event_data.identifier
-            response_json["time"] = (event_data.time).strftime("%Y-%m-%dT%H:%M:%S%z")
-            response_json["location"] = event_data.location
-            response_json["creator_name"] = event_data.creator_name
-            response_json["description"] = event_data.description
-            response_json["image"] = event_data.image
-            return response_json, 201
-        except (KeyError, ValueError, OperationalError):
+            response_data = []
+            rows = []
+            created = []
+            for item in items:
+                if item is INVALID_JSON:
+                    response_data.append({"errors": [{"field": "", "message": "Invalid JSON"}]})
+                    continue
+                errors = validate_json(item, validators["post_event"])
+                if not errors:
+                    try:
+                        event_info, creator_token = event_info_from_request(item)
+                    except ValueError:
+                        errors = [{"field": "time", "message": "Time must be in ISO8601 format"}]
+                if errors:
+                    response_data.append({"errors": errors})
+                    continue
+                rows.append(event_info)
+                created.append({"identifier": event_info["identifier"], "creator_token": creator_token})
+                response_data.append(created[-1])
+            if not rows:
+                return response_data, 400
+
+            # insert all valid events with one executemany in one transaction
+            for attempt in range(IDENTIFIER_RETRIES):
+                try:
+                    repository.add_events(rows)
+                    break
+                except IdentifierConflictError:
+                    # none of the events were inserted, generated identifiers are replaced for the next attempt
+                    for event_info, response_item in zip(rows, created):
+                        event_info["identifier"] = response_item["identifier"] = generate_token(8)
+            else:
+                return "Identifier collision, please retry", 409
+            return response_data, 201 if len(rows) == len(response_data) else 207
+        except (KeyError, ValueError, StorageError):
+            return "General error o7, please contact administrators", 400
+
+
+class EventSearch(Resource):
+
+    def get(self):
+        """search events by keywords in title, description and location, best matches first
+        next page is linked in Link header"""
+        try:
+            try:
+                text = request.args.get("q", "")
+                if not text.strip():
+                    raise ValueError("search text is required")
+                limit = parse_page_size(request.args.get("limit"))
+                offset = int(request.args.get("offset", 0))
+                if offset < 0:
+                    raise ValueError("offset must not be negative")
+                fields = parse_fields(request.args.get("fields"), EVENT_FIELDS)
+            except ValueError:
+                return "Invalid search text, limit, offset or fields", 400
+
+            # fetch one extra row to know if there is a next page
+            event_list = repository.search_events(text, limit + 1, offset, fields)
+            response_data = [event_to_dict(item, fields=fields) for item in event_list[:limit]]
+
+            headers = {}
+            if len(event_list) > limit:
+                next_args = {"fields": ",".join(fields)} if fields else {}
+                next_url = url_for("eventsearch", q=text, limit=limit, offset=offset + limit, **next_args)
+                headers["Link"] = '<{}>; rel="next"'.format(next_url)
+            return response_data, 200, headers
+        except (KeyError, ValueError, StorageError):
             return "General error o7, please contact administrators", 400
 
 
 class EventItem(Resource):
 
     def get(self, event_id):
-        """get specific event by id as JSON array"""
+        """get specific event by id as JSON array
+        with ?expand=attendees,attendee_count the attendees (requires creator token) and their count are included
+        with ?fields=identifier,title,time only the given fields of the event are returned"""
         try:
+            try:
+                expand = parse_expand(request.args.get("expand"))
+            except ValueError:
+                return "Invalid expand, choose from {}".format(", ".join(EVENT_EXPANSIONS)), 400
+            try:
+                fields = parse_fields(request.args.get("fields"), EVENT_FIELDS)
+            except ValueError:
+                return "Invalid fields, choose from {}".format(", ".join(EVENT_FIELDS)), 400
+            if expand:
+                return self.get_expanded(event_id, expand, fields)
+
+            # respond 304 without loading the row if client has the current version
+            etag = event_not_modified(event_id)
+            if etag:
+                return None, 304, {"ETag": etag}
+
             # check if event exists and continue
-            event_data = Event.query.filter_by(identifier=event_id).first()
-            if not event_data:
+            snapshot = get_event_snapshot(event_id)
+            if not snapshot:
                 return "Event not found", 404
-            response_template = json.dumps(
-                {
-                    "title":"",
-                    "identifier":"",
-                    "time":"",
-                    "location":"",
-                    "creator_name":"",
-                    "description":"",
-                    "image":""
-                })
-            response_json = json.loads(response_template)
-            response_json["title"] = event_data.title
-            response_json["identifier"] = event_data.identifier
-            response_json["time"] = (event_data.time).strftime("%Y-%m-%dT%H:%M:%S%z")
-            response_json["location"] = event_data.location
-            response_json["creator_name"] = event_data.creator_name
-            response_json["description"] = event_data.description
-            response_json["image"] = event_data.image
-            return response_json, 200
-        except (KeyError, ValueError, IntegrityError, OperationalError):
+            # the full event is cached, so the fields are picked from the snapshot instead of read from the db
+            response_json = {field: snapshot["data"][field] for field in fields} if fields else snapshot["data"]
+            return response_json, 200, {"ETag": make_etag(event_id, snapshot["version"])}
+        except (KeyError, ValueError, StorageError):
             return "General error o7, please contact administrators", 400
 
+    def get_expanded(self, event_id, expand, fields=None):
+        """event with related data read in one query, not cached or tagged since attendees change without the event version"""
+        result = repository.get_event_with_attendees(event_id, "attendees" in expand)
+        if not result:
+            return "Event not found", 404
+        event_data, attendee_count, attendees = result
+
+        # attendee details are for the creator only, like the attendee list
+        if "attendees" in expand and not authenticate_user(request.headers.get("Authorization"), event_data.creator_token):
+            return "Authorization failed", 401
+
+        response_json = event_to_dict(event_data, fields=fields)
+        if "attendees" in expand:
+            response_json["attendees"] = [user_to_dict(attendee) for attendee in attendees]
+        if "attendee_count" in expand:
+            response_json["attendee_count"] = attendee_count
+        return response_json, 200
+
 
     def put(self, event_id):
         """modify event, requires creator token as header"""
 
         # check if request is json and follows correct schema
-        if not request.json or not validate_json(request.json, put_event_schema()):
+        if not request.json:
             return "Request content type must be JSON", 415
+        errors = validate_json(request.json, validators["put_event"])
+        if errors:
+            return {"message": "Request does not match schema", "errors": errors}, 415
 
         try:
 
             # check if event exists and continue
-            event_data = Event.query.filter_by(identifier=event_id).first()
+            event_data = repository.get_event(event_id)
             if not event_data:
                 return "Event not found", 404
 
@@ -343,44 +616,30 @@ class EventItem(Resource):
                 return "Authorization failed", 401
 
             # check if request contains info and save the info
+            changes = {}
             if "title" in request.json:
-                event_data.title = request.json["title"]
+                changes["title"] = request.json["title"]
             if "time" in request.json:
-                event_data.time = datetime.datetime.strptime(request.json["time"], "%Y-%m-%dT%H:%M:%S%z")
+                changes["time"] = parse_time(request.json["time"])
             if "location" in request.json:
-                event_data.location = request.json["location"]
+                changes["location"] = request.json["location"]
             if "creator_name" in request.json:
-                event_data.creator_name = request.json["creator_name"]
+                changes["creator_name"] = request.json["creator_name"]
             if "description" in request.json:
-                event_data.description = request.json["description"]
+                changes["description"] = request.json["description"]
             if "image" in request.json:
-                event_data.image = request.json["image"]
+                changes["image"] = request.json["image"]
 
             # commit changes to db and return 201
-            db.session.commit()
-
-            response_template = json.dumps(
-                {
-                    "creator_token": "",
-                    "title":"",
-                    "identifier":"",
-                    "time":"",
-                    "location":"",
-                    "creator_name":"",
-                    "description":"",
-                    "image":""
-                })
-            response_json = json.loads(response_template)
-            response_json["creator_token"] = event_data.creator_token
-            response_json["title"] = event_data.title
-            response_json["identifier"] = event_data.identifier
-            response_json["time"] = (event_data.time).strftime("%Y-%m-%dT%H:%M:%S%z")
-            response_json["location"] = event_data.location
-            response_json["creator_name"] = event_data.creator_name
-            response_json["description"] = event_data.description
-            response_json["image"] = event_data.image
+            repository.update_event(event_data, changes)
+            event_cache.invalidate(event_id)
+
+            # the token of the request is the creator token
+            response_json = event_to_dict(event_data, creator_token=authorization_token(request.headers.get("Authorization")))
             return response_json, 200
-        except (KeyError, ValueError, IntegrityError, OperationalError):
+        except ConcurrentUpdateError:
+            return "Event was modified concurrently, try again", 409
+        except (KeyError, ValueError, StorageError):
             return "General error o7, please contact administrators", 400
 
 
@@ -388,7 +647,7 @@ class EventItem(Resource):
         """delete event, requires creator token as header"""
         try:
             # check if event exists and continue
-            event_data = Event.query.filter_by(identifier=event_id).first()
+            event_data = repository.get_event(event_id)
             if not event_data:
                 return "Event not found", 404
 
@@ -398,10 +657,10 @@ class EventItem(Resource):
 
             # for attendee in event_data.attendees:  # hacky way of deleting users of the event
             #     User.query.filter_by(user_identifier=attendee.user_identifier).delete()
-            Event.query.filter_by(identifier=event_id).delete()
-            db.session.commit()
+            repository.delete_event(event_data)
+            event_cache.invalidate(event_id)
             return "OK", 204
-        except (KeyError, ValueError, IntegrityError, OperationalError):
+        except (KeyError, ValueError, StorageError):
             return "General error o7, please contact administrators", 400
 
 
@@ -472,39 +731,26 @@ class AttendeeCollection(Resource):
 
 
     def get(self, event_identifier):
-        """get list of all attendees to specific event as JSON array"""
+        """get list of all attendees to specific event as JSON array, ?fields= limits the fields read and returned"""
 
         try:
+            try:
+                fields = parse_fields(request.args.get("fields"), USER_FIELDS)
+            except ValueError:
+                return "Invalid fields, choose from {}".format(", ".join(USER_FIELDS)), 400
+
             # check if event exists and continue
-            event_item = Event.query.filter_by(identifier=event_identifier).first()
-            if not event_item:
+            snapshot = get_event_snapshot(event_identifier)
+            if not snapshot:
                 return "Event not found", 404
 
             # check authentication
-            if not authenticate_user(request.headers.get("Authorization"), event_item.creator_token):
+            if not authenticate_user(request.headers.get("Authorization"), snapshot["creator_token"]):
                 return "Authentication failed", 401
 
-            response_data = []
-            response_template = json.dumps(
-                {
-                    "user_identifier":"",
-                    "user_name":"",
-                    "first_name":"",
-                    "last_name":"",
-                    "email":"",
-                    "phone":""
-                })
-            for attendee in event_item.attendees:
-                response_json = json.loads(response_template)
-                response_json["user_identifier"] = attendee.user_identifier
-                response_json["user_name"] = attendee.user_name
-                response_json["first_name"] = attendee.first_name
-                response_json["last_name"] = attendee.last_name
-                response_json["email"] = attendee.email
-                response_json["phone"] = attendee.phone
-                response_data.append(response_json)
+            response_data = [user_to_dict(attendee, fields=fields) for attendee in repository.list_attendees(snapshot["id"], fields)]
             return response_data, 200
-        except (KeyError, ValueError, IntegrityError, OperationalError):
+        except (KeyError, ValueError, StorageError):
             return "General error o7, please contact administrators", 400
 
 
@@ -512,80 +758,160 @@ class AttendeeCollection(Resource):
         """create new attendee to specific event"""
 
         # check if request is json and follows correct schema
-        if not request.json or not validate_json(request.json, post_user_schema()):
+        if not request.json:
             return "Request content type must be JSON", 415
+        errors = validate_json(request.json, validators["post_user"])
+        if errors:
+            return {"message": "Request does not match schema", "errors": errors}, 415
 
         try:
             # check if event exists and continue
-            event_item = Event.query.filter_by(identifier=event_identifier).first()
-            if not event_item:
+            snapshot = get_event_snapshot(event_identifier)
+            if not snapshot:
                 return "Event not found", 404
 
-            # create dict with empty values for all keys
-            attendee_info = {"user_identifier": "", "user_token": "", "user_name": "", "first_name": "", "last_name": "", "email": "", "phone": ""}
-
-            # check for duplicate usernames within event
-            for attendee in event_item.attendees:
-                if request.json["user_name"] == attendee.user_name:
-                    return "Username is in use", 409
+            # create new db entry for new user, duplicate username within event violates unique index
+            attendee_info, user_token = attendee_info_from_request(request.json)
+            try:
+                new_attendee = repository.add_attendee(snapshot["id"], attendee_info)
+            except IdentifierConflictError:
+                return "Identifier collision, please retry", 409
+            except ConflictError:
+                return "Username is in use", 409
+            except NotFoundError:
+                # event was deleted after the snapshot was cached, e.g. by another worker
+                event_cache.invalidate(event_identifier)
+                return "Event not found", 404
 
-            # check if request contains information and save that info to dict
-            # user_name is required, so no need to check it
-            attendee_info["user_name"] = request.json["user_name"]
-            if "first_name" in request.json:
-                attendee_info["first_name"] = request.json["first_name"]
-            if "last_name" in request.json:
-                attendee_info["last_name"] = request.json["last_name"]
-            if "email" in request.json:
-                attendee_info["email"] = request.json["email"]
-            if "phone" in request.json:
-                attendee_info["phone"] = request.json["phone"]
-
-            # create secret token for user to modify or remove event participation later
-            attendee_info["user_token"] = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for j in range(64))
-
-            # create unique user identifier
-            attendee_info["user_identifier"] = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for i in range(8))
-
-            # create new db entry for new user
-            # TODO: change request handling to not save empty strings if value is not given
-            new_attendee = User(
-                event=event_item,
-                event_id=event_identifier,
-                user_identifier=attendee_info["user_identifier"],
-                user_token=attendee_info["user_token"],
-                user_name=attendee_info["user_name"],
-                first_name=attendee_info["first_name"],
-                last_name=attendee_info["last_name"],
-                email=attendee_info["email"],
-                phone=attendee_info["phone"]
-            )
-
-            # add and commit changes to db
-            db.session.add(new_attendee)
-            db.session.commit()
-
-            # db query to return user_identifier and user_token as response after joining event
-            user_data = User.query.filter_by(user_identifier=attendee_info["user_identifier"]).first()
-            response_template = json.dumps(
-                {
-                    "user_identifier":"",
-                    "user_name":"",
-                    "first_name":"",
-                    "last_name":"",
-                    "email":"",
-                    "phone":""
-                })
-            response_json = json.loads(response_template)
-            response_json["user_identifier"] = user_data.user_identifier
-            response_json["user_token"] = user_data.user_token
-            response_json["user_name"] = user_data.user_name
-            response_json["first_name"] = user_data.first_name
-            response_json["last_name"] = user_data.last_name
-            response_json["email"] = user_data.email
-            response_json["phone"] = user_data.phone
+            # respond with user_identifier and user_token of the created object after joining event
+            response_json = user_to_dict(new_attendee, user_token=user_token)
             return response_json, 201
-        except (KeyError, ValueError, OperationalError):
+        except (KeyError, ValueError, StorageError):
+            return "General error o7, please contact administrators", 400
+
+
+def attendee_info_from_request(data):
+    """create dict of column values for new attendee from validated request data,
+    returns (attendee_info, user_token), only the hash of the token is stored"""
+
+    # create dict with empty values for all keys
+    attendee_info = {"user_identifier": "", "user_token": "", "user_name": "", "first_name": "", "last_name": "", "email": "", "phone": ""}
+
+    # check if request contains information and save that info to dict
+    # user_name is required, so no need to check it
+    attendee_info["user_name"] = data["user_name"]
+    if "first_name" in data:
+        attendee_info["first_name"] = data["first_name"]
+    if "last_name" in data:
+        attendee_info["last_name"] = data["last_name"]
+    if "email" in data:
+        attendee_info["email"] = data["email"]
+    if "phone" in data:
+        attendee_info["phone"] = data["phone"]
+
+    # create secret token for user to modify or remove event participation later
+    user_token = generate_token(64)
+    attendee_info["user_token"] = token_hasher.hash(user_token)
+
+    # create unique user identifier
+    attendee_info["user_identifier"] = generate_token(8)
+
+    # TODO: change request handling to not save empty strings if value is not given
+    return attendee_info, user_token
+
+def read_import_rows():
+    """yield attendee dicts from CSV (with header row) or NDJSON request body while it is being read,
+    None is yielded for rows that can't be parsed"""
+    lines = (line.decode("utf-8") for line in request.stream)
+    if request.mimetype == "text/csv":
+        for row in csv.DictReader(lines):
+            # empty CSV cells are treated as missing values
+            yield {key: value for key, value in row.items() if key and value}
+    else:
+        for line in lines:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+
+def import_attendee_batch(event_pk, batch, report):
+    """insert batch of (report index, attendee dict) in one transaction, usernames are checked in bulk"""
+    names = [item["user_name"] for index, item in batch]
+    taken = repository.taken_user_names(event_pk, names)
+    rows = []
+    inserted = []
+    for index, item in batch:
+        if item["user_name"] in taken:
+            report[index]["errors"] = [{"field": "user_name", "message": "Username is in use"}]
+            continue
+        # usernames are also unique within the batch
+        taken.add(item["user_name"])
+        attendee_info, user_token = attendee_info_from_request(item)
+        rows.append(attendee_info)
+        inserted.append(index)
+        report[index].update(user_identifier=attendee_info["user_identifier"], user_token=user_token)
+    if not rows:
+        return
+    for attempt in range(IDENTIFIER_RETRIES):
+        try:
+            repository.add_attendees(event_pk, rows)
+            return
+        except IdentifierConflictError:
+            # none of the batch was inserted, generated identifiers are replaced for the next attempt
+            for index, attendee_info in zip(inserted, rows):
+                attendee_info["user_identifier"] = generate_token(8)
+                report[index]["user_identifier"] = attendee_info["user_identifier"]
+        except ConflictError:
+            # a concurrent join took a username after the check, none of the batch was inserted
+            for index in inserted:
+                report[index] = {"row": report[index]["row"], "errors": [{"field": "user_name", "message": "Username was taken during import, please retry"}]}
+            return
+    for index in inserted:
+        report[index] = {"row": report[index]["row"], "errors": [{"field": "user_identifier", "message": "Identifier collision, please retry"}]}
+
+
+class AttendeeImport(Resource):
+
+    def post(self, event_identifier):
+        """import many attendees to specific event from CSV (text/csv) or NDJSON (application/x-ndjson),
+        requires creator token as header, responds with user_identifier and user_token or errors for each row,
+        rows imported before an error are reported with the error"""
+        if request.mimetype not in ("text/csv", "application/x-ndjson"):
+            return "Request content type must be CSV or NDJSON", 415
+        try:
+            # check if event exists and continue
+            snapshot = get_event_snapshot(event_identifier)
+            if not snapshot:
+                return "Event not found", 404
+
+            # check authentication
+            if not authenticate_user(request.headers.get("Authorization"), snapshot["creator_token"]):
+                return "Authentication failed", 401
+
+            report = []
+            batch = []
+            try:
+                for row, item in enumerate(read_import_rows(), start=1):
+                    report.append({"row": row})
+                    errors = [{"field": "", "message": "Invalid row"}] if item is None else validate_json(item, validators["post_user"])
+                    if errors:
+                        report[-1]["errors"] = errors
+                        continue
+                    batch.append((len(report) - 1, item))
+                    if len(batch) == IMPORT_BATCH_SIZE:
+                        import_attendee_batch(snapshot["id"], batch, report)
+                        batch = []
+                if batch:
+                    import_attendee_batch(snapshot["id"], batch, report)
+            except (KeyError, ValueError, StorageError):
+                # earlier batches are committed, so their tokens are returned with the error, rows of the current batch were not inserted
+                for index, item in batch:
+                    if "errors" not in report[index]:
+                        report[index] = {"row": report[index]["row"], "errors": [{"field": "", "message": "Not imported"}]}
+                return {"message": "General error o7, please contact administrators", "report": report}, 400
+            return report, 201
+        except (KeyError, ValueError, StorageError):
             return "General error o7, please contact administrators", 400
 
 
@@ -648,42 +974,36 @@ class AttendeeItem(Resource):
 #     return "Not Found", 404
 
     def get(self, event_identifier, attendee_id):
-        """get information of one attendee as JSON array"""
+        """get information of one attendee as JSON array, ?fields= limits the fields returned"""
         try:
+            try:
+                fields = parse_fields(request.args.get("fields"), USER_FIELDS)
+            except ValueError:
+                return "Invalid fields, choose from {}".format(", ".join(USER_FIELDS)), 400
+
             # check if event exists and continue
-            event_item = Event.query.filter_by(identifier=event_identifier).first()
-            if not event_item:
+            snapshot = get_event_snapshot(event_identifier)
+            if not snapshot:
                 return "Event not found", 404
 
             # check if user exists and continue
-            user_item = User.query.filter_by(user_identifier=attendee_id).first()
-            if not user_item:
+            # attendees of other events are not found through this event
+            user_item = repository.get_attendee(attendee_id)
+            if not user_item or user_item.event_id != snapshot["id"]:
                 return "User not found", 404
 
-            # check authentication, continue if request contains correct creator_token or user_token
-            if not authenticate_user(request.headers.get("Authorization"), event_item.creator_token):
-                if not authenticate_user(request.headers.get("Authorization"), user_item.user_token):
-                    return "Authentication failed", 401
-
-            response_template = json.dumps(
-                {
-                    "user_identifier":"",
-                    "user_name":"",
-                    "first_name":"",
-                    "last_name":"",
-                    "email":"",
-                    "phone":""
-                })
-
-            response_json = json.loads(response_template)
-            response_json["user_identifier"] = user_item.user_identifier
-            response_json["user_name"] = user_item.user_name
-            response_json["first_name"] = user_item.first_name
-            response_json["last_name"] = user_item.last_name
-            response_json["email"] = user_item.email
-            response_json["phone"] = user_item.phone
-            return response_json, 200
-        except (KeyError, ValueError, IntegrityError, OperationalError):
+            # check authentication, continue if request contains correct creator_token or user_token,
+            # the token is hashed once for both
+            if not authenticate_user(request.headers.get("Authorization"), snapshot["creator_token"], user_item.user_token):
+                return "Authentication failed", 401
+
+            etag = make_etag(user_item.user_identifier, user_item.version)
+            if request.if_none_match.contains_weak(etag.strip('"')):
+                return None, 304, {"ETag": etag}
+
+            response_json = user_to_dict(user_item, fields=fields)
+            return response_json, 200, {"ETag": etag}
+        except (KeyError, ValueError, StorageError):
             return "General error o7, please contact administrators", 400
 
 
@@ -691,65 +1011,56 @@ class AttendeeItem(Resource):
         """modify attendee participation information"""
 
         # check if request is json and follows correct schema
-        if not request.json or not validate_json(request.json, put_user_schema()):
+        if not request.json:
             return "Request content type must be JSON", 415
+        errors = validate_json(request.json, validators["put_user"])
+        if errors:
+            return {"message": "Request does not match schema", "errors": errors}, 415
 
         try:
             # check if event exists and continue
-            event_item = Event.query.filter_by(identifier=event_identifier).first()
-            if not event_item:
+            snapshot = get_event_snapshot(event_identifier)
+            if not snapshot:
                 return "Event not found", 404
 
             # check if user exists and continue
-            user_item = User.query.filter_by(user_identifier=attendee_id).first()
-            if not user_item:
+            # attendees of other events are not found through this event
+            user_item = repository.get_attendee(attendee_id)
+            if not user_item or user_item.event_id != snapshot["id"]:
                 return "User not found", 404
 
-            # check authentication, continue if request contains correct creator_token or user_token
-            if not authenticate_user(request.headers.get("Authorization"), event_item.creator_token):
-                if not authenticate_user(request.headers.get("Authorization"), user_item.user_token):
-                    return "Authentication failed", 401
+            # check authentication, continue if request contains correct creator_token or user_token,
+            # the token is hashed once for both
+            if not authenticate_user(request.headers.get("Authorization"), snapshot["creator_token"], user_item.user_token):
+                return "Authentication failed", 401
 
             # check if request contains information and save that info to dict
+            changes = {}
             if "user_name" in request.json:
-
-                # check for duplicate usernames within event
-                for attendee in event_item.attendees:
-                    if ((request.json["user_name"] == attendee.user_name) & (request.json["user_name"] != user_item.user_name)):
-                        return "Username is in use", 409
-                user_item.user_name = request.json["user_name"]
+                changes["user_name"] = request.json["user_name"]
 
             if "first_name" in request.json:
-                user_item.first_name = request.json["first_name"]
+                changes["first_name"] = request.json["first_name"]
             if "last_name" in request.json:
-                user_item.last_name = request.json["last_name"]
+                changes["last_name"] = request.json["last_name"]
             if "email" in request.json:
-                user_item.email = request.json["email"]
+                changes["email"] = request.json["email"]
             if "phone" in request.json:
-                user_item.phone = request.json["phone"]
+                changes["phone"] = request.json["phone"]
 
-            # commit changes to db and return 201
-            db.session.commit()
-
-            response_template = json.dumps(
-                {
-                    "user_identifier":"",
-                    "user_name":"",
-                    "first_name":"",
-                    "last_name":"",
-                    "email":"",
-                    "phone":""
-                })
-            response_json = json.loads(response_template)
-            response_json["user_identifier"] = user_item.user_identifier
-            response_json["user_token"] = user_item.user_token
-            response_json["user_name"] = user_item.user_name
-            response_json["first_name"] = user_item.first_name
-            response_json["last_name"] = user_item.last_name
-            response_json["email"] = user_item.email
-            response_json["phone"] = user_item.phone
+            # commit changes to db and return 201, duplicate username within event violates unique index
+            try:
+                repository.update_attendee(user_item, changes)
+            except ConflictError:
+                return "Username is in use", 409
+
+            # user_token can only be returned to the attendee who sent it, not to the creator
+            token = authorization_token(request.headers.get("Authorization"))
+            response_json = user_to_dict(user_item, user_token=token if token_hasher.verify(token, user_item.user_token) else None)
             return response_json, 200
-        except (KeyError, ValueError, OperationalError):
+        except ConcurrentUpdateError:
+            return "Attendee was modified concurrently, try again", 409
+        except (KeyError, ValueError, StorageError):
             return "General error o7, please contact administrators", 400
 
 
@@ -758,23 +1069,24 @@ class AttendeeItem(Resource):
 
         try:
             # check if event exists and continue
-            event_item = Event.query.filter_by(identifier=event_identifier).first()
-            user_item = User.query.filter_by(user_identifier=attendee_id).first()
-            if not event_item:
+            snapshot = get_event_snapshot(event_identifier)
+            user_item = repository.get_attendee(attendee_id)
+            if not snapshot:
                 return "Event not found", 404
+            # attendees of other events are not found through this event
+            if user_item and user_item.event_id != snapshot["id"]:
+                user_item = None
 
             # check authentication, continue if request contains correct creator_token or user_token
-            if not authenticate_user(request.headers.get("Authorization"), event_item.creator_token):
-                if not authenticate_user(request.headers.get("Authorization"), user_item.user_token):
-                    return "Authentication failed", 401
+            if not authenticate_user(request.headers.get("Authorization"), snapshot["creator_token"], user_item and user_item.user_token):
+                return "Authentication failed", 401
 
             if not user_item:
                 return "User not found", 404
 
-            test = User.query.filter_by(user_identifier=attendee_id).delete()
-            db.session.commit()
+            repository.delete_attendee(user_item)
             return "OK", 204
-        except (KeyError, ValueError, OperationalError):
+        except (KeyError, ValueError, StorageError):
             return "General error o7, please contact administrators", 400
 
 
@@ -790,17 +1102,15 @@ class EventTime(Resource):
         # return "Not Found", 404
         """get time specific event by id as JSON array"""
         try:
-            response_template = json.dumps(
-                {
-                    "time":""
-                })
-            event_data = Event.query.filter_by(identifier=event_id).first()
-            response_json = json.loads(response_template)
-            response_json["time"] = (event_data.time).strftime("%Y-%m-%dT%H:%M:%S%z")
-            return response_json, 200
-        except AttributeError:
-            return "Event not found", 404
-        except (KeyError, ValueError, IntegrityError, OperationalError):
+            etag = event_not_modified(event_id)
+            if etag:
+                return None, 304, {"ETag": etag}
+            snapshot = get_event_snapshot(event_id)
+            if not snapshot:
+                return "Event not found", 404
+            response_json = {"time": snapshot["data"]["time"]}
+            return response_json, 200, {"ETag": make_etag(event_id, snapshot["version"])}
+        except (KeyError, ValueError, StorageError):
             return "General error o7, please contact administrators", 400
 
 
@@ -816,17 +1126,15 @@ class EventLocation(Resource):
         # return "Not Found", 404
         """get location of specific event by id as JSON array"""
         try:
-            response_template = json.dumps(
-                {
-                    "location":""
-                })
-            event_data = Event.query.filter_by(identifier=event_id).first()
-            response_json = json.loads(response_template)
-            response_json["location"] = event_data.location
-            return response_json, 200
-        except AttributeError:
-            return "Event not found", 404
-        except (KeyError, ValueError, IntegrityError, OperationalError):
+            etag = event_not_modified(event_id)
+            if etag:
+                return None, 304, {"ETag": etag}
+            snapshot = get_event_snapshot(event_id)
+            if not snapshot:
+                return "Event not found", 404
+            response_json = {"location": snapshot["data"]["location"]}
+            return response_json, 200, {"ETag": make_etag(event_id, snapshot["version"])}
+        except (KeyError, ValueError, StorageError):
             return "General error o7, please contact administrators", 400
 
 
@@ -842,17 +1150,15 @@ class EventDescription(Resource):
         # return "Not Found", 404
         """get description of specific event by id as JSON array"""
         try:
-            response_template = json.dumps(
-                {
-                    "description":""
-                })
-            event_data = Event.query.filter_by(identifier=event_id).first()
-            response_json = json.loads(response_template)
-            response_json["description"] = event_data.description
-            return response_json, 200
-        except AttributeError:
-            return "Event not found", 404
-        except (KeyError, ValueError, IntegrityError, OperationalError):
+            etag = event_not_modified(event_id)
+            if etag:
+                return None, 304, {"ETag": etag}
+            snapshot = get_event_snapshot(event_id)
+            if not snapshot:
+                return "Event not found", 404
+            response_json = {"description": snapshot["data"]["description"]}
+            return response_json, 200, {"ETag": make_etag(event_id, snapshot["version"])}
+        except (KeyError, ValueError, StorageError):
             return "General error o7, please contact administrators", 400
 
 
@@ -868,17 +1174,15 @@ class EventImage(Resource):
         # return "OK", 200
         # return "Not Found", 404
         try:
-            response_template = json.dumps(
-                {
-                    "image":""
-                })
-            event_data = Event.query.filter_by(identifier=event_id).first()
-            response_json = json.loads(response_template)
-            response_json["image"] = event_data.image
-            return response_json, 200
-        except AttributeError:
-            return "Event not found", 404
-        except (KeyError, ValueError, IntegrityError, OperationalError):
+            etag = event_not_modified(event_id)
+            if etag:
+                return None, 304, {"ETag": etag}
+            snapshot = get_event_snapshot(event_id)
+            if not snapshot:
+                return "Event not found", 404
+            response_json = {"image": snapshot["data"]["image"]}
+            return response_json, 200, {"ETag": make_etag(event_id, snapshot["version"])}
+        except (KeyError, ValueError, StorageError):
             return "General error o7, please contact administrators", 400
 
 
@@ -898,30 +1202,26 @@ class EventImage(Resource):
         # return "Unauthorized", 401
         # return "Not Found", 404
         """add or modify image of event"""
-        if not request.json or not validate_json(request.json, image_post_schema()):
+        if not request.json:
             return "Request content type must be JSON", 415
+        errors = validate_json(request.json, validators["post_image"])
+        if errors:
+            return {"message": "Request does not match schema", "errors": errors}, 415
         try:
-            event = Event.query.filter_by(identifier=event_id).first()
+            event = repository.get_event(event_id)
             if not event:
                 return "Not Found", 404
             if not authenticate_user(request.headers.get("Authorization"), event.creator_token):
                 return "invalid token", 401
 
-            event.image = request.json["image"]
-            db.session.add(event)
-            db.session.commit()
-            event_data = Event.query.filter_by(identifier=event_id).first()
-            response_template = json.dumps(
-                {
-                    "event_id": "",
-                    "image":""
-                })
-            response_json = json.loads(response_template)
-            response_json["event_id"] = event_data.identifier
-            response_json["image"] = event_data.image
-            logger.info("post image response: " + json.dumps(response_json))
+            repository.update_event(event, {"image": request.json["image"]})
+            event_cache.invalidate(event_id)
+            response_json = {"event_id": event.identifier, "image": event.image}
+            logger.debug("post image response: %s", response_json)
             return response_json, 201
-        except (KeyError, ValueError, OperationalError):
+        except ConcurrentUpdateError:
+            return "Event was modified concurrently, try again", 409
+        except (KeyError, ValueError, StorageError):
             return "Bad Request - https://http.cat/400", 400
 
 
@@ -936,29 +1236,91 @@ class EventImage(Resource):
         # return "Not Found", 404
         """delete event image"""
         try:
-            event = Event.query.filter_by(identifier=event_id).first()
+            event = repository.get_event(event_id)
             if not event:
                 return "Not Found", 404
             if not authenticate_user(request.headers.get("Authorization"), event.creator_token):
                 return "invalid token", 401
-            event = Event.query.filter_by(identifier=event_id).first()
-            event.image = None
-            db.session.add(event)
-            db.session.commit()
+            repository.update_event(event, {"image": None})
+            event_cache.invalidate(event_id)
             return "OK", 204
-        except (AttributeError, KeyError):
+        except ConcurrentUpdateError:
+            return "Event was modified concurrently, try again", 409
+        except (AttributeError, KeyError, StorageError):
             return "Bad Request - https://http.cat/400", 400
 
-db.create_all()
-api.add_resource(ApiRoot, "/")
-api.add_resource(EventCollection, "/event")
-api.add_resource(EventItem, "/event/<event_id>")
-api.add_resource(AttendeeCollection, "/event/<event_identifier>/attendees")
-api.add_resource(AttendeeItem, "/event/<event_identifier>/attendees/<attendee_id>")
-api.add_resource(EventTime, "/event/<event_id>/time")
-api.add_resource(EventLocation, "/event/<event_id>/location")
-api.add_resource(EventDescription, "/event/<event_id>/description")
-api.add_resource(EventImage, "/event/<event_id>/image")
+def create_app(config=None):
+    """create Notikums app, the database schema is set up with `flask init-db` or on first request"""
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    if config:
+        app.config.update(config)
+
+    db.init_app(app)
+    app.extensions["notikums_repository"] = create_repository(app.config["STORAGE_BACKEND"])
+    setup_logging(app.config)
+    # after logging is set up, so that the warning of a missing key is logged
+    app.extensions["notikums_tokens"] = TokenHasher.from_config(app.config)
+    app.extensions["notikums_event_cache"] = LRUCache(app.config["EVENT_CACHE_SIZE"], app.config["EVENT_CACHE_TTL"])
+
+    @app.cli.command("init-db")
+    def init_db_command():
+        """Create the database tables."""
+        repository.init_schema()
+
+    @app.cli.command("hash-tokens")
+    def hash_tokens_command():
+        """Replace tokens stored in plaintext by older versions with their hashes."""
+        count = repository.hash_plaintext_tokens(token_hasher.hash)
+        print("Hashed {} tokens".format(count))
+
+    @app.cli.command("utc-times")
+    @click.option("--offset", help="UTC offset of the stored times, e.g. +02:00, local time zone of the server by default")
+    def utc_times_command(offset):
+        """Convert event times stored without offset by older versions to UTC, once."""
+        if offset is not None:
+            try:
+                offset = datetime.datetime.strptime(offset, "%z").utcoffset()
+            except ValueError:
+                raise click.BadParameter("UTC offset must be e.g. +02:00", param_hint="--offset")
+        count = repository.convert_local_times(offset)
+        if count is None:
+            print("Event times are already in UTC")
+        else:
+            print("Converted {} event times".format(count))
+
+    if app.config["AUTO_INIT_DB"]:
+        @app.before_first_request
+        def init_db_once():
+            repository.init_schema()
+
+    # every resource method is wrapped to record metrics by its route template,
+    # and profiled on demand if profiling is enabled with PROFILE_SECRET or PROFILE_SAMPLE_RATE
+    decorators = []
+    profiler = RequestProfiler.from_config(app.config)
+    if profiler.enabled:
+        decorators.append(profiler.instrument)
+    if app.config["METRICS_ENABLED"]:
+        metrics = app.extensions["notikums_metrics"] = RequestMetrics()
+        metrics.add_cache("event", app.extensions["notikums_event_cache"])
+        decorators.append(metrics.instrument)
+        app.add_url_rule("/metrics", "metrics", metrics_view)
+
+    api = Api(app, decorators=decorators)
+    api.representation("application/json")(output_json)
+    api.add_resource(ApiRoot, "/")
+    api.add_resource(EventCollection, "/event")
+    api.add_resource(EventSearch, "/event/search")
+    api.add_resource(EventBatch, "/event/batch")
+    api.add_resource(EventItem, "/event/<event_id>")
+    api.add_resource(AttendeeCollection, "/event/<event_identifier>/attendees")
+    api.add_resource(AttendeeImport, "/event/<event_identifier>/attendees/import")
+    api.add_resource(AttendeeItem, "/event/<event_identifier>/attendees/<attendee_id>")
+    api.add_resource(EventTime, "/event/<event_id>/time")
+    api.add_resource(EventLocation, "/event/<event_id>/location")
+    api.add_resource(EventDescription, "/event/<event_id>/description")
+    api.add_resource(EventImage, "/event/<event_id>/image")
+    return app
 
 
 # get list of events with GET
@@ -0,0 +1,254 @@
+"""in-process benchmarks of every API route through the Flask test client
+a dataset of given size is seeded first, results are written as JSON and can be compared to a previous run
+
+python benchmark.py --size small --attendees 10,1000 --output results.json
+python benchmark.py --size small --attendees 10,1000 --compare results.json
+"""
+import argparse, datetime, json, os, platform, statistics, sys, tempfile, time
+import app
+from seed import seed, event_identifier, user_identifier, seeded_token
+
+# number of seeded events
+SIZES = {"small": 1000, "medium": 100000, "large": 1000000}
+
+
+def auth(token):
+    return {"Authorization": "Basic " + token}
+
+
+def build_cases(client, events, attendee_counts, iterations, seed_value):
+    """return list of (name, expected status, request function of iteration number) for every route,
+    objects needed by the cases are created here through the API"""
+    event_id = event_identifier(events - 1)
+    creator_token = seeded_token(seed_value, event_id)
+    # conditional GET of an event which is not modified by the cases
+    unmodified_id = event_identifier(0)
+    etag = client.get("/event/" + unmodified_id).headers["ETag"]
+    event_body = {"title": "benchmark event", "time": "2030-06-01T12:00:00+0000", "location": "Oulu", "description": "benchmark"}
+
+    # events and attendees which are deleted by the cases
+    deletable_events = []
+    for i in range(iterations):
+        data = client.post("/event", json=event_body).json
+        deletable_events.append((data["identifier"], data["creator_token"]))
+    attendee = client.post("/event/{}/attendees".format(event_id), json={"user_name": "bench-attendee"}).json
+    deletable_attendees = [
+        client.post("/event/{}/attendees".format(event_id), json={"user_name": "bench-delete-{}".format(i)}).json
+        for i in range(iterations)
+    ]
+    batch = [dict(event_body, title="batch event {}".format(i)) for i in range(100)]
+    import_rows = "user_name,first_name,email\n" + "".join("import-{{0}}-{},First,import{}@mail.example\n".format(i, i) for i in range(100))
+
+    cases = [
+        ("root", 302, lambda i: client.get("/")),
+        ("event_list", 200, lambda i: client.get("/event")),
+        ("event_list_fields", 200, lambda i: client.get("/event?fields=identifier,title,time")),
+        ("event_list_range", 200, lambda i: client.get("/event?from=2030-01-01T00:00:00%2B0000&to=2030-01-08T00:00:00%2B0000")),
+        ("event_search", 200, lambda i: client.get("/event/search?q=python+meetup")),
+        ("event_create", 201, lambda i: client.post("/event", json=event_body)),
+        ("event_batch_100", 201, lambda i: client.post("/event/batch", json=batch)),
+        ("event_get", 200, lambda i: client.get("/event/" + event_id)),
+        ("event_get_attendee_count", 200, lambda i: client.get("/event/{}?expand=attendee_count".format(event_id))),
+        ("event_get_not_modified", 304, lambda i: client.get("/event/" + unmodified_id, headers={"If-None-Match": etag})),
+        ("event_update", 200, lambda i: client.put("/event/" + event_id, json={"description": "updated {}".format(i)}, headers=auth(creator_token))),
+        ("event_delete", 204, lambda i: client.delete("/event/" + deletable_events[i][0], headers=auth(deletable_events[i][1]))),
+        ("event_time", 200, lambda i: client.get("/event/{}/time".format(event_id))),
+        ("event_location", 200, lambda i: client.get("/event/{}/location".format(event_id))),
+        ("event_description", 200, lambda i: client.get("/event/{}/description".format(event_id))),
+        ("event_image", 200, lambda i: client.get("/event/{}/image".format(event_id))),
+        ("image_post", 201, lambda i: client.post("/event/{}/image".format(event_id), json={"image": "https://example.com/{}.jpg".format(i)}, headers=auth(creator_token))),
+        ("image_delete", 204, lambda i: client.delete("/event/{}/image".format(event_id), headers=auth(creator_token))),
+        ("attendee_create", 201, lambda i: client.post("/event/{}/attendees".format(event_id), json={"user_name": "bench-{}".format(i)})),
+        ("attendee_import_100", 201, lambda i: client.post("/event/{}/attendees/import".format(event_id), data=import_rows.format(i), content_type="text/csv", headers=auth(creator_token))),
+        ("attendee_get", 200, lambda i: client.get("/event/{}/attendees/{}".format(event_id, attendee["user_identifier"]), headers=auth(attendee["user_token"]))),
+        ("attendee_update", 200, lambda i: client.put("/event/{}/attendees/{}".format(event_id, attendee["user_identifier"]), json={"first_name": "First {}".format(i)}, headers=auth(attendee["user_token"]))),
+        ("attendee_delete", 204, lambda i: client.delete("/event/{}/attendees/{}".format(event_id, deletable_attendees[i]["user_identifier"]), headers=auth(creator_token))),
+    ]
+    # attendee lists of the events with given number of attendees
+    for i, count in enumerate(attendee_counts):
+        identifier = event_identifier(i)
+        token = seeded_token(seed_value, identifier)
+        cases.append(("attendee_list_{}".format(count), 200, lambda i, identifier=identifier, token=token: client.get("/event/{}/attendees".format(identifier), headers=auth(token))))
+        cases.append(("event_expand_{}".format(count), 200, lambda i, identifier=identifier, token=token: client.get("/event/{}?expand=attendees,attendee_count".format(identifier), headers=auth(token))))
+    return cases
+
+
+def build_auth_cases(seed_value):
+    """return cases of token verification of an attendee request without the rest of the request, run in app context,
+    status is 200 for accepted and 401 for rejected tokens, auth_plaintext is the comparison used before tokens were hashed"""
+    creator_token = seeded_token(seed_value, event_identifier(0))
+    user_token = seeded_token(seed_value, user_identifier(0))
+    creator_hash = app.token_hasher.hash(creator_token)
+    user_hash = app.token_hasher.hash(user_token)
+
+    def verify(token):
+        return 200 if app.authenticate_user("Basic " + token, creator_hash, user_hash) else 401
+
+    def plaintext(token):
+        auth_type, auth_token = ("Basic " + token).split(" ", 1)
+        return 200 if auth_type == "Basic" and (auth_token == creator_token or auth_token == user_token) else 401
+
+    return [
+        ("auth_plaintext", 200, lambda i: plaintext(user_token)),
+        ("auth_creator_token", 200, lambda i: verify(creator_token)),
+        ("auth_user_token", 200, lambda i: verify(user_token)),
+        ("auth_wrong_token", 401, lambda i: verify("X" * 64)),
+    ]
+
+
+def time_case(send, warmup, repeat):
+    """return durations and statuses of the timed calls of send, which returns a response or a status code"""
+    durations = []
+    statuses = []
+    for i in range(warmup + repeat):
+        start = time.perf_counter()
+        response = send(i)
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            durations.append(elapsed)
+            statuses.append(getattr(response, "status_code", response))
+    return durations, statuses
+
+
+def summarize(durations, statuses):
+    """return statistics of durations in microseconds"""
+    durations = sorted(durations)
+    quantiles = statistics.quantiles(durations, n=100, method="inclusive") if len(durations) > 1 else durations * 99
+    return {
+        "n": len(durations),
+        "mean_us": round(statistics.mean(durations) * 1e6, 1),
+        "p50_us": round(quantiles[49] * 1e6, 1),
+        "p95_us": round(quantiles[94] * 1e6, 1),
+        "p99_us": round(quantiles[98] * 1e6, 1),
+        "min_us": round(durations[0] * 1e6, 1),
+        "max_us": round(durations[-1] * 1e6, 1),
+        "status": {str(status): statuses.count(status) for status in sorted(set(statuses))}
+    }
+
+
+def run(config, events, attendee_counts, repeat, warmup, seed_value=0, only=None):
+    """seed app created with config and time every case, returns results dict"""
+    flask_app = app.create_app(dict(config, AUTO_INIT_DB=False))
+    started = time.perf_counter()
+    with flask_app.app_context():
+        app.repository.init_schema()
+        seed(app.repository, events, attendee_counts, seed_value)
+    seed_seconds = time.perf_counter() - started
+
+    client = flask_app.test_client()
+    results = {}
+    for name, expected, send in build_cases(client, events, attendee_counts, warmup + repeat, seed_value):
+        if only and name not in only:
+            continue
+        results[name] = summarize(*time_case(send, warmup, repeat))
+        results[name]["expected_status"] = expected
+    with flask_app.app_context():
+        for name, expected, send in build_auth_cases(seed_value):
+            if only and name not in only:
+                continue
+            results[name] = summarize(*time_case(send, warmup, repeat))
+            results[name]["expected_status"] = expected
+    if config.get("STORAGE_BACKEND") != "memory":
+        with flask_app.app_context():
+            app.db.session.remove()
+            app.db.get_engine().dispose()
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": config.get("SQLALCHEMY_DATABASE_URI", "").split(":")[0] if config.get("STORAGE_BACKEND") != "memory" else "memory",
+            "events": events,
+            "attendees": attendee_counts,
+            "repeat": repeat,
+            "warmup": warmup,
+            "seed": seed_value,
+            "seed_seconds": round(seed_seconds, 2),
+            "time": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S%z")
+        },
+        "results": results
+    }
+
+
+def compare(results, baseline, threshold):
+    """return list of (name, baseline p50, p50, ratio) and names of cases slower than baseline by more than threshold"""
+    rows = []
+    regressions = []
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]["p50_us"]
+        ratio = result["p50_us"] / before if before else float("inf")
+        rows.append((name, before, result["p50_us"], ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every Notikums API route in-process")
+    parser.add_argument("--size", choices=SIZES, default="small", help="number of seeded events: small 1k, medium 100k, large 1M")
+    parser.add_argument("--events", type=int, help="number of seeded events, overrides --size")
+    parser.add_argument("--attendees", default="10,1000", help="comma separated attendee counts of the events with attendees, e.g. 10,1000,50000")
+    parser.add_argument("--backend", choices=["sqlite", "postgresql", "memory"], default="sqlite")
+    parser.add_argument("--database-uri", help="database for sqlite or postgresql backend, a temporary SQLite file by default")
+    parser.add_argument("--repeat", type=int, default=200, help="timed requests per route")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed requests per route before timing")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random dataset")
+    parser.add_argument("--only", help="comma separated names of cases to run")
+    parser.add_argument("--output", help="write results as JSON to file instead of stdout")
+    parser.add_argument("--compare", help="JSON results of a previous run, exit with status 1 if p50 of a case regressed")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative p50 slowdown when comparing")
+    args = parser.parse_args(argv)
+
+    events = args.events if args.events is not None else SIZES[args.size]
+    attendee_counts = [int(count) for count in args.attendees.split(",") if count]
+    if len(attendee_counts) > events:
+        parser.error("more attendee counts than events")
+    config = {"TESTING": True, "LOG_LEVEL": "WARNING"}
+    db_file = None
+    if args.backend == "memory":
+        config["STORAGE_BACKEND"] = "memory"
+    elif args.database_uri:
+        config["SQLALCHEMY_DATABASE_URI"] = args.database_uri
+    elif args.backend == "postgresql":
+        parser.error("--database-uri is required with postgresql backend")
+    else:
+        db_fd, db_file = tempfile.mkstemp(suffix=".db")
+        os.close(db_fd)
+        config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_file
+
+    try:
+        results = run(config, events, attendee_counts, args.repeat, args.warmup, args.seed, args.only.split(",") if args.only else None)
+    finally:
+        if db_file:
+            for fname in [db_file, db_file + "-wal", db_file + "-shm"]:
+                if os.path.exists(fname):
+                    os.unlink(fname)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    # human readable summary to stderr so that stdout stays JSON
+    print("{:<26}{:>10}{:>10}{:>10}  status".format("case", "p50 us", "p95 us", "p99 us"), file=sys.stderr)
+    for name, result in results["results"].items():
+        unexpected = "" if result["status"] == {str(result["expected_status"]): result["n"]} else "  unexpected " + str(result["status"])
+        print("{:<26}{:>10}{:>10}{:>10}  {}{}".format(name, result["p50_us"], result["p95_us"], result["p99_us"], result["expected_status"], unexpected), file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows, regressions = compare(results, baseline, args.threshold)
+        print("\n{:<26}{:>12}{:>10}{:>8}".format("case", "baseline us", "p50 us", "ratio"), file=sys.stderr)
+        for name, before, after, ratio in rows:
+            print("{:<26}{:>12}{:>10}{:>8.2f}{}".format(name, before, after, ratio, "  REGRESSION" if name in regressions else ""), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""bounded in-process LRU cache with time-to-live for entries"""
+import threading, time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """thread safe LRU cache, entries older than ttl seconds are treated as misses"""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # key: [loads in progress, invalidations during them], only kept while get_or_load is loading the key
+        self._loads = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """return cached value or None if key is not cached or has expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """cache value, least recently used entry is evicted if cache is full"""
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_load(self, key, load):
+        """return cached value or value returned by load(), which is cached unless it is None
+        or the key was invalidated during the load, so a value read before a concurrent write is not cached"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            loading = self._loads.setdefault(key, [0, 0])
+            loading[0] += 1
+            generation = loading[1]
+        try:
+            value = load()
+        finally:
+            with self._lock:
+                loading[0] -= 1
+                if not loading[0]:
+                    del self._loads[key]
+                if value is not None and loading[1] == generation:
+                    self._store(key, value)
+        return value
+
+    def invalidate(self, key):
+        """remove key from cache if it is cached, values being loaded for it are not cached"""
+        with self._lock:
+            self._entries.pop(key, None)
+            if key in self._loads:
+                self._loads[key][1] += 1
+
+    def clear(self):
+        """remove all entries and reset counters"""
+        with self._lock:
+            self._entries.clear()
+            for loading in self._loads.values():
+                loading[1] += 1
+            self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self):
+        """return counters for sizing the cache"""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
@@ -0,0 +1,86 @@
+"""logging for the application, records are written to a rotating file by a background thread
+so that request threads only put records to a queue"""
+import atexit, logging, os, queue, random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# settings can be given in app config or overridden with NOTIKUMS_<KEY> environment variables
+DEFAULTS = {
+    "LOG_LEVEL": "INFO",
+    "LOG_FILE": "notikums_app.log",
+    "LOG_MAX_BYTES": 10 * 1024 * 1024,
+    "LOG_BACKUP_COUNT": 5,
+    "SQL_LOG_LEVEL": "WARNING",  # INFO logs every SQL statement, DEBUG also the result rows
+    "SQL_LOG_SAMPLE_RATE": 1.0,
+    "VALIDATION_LOG_SAMPLE_RATE": 1.0,
+}
+
+_listener = None
+_handlers = []
+
+
+class SamplingFilter(logging.Filter):
+    """pass given fraction of records below WARNING, warnings and errors always pass"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+
+def get_settings(config):
+    """return logging settings from config and environment"""
+    return {key: os.environ.get("NOTIKUMS_" + key, config.get(key, default)) for key, default in DEFAULTS.items()}
+
+
+def stop_logging():
+    """write queued records and stop the background thread"""
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+def setup_logging(config):
+    """configure notikums and sqlalchemy loggers, can be called again to apply new settings"""
+    global _listener
+    settings = get_settings(config)
+    stop_logging()
+    for logger, handler in _handlers:
+        logger.removeHandler(handler)
+    _handlers.clear()
+
+    file_handler = RotatingFileHandler(
+        settings["LOG_FILE"],
+        maxBytes=int(settings["LOG_MAX_BYTES"]),
+        backupCount=int(settings["LOG_BACKUP_COUNT"]),
+        delay=True
+    )
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    log_queue = queue.SimpleQueue()
+    _listener = QueueListener(log_queue, file_handler)
+    _listener.start()
+
+    app_logger = logging.getLogger("notikums")
+    app_logger.setLevel(settings["LOG_LEVEL"])
+    app_handler = QueueHandler(log_queue)
+    app_logger.addHandler(app_handler)
+    _handlers.append((app_logger, app_handler))
+
+    validation_logger = logging.getLogger("notikums.validation")
+    for old_filter in list(validation_logger.filters):
+        validation_logger.removeFilter(old_filter)
+    validation_logger.addFilter(SamplingFilter(float(settings["VALIDATION_LOG_SAMPLE_RATE"])))
+
+    # engine logs are only produced at all if SQL_LOG_LEVEL is INFO or DEBUG
+    logging.getLogger("sqlalchemy.engine").setLevel(settings["SQL_LOG_LEVEL"])
+    sql_logger = logging.getLogger("sqlalchemy")
+    sql_handler = QueueHandler(log_queue)
+    sql_handler.addFilter(SamplingFilter(float(settings["SQL_LOG_SAMPLE_RATE"])))
+    sql_logger.addHandler(sql_handler)
+    _handlers.append((sql_logger, sql_handler))
+    return _listener
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,148 @@
+"""request metrics of the API resources in Prometheus text format, recorded per route template
+with request counts by status code, latency histograms, db time and number of SQL statements,
+and the counters of the in-process caches of the app"""
+import bisect, functools, threading, time
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import HTTPException
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# upper bounds of histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# stats of LRUCache exported as gauges, counters start from zero when a cache is cleared
+CACHE_STATS = {
+    "size": "Entries in the cache.",
+    "maxsize": "Maximum number of entries in the cache.",
+    "hits": "Cache lookups which found a value.",
+    "misses": "Cache lookups which found no value or an expired one.",
+    "evictions": "Entries removed to make room for new ones.",
+    "expirations": "Entries removed because their time-to-live had passed.",
+}
+
+# SQL statements and db time of the request handled by the thread, None outside of instrumented requests
+_sql = threading.local()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_sql, "stats", None) is not None:
+        _sql.start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_sql, "stats", None)
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += time.perf_counter() - _sql.start
+
+
+class Histogram:
+    """counts of observations in fixed buckets, updated under the lock of RequestMetrics"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        # bucket bounds are inclusive, last count is for values above all bounds
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+def format_labels(labels):
+    return ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for name, value in labels)
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class RequestMetrics:
+    """thread safe request metrics of one app, labeled by route template and method"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._latency = {}
+        self._db_time = {}
+        self._statements = {}
+        self._caches = {}
+
+    def add_cache(self, name, cache):
+        """export stats of cache with label cache=name"""
+        self._caches[name] = cache
+
+    def observe(self, route, method, status, seconds, db_seconds=0.0, statements=0):
+        """record one handled request"""
+        key = (route, method)
+        with self._lock:
+            self._requests[key + (status,)] = self._requests.get(key + (status,), 0) + 1
+            if key not in self._latency:
+                self._latency[key] = Histogram(self.buckets)
+                self._db_time[key] = Histogram(self.buckets)
+            self._latency[key].observe(seconds)
+            self._db_time[key].observe(db_seconds)
+            self._statements[key] = self._statements.get(key, 0) + statements
+
+    def instrument(self, view):
+        """decorator for resource views, records every request of the view
+        streamed responses are timed until the response is returned, not until the body is sent"""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            _sql.stats = stats = [0, 0.0]
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = view(*args, **kwargs)
+                status = response.status_code
+                return response
+            except HTTPException as err:
+                status = err.code
+                raise
+            finally:
+                _sql.stats = None
+                self.observe(request.url_rule.rule, request.method, status, time.perf_counter() - start, stats[1], stats[0])
+        return wrapper
+
+    def render(self):
+        """return metrics in Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            lines.append("# HELP notikums_requests_total Handled requests by route, method and status code.")
+            lines.append("# TYPE notikums_requests_total counter")
+            for (route, method, status), count in sorted(self._requests.items()):
+                lines.append("notikums_requests_total{{{}}} {}".format(
+                    format_labels([("route", route), ("method", method), ("status", status)]), count))
+            self._render_histograms(lines, "notikums_request_duration_seconds", "Request handling time in seconds.", self._latency)
+            self._render_histograms(lines, "notikums_request_db_seconds", "Time spent executing SQL statements per request in seconds.", self._db_time)
+            lines.append("# HELP notikums_sql_statements_total Executed SQL statements by route and method.")
+            lines.append("# TYPE notikums_sql_statements_total counter")
+            for (route, method), count in sorted(self._statements.items()):
+                lines.append("notikums_sql_statements_total{{{}}} {}".format(format_labels([("route", route), ("method", method)]), count))
+        # caches have their own locks
+        if self._caches:
+            stats = {name: cache.stats() for name, cache in sorted(self._caches.items())}
+            for stat, description in CACHE_STATS.items():
+                lines.append("# HELP notikums_cache_{} {}".format(stat, description))
+                lines.append("# TYPE notikums_cache_{} gauge".format(stat))
+                for name, values in stats.items():
+                    lines.append("notikums_cache_{}{{{}}} {}".format(stat, format_labels([("cache", name)]), values[stat]))
+        return "\n".join(lines) + "\n"
+
+    def _render_histograms(self, lines, name, description, histograms):
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} histogram".format(name))
+        for (route, method), histogram in sorted(histograms.items()):
+            labels = [("route", route), ("method", method)]
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append("{}_bucket{{{}}} {}".format(name, format_labels(labels + [("le", bound)]), cumulative))
+            lines.append("{}_sum{{{}}} {}".format(name, format_labels(labels), format_value(histogram.sum)))
+            lines.append("{}_count{{{}}} {}".format(name, format_labels(labels), cumulative))
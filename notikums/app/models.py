@@ -0,0 +1,230 @@
+"""database models of events and attendees and setup of the database schema"""
+import datetime, logging
+from sqlalchemy import inspect
+from storage import StorageSQLAlchemy
+
+# objects are not expired on commit, so write handlers can respond without reloading the row
+# SQLite pragmas and connection pools are set up from app config in storage.py
+db = StorageSQLAlchemy(session_options={"expire_on_commit": False})
+logger = logging.getLogger("notikums")
+
+def to_utc(value):
+    """return datetime in UTC, naive datetimes are taken to be in UTC"""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc)
+
+class UTCDateTime(db.TypeDecorator):
+    """timezone-aware datetime, TIMESTAMP WITH TIME ZONE in PostgreSQL
+    and UTC time without offset in SQLite which has no time zone support"""
+    impl = db.DateTime
+
+    def __init__(self):
+        super().__init__(timezone=True)
+
+    def process_bind_param(self, value, dialect):
+        return to_utc(value)
+
+    def process_result_value(self, value, dialect):
+        return to_utc(value)
+
+# stored tokens are hashes with a prefix, see tokens.py
+TOKEN_HASH_LENGTH = 80
+
+# create db model for users
+class User(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey("event.id", ondelete='CASCADE'))
+    user_identifier = db.Column(db.String(8), unique=True, nullable=False) #this is exposed in API to identify users
+    user_token = db.Column(db.String(TOKEN_HASH_LENGTH), nullable=False)
+    user_name = db.Column(db.String(64), nullable=False)
+    first_name = db.Column(db.String(64), nullable=True)
+    last_name = db.Column(db.String(64), nullable=True)
+    email = db.Column(db.String(64), nullable=True)
+    phone = db.Column(db.String(16), nullable=True)
+    version = db.Column(db.Integer, nullable=False)  # incremented on every update, used for ETags
+
+    event = db.relationship("Event", back_populates="attendees")
+
+    # usernames are unique within event, enforced by db so concurrent joins can't race past the check
+    __table_args__ = (db.Index("ix_user_event_user_name", "event_id", "user_name", unique=True),)
+    __mapper_args__ = {"version_id_col": version}
+
+    def as_dict(self):
+       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+# create db model for events
+class Event(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    identifier = db.Column(db.String(8), unique=True, nullable=False)  # this is exposed in API to identify events
+    creator_name = db.Column(db.String(64), nullable=True)
+    creator_token = db.Column(db.String(TOKEN_HASH_LENGTH), nullable=False)
+    title = db.Column(db.String(128), nullable=False)
+    description = db.Column(db.String(256), nullable=True)
+    time = db.Column(UTCDateTime(), nullable=False)
+    location = db.Column(db.String(64), nullable=False)
+    image =  db.Column(db.String(256), nullable=True)
+    version = db.Column(db.Integer, nullable=False)  # incremented on every update, used for ETags
+
+    attendees = db.relationship("User", back_populates="event")
+
+    # index for keyset pagination of the event list
+    __table_args__ = (db.Index("ix_event_time_id", "time", "id"),)
+    __mapper_args__ = {"version_id_col": version}
+
+    # credit to https://stackoverflow.com/questions/5022066/how-to-serialize-sqlalchemy-result-to-json
+    def as_dict(self):
+       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+# full-text search index of events, SQLite FTS5 table kept in sync with event table by triggers
+EVENT_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS event_fts USING fts5(title, description, location, content='event', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS event_fts_insert AFTER INSERT ON event BEGIN
+        INSERT INTO event_fts(rowid, title, description, location) VALUES (new.id, new.title, new.description, new.location);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS event_fts_delete AFTER DELETE ON event BEGIN
+        INSERT INTO event_fts(event_fts, rowid, title, description, location) VALUES ('delete', old.id, old.title, old.description, old.location);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS event_fts_update AFTER UPDATE OF title, description, location ON event BEGIN
+        INSERT INTO event_fts(event_fts, rowid, title, description, location) VALUES ('delete', old.id, old.title, old.description, old.location);
+        INSERT INTO event_fts(rowid, title, description, location) VALUES (new.id, new.title, new.description, new.location);
+    END""",
+]
+for statement in EVENT_FTS_DDL:
+    db.event.listen(Event.__table__, "after_create", db.DDL(statement).execute_if(dialect="sqlite"))
+db.event.listen(Event.__table__, "before_drop", db.DDL("DROP TABLE IF EXISTS event_fts").execute_if(dialect="sqlite"))
+event_fts = db.table("event_fts", db.column("rowid"), db.column("rank"))
+
+# full-text search of events in PostgreSQL, expression of the GIN index is used as is in search queries
+EVENT_SEARCH_VECTOR = "to_tsvector('simple', coalesce(title, '') || ' ' || coalesce(description, '') || ' ' || coalesce(location, ''))"
+EVENT_SEARCH_INDEX_DDL = "CREATE INDEX IF NOT EXISTS ix_event_search ON event USING gin (({}))".format(EVENT_SEARCH_VECTOR)
+
+# columns added to the models after tables were first created, create_all doesn't add them to existing tables
+ADDED_COLUMNS = [
+    ("event", "version", "INTEGER NOT NULL DEFAULT 1"),
+    ("user", "version", "INTEGER NOT NULL DEFAULT 1"),
+]
+
+
+def missing_columns(engine):
+    """return (table, column, type) of ADDED_COLUMNS which existing tables don't have"""
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    columns = {table: {column["name"] for column in inspector.get_columns(table)} for table in tables}
+    return [added for added in ADDED_COLUMNS if added[0] in tables and added[1] not in columns[added[0]]]
+
+
+# columns made longer after tables were first created, (table, column, length)
+WIDENED_COLUMNS = [
+    ("event", "creator_token", TOKEN_HASH_LENGTH),
+    ("user", "user_token", TOKEN_HASH_LENGTH),
+]
+
+
+def narrow_columns(engine):
+    """return (table, column, length) of WIDENED_COLUMNS which are shorter in existing tables,
+    SQLite doesn't limit the length of strings so they are only altered in PostgreSQL"""
+    if engine.dialect.name != "postgresql":
+        return []
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    lengths = {(table, column["name"]): getattr(column["type"], "length", None) for table in tables for column in inspector.get_columns(table)}
+    return [widened for widened in WIDENED_COLUMNS if (lengths.get(widened[:2]) or widened[2]) < widened[2]]
+
+
+def missing_indexes(engine):
+    """return indexes of the models which existing tables don't have, create_all only creates indexes of new tables"""
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in (Event.__table__, User.__table__):
+        if table.name in tables:
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            missing.extend(index for index in table.indexes if index.name not in existing)
+    return missing
+
+
+def rename_duplicate_user_names(connection):
+    """rename attendees whose username is already used in their event before the unique index is created,
+    older versions checked usernames only in the app, the first attendee keeps the name and others get their identifier appended"""
+    table = User.__table__
+    duplicates = connection.execute(db.select([table.c.event_id, table.c.user_name])
+                                    .where(table.c.event_id.isnot(None))
+                                    .group_by(table.c.event_id, table.c.user_name)
+                                    .having(db.func.count() > 1)).fetchall()
+    for event_id, name in duplicates:
+        rows = connection.execute(db.select([table.c.id, table.c.user_identifier])
+                                  .where(db.and_(table.c.event_id == event_id, table.c.user_name == name))
+                                  .order_by(table.c.id)).fetchall()
+        for row_id, identifier in rows[1:]:
+            new_name = "{}-{}".format(name[:table.c.user_name.type.length - len(identifier) - 1], identifier)
+            connection.execute(table.update().where(table.c.id == row_id).values(user_name=new_name, version=table.c.version + 1))
+            logger.warning("init_db(): username %r of attendee %s is already used in the event, renamed to %r", name, identifier, new_name)
+
+
+# PRAGMA user_version of SQLite databases whose event times are stored in UTC,
+# older versions stored the times of requests without their offsets
+SQLITE_UTC_TIMES_VERSION = 1
+
+
+def init_db():
+    """create missing tables, columns, indexes and the search index, safe to run again on an existing database"""
+    engine = db.get_engine()
+    fts_missing = False
+    new_database = False
+    if engine.dialect.name == "sqlite":
+        fts_missing = not engine.has_table("event_fts")
+        new_database = not engine.has_table("event")
+    added_columns = missing_columns(engine)
+    widened_columns = narrow_columns(engine)
+    added_indexes = missing_indexes(engine)
+    db.create_all()
+    with engine.begin() as connection:
+        # rows of older versions start from version 1
+        quote = engine.dialect.identifier_preparer.quote
+        for table, column, column_type in added_columns:
+            connection.execute("ALTER TABLE {} ADD COLUMN {} {}".format(quote(table), quote(column), column_type))
+        for table, column, length in widened_columns:
+            connection.execute("ALTER TABLE {} ALTER COLUMN {} TYPE VARCHAR({})".format(quote(table), quote(column), length))
+        for index in added_indexes:
+            if index.name == "ix_user_event_user_name":
+                rename_duplicate_user_names(connection)
+            index.create(connection)
+        if fts_missing:
+            # event table may have existed before the search index, so create and fill the index from it
+            for statement in EVENT_FTS_DDL:
+                connection.execute(statement)
+            connection.execute("INSERT INTO event_fts(event_fts) VALUES ('rebuild')")
+        if engine.dialect.name == "postgresql":
+            connection.execute(EVENT_SEARCH_INDEX_DDL)
+        if new_database:
+            # times of new databases are in UTC from the start, there is nothing to convert
+            connection.execute("PRAGMA user_version = {}".format(SQLITE_UTC_TIMES_VERSION))
+
+
+def convert_local_times(offset=None):
+    """convert event times stored by older versions without offset to UTC, once per SQLite database,
+    stored times are taken to be in the local time zone of the server or at the given UTC offset (timedelta),
+    returns number of converted events or None if the times are already in UTC"""
+    engine = db.get_engine()
+    if engine.dialect.name != "sqlite":
+        # PostgreSQL has stored times with time zone from the start
+        return None
+    table = Event.__table__
+    with engine.begin() as connection:
+        if connection.execute("PRAGMA user_version").scalar() >= SQLITE_UTC_TIMES_VERSION:
+            return None
+        rows = []
+        for row_id, time in connection.execute(db.select([table.c.id, table.c.time])):
+            # UTCDateTime reads the stored time as UTC, naive datetimes are converted from the local time zone
+            local = time.replace(tzinfo=None if offset is None else datetime.timezone(offset))
+            rows.append({"row_id": row_id, "utc_time": local.astimezone(datetime.timezone.utc)})
+        if rows:
+            connection.execute(table.update().where(table.c.id == db.bindparam("row_id")).values(
+                # times of the representations change, so do their ETags
+                time=db.bindparam("utc_time", type_=table.c.time.type), version=table.c.version + 1), rows)
+        connection.execute("PRAGMA user_version = {}".format(SQLITE_UTC_TIMES_VERSION))
+    return len(rows)
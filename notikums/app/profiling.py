@@ -0,0 +1,97 @@
+"""on-demand cProfile profiling of single requests, triggered by the admin secret in X-Profile header
+or by a sampling rate, profiles are written to files which can be read with pstats or e.g. snakeviz"""
+import cProfile, functools, hmac, io, logging, os, pstats, random, time, uuid
+from flask import Response, request
+
+PROFILE_HEADER = "X-Profile"
+# with the secret, "X-Profile-Output: text" responds with the profile instead of the response of the request
+OUTPUT_HEADER = "X-Profile-Output"
+TEXT_LINES = 60
+
+# settings can be given in app config or overridden with NOTIKUMS_<KEY> environment variables
+DEFAULTS = {
+    "PROFILE_SECRET": None,  # header trigger is disabled without a secret
+    "PROFILE_SAMPLE_RATE": 0.0,
+    "PROFILE_DIR": "profiles",
+    "PROFILE_MAX_FILES": 100,  # oldest profiles are deleted when there are more, so sampling can't fill the disk
+}
+
+logger = logging.getLogger("notikums.profiling")
+
+
+def get_settings(config):
+    """return profiling settings from config and environment"""
+    return {key: os.environ.get("NOTIKUMS_" + key, config.get(key, default)) for key, default in DEFAULTS.items()}
+
+
+class RequestProfiler:
+    """profiles resource views of requests with the secret or sampled requests,
+    resource views are only wrapped if profiling is enabled"""
+
+    def __init__(self, secret=None, sample_rate=0.0, directory="profiles", max_files=100):
+        self.secret = secret.encode() if secret else None
+        self.sample_rate = float(sample_rate)
+        self.directory = directory
+        self.max_files = int(max_files)
+
+    @classmethod
+    def from_config(cls, config):
+        settings = get_settings(config)
+        return cls(settings["PROFILE_SECRET"], settings["PROFILE_SAMPLE_RATE"], settings["PROFILE_DIR"], settings["PROFILE_MAX_FILES"])
+
+    @property
+    def enabled(self):
+        return self.secret is not None or self.sample_rate > 0
+
+    def is_admin_request(self):
+        token = request.headers.get(PROFILE_HEADER)
+        return bool(token and self.secret and hmac.compare_digest(token.encode(), self.secret))
+
+    def instrument(self, view):
+        """decorator for resource views, profiles validation, queries and serialization of the request"""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            admin = self.is_admin_request()
+            if not admin and not (self.sample_rate > 0 and random.random() < self.sample_rate):
+                return view(*args, **kwargs)
+            profiler = cProfile.Profile()
+            try:
+                response = profiler.runcall(view, *args, **kwargs)
+            finally:
+                path = self.dump(profiler)
+            # only requests with the secret learn about the profile
+            if admin:
+                if request.headers.get(OUTPUT_HEADER) == "text":
+                    return Response(stats_text(profiler), content_type="text/plain; charset=utf-8")
+                response.headers["X-Profile-File"] = os.path.basename(path)
+            return response
+        return wrapper
+
+    def dump(self, profiler):
+        """write profile to a file named by time, method and route of the request and return its path"""
+        os.makedirs(self.directory, exist_ok=True)
+        route = "".join(c if c.isalnum() else "_" for c in request.url_rule.rule).strip("_") or "root"
+        name = "{}-{}-{}-{}.prof".format(time.strftime("%Y%m%dT%H%M%S"), request.method, route, uuid.uuid4().hex[:8])
+        path = os.path.join(self.directory, name)
+        profiler.dump_stats(path)
+        logger.info("profile of %s %s written to %s", request.method, request.path, path)
+        self.remove_old_profiles()
+        return path
+
+    def remove_old_profiles(self):
+        """delete oldest profiles so that at most max_files are kept"""
+        # names start with the time of the request, so they sort from the oldest
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".prof"))
+        for name in names[:max(len(names) - self.max_files, 0)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # removed by another request at the same time
+                pass
+
+
+def stats_text(profiler):
+    """return functions of profile sorted by cumulative time as text"""
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(TEXT_LINES)
+    return stream.getvalue()
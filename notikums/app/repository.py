@@ -0,0 +1,604 @@
+"""storage of events and attendees behind one interface, kept in the database with SQLAlchemy or in memory
+records returned by a repository have the columns of the models as attributes and must only be modified
+through the repository, times are timezone-aware datetimes in UTC"""
+import abc, bisect, functools, re, threading
+from types import SimpleNamespace
+from sqlalchemy.exc import DataError, IntegrityError, OperationalError
+from sqlalchemy.ext import baked
+from sqlalchemy.orm.exc import StaleDataError
+from models import db, Event, User, event_fts, init_db, convert_local_times, to_utc, EVENT_SEARCH_VECTOR
+from tokens import is_token_hash
+
+
+class StorageError(Exception):
+    """storage failed, handled as a general error"""
+
+
+class ConflictError(StorageError):
+    """write conflicts with existing data, e.g. identifier or username is already in use"""
+
+
+class IdentifierConflictError(ConflictError):
+    """generated identifier is already in use, the write can be retried with a new identifier"""
+
+
+class ConcurrentUpdateError(StorageError):
+    """row was modified or deleted by another request after it was read"""
+
+
+class NotFoundError(StorageError):
+    """row referenced by the write does not exist, e.g. event was deleted after it was read"""
+
+
+class Repository(abc.ABC):
+    """interface of event and attendee storage, backends must implement every method"""
+
+    @abc.abstractmethod
+    def init_schema(self):
+        """create missing tables, safe to call again"""
+
+    # events
+    @abc.abstractmethod
+    def get_event(self, identifier):
+        """return event by identifier or None"""
+
+    @abc.abstractmethod
+    def get_event_version(self, identifier):
+        """return version of event or None, without loading the other columns"""
+
+    @abc.abstractmethod
+    def get_event_with_attendees(self, identifier, load_attendees=True):
+        """return (event, attendee count, list of attendees) or None, the related data is read with the event in one query,
+        attendees are None and only counted unless load_attendees"""
+
+    @abc.abstractmethod
+    def list_events(self, time_from=None, time_to=None, after=None, limit=None, columns=None):
+        """return list of events ordered by time and id, optionally within time range,
+        after is (time, id) of the last event of the previous page,
+        with columns only those are read from storage, the returned records may lack the other columns except id and time"""
+
+    @abc.abstractmethod
+    def iter_events(self, time_from=None, time_to=None, batch_size=500, columns=None):
+        """return iterable of all events in time range ordered by time and id, read in batches"""
+
+    @abc.abstractmethod
+    def search_events(self, text, limit, offset=0, columns=None):
+        """return list of events which contain all terms of text in title, description or location,
+        best matches first"""
+
+    @abc.abstractmethod
+    def add_event(self, info):
+        """insert event from dict of column values and return it"""
+
+    @abc.abstractmethod
+    def add_events(self, rows):
+        """insert events from dicts of column values in one transaction, none are inserted on conflict"""
+
+    @abc.abstractmethod
+    def event_ids(self, identifiers):
+        """return dict of primary keys of the existing events by identifier"""
+
+    @abc.abstractmethod
+    def update_event(self, event, changes):
+        """set columns of event from dict and return it"""
+
+    @abc.abstractmethod
+    def delete_event(self, event):
+        """delete event and its attendees"""
+
+    # attendees
+    @abc.abstractmethod
+    def get_attendee(self, identifier):
+        """return attendee by user identifier or None"""
+
+    @abc.abstractmethod
+    def list_attendees(self, event_pk, columns=None):
+        """return list of attendees of event, with columns only those and id are read like in list_events"""
+
+    @abc.abstractmethod
+    def taken_user_names(self, event_pk, names):
+        """return set of given usernames which are already in use in event"""
+
+    @abc.abstractmethod
+    def add_attendee(self, event_pk, info):
+        """insert attendee of event from dict of column values and return it"""
+
+    @abc.abstractmethod
+    def add_attendees(self, event_pk, rows):
+        """insert attendees of event in one transaction, none are inserted on conflict"""
+
+    @abc.abstractmethod
+    def add_attendees_of_events(self, rows):
+        """insert attendees of several events from dicts of column values with event_id in one transaction,
+        none are inserted on conflict"""
+
+    @abc.abstractmethod
+    def update_attendee(self, attendee, changes):
+        """set columns of attendee from dict and return it"""
+
+    @abc.abstractmethod
+    def delete_attendee(self, attendee):
+        """delete attendee"""
+
+    # tokens
+    @abc.abstractmethod
+    def hash_plaintext_tokens(self, hash_token):
+        """replace creator and user tokens stored in plaintext with hash_token(token), returns number of replaced tokens"""
+
+    @abc.abstractmethod
+    def convert_local_times(self, offset=None):
+        """convert event times stored without offset by older versions to UTC once, in the local time zone of the server
+        or at UTC offset (timedelta), returns number of converted events or None if times are already in UTC"""
+
+
+def translate_errors(method):
+    """roll back session and raise storage errors instead of SQLAlchemy errors"""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except IntegrityError as err:
+            db.session.rollback()
+            raise integrity_error(err) from err
+        except StaleDataError as err:
+            db.session.rollback()
+            raise ConcurrentUpdateError(str(err)) from err
+        except (DataError, OperationalError) as err:
+            db.session.rollback()
+            raise StorageError(str(err.orig)) from err
+    return wrapper
+
+
+# unique constraints of the generated identifiers, named in SQLite and PostgreSQL messages
+IDENTIFIER_CONSTRAINT = re.compile(r"\b(?:user\.user_identifier|event\.identifier|user_user_identifier_key|event_identifier_key)\b")
+
+
+def integrity_error(err):
+    """return storage error for IntegrityError, only unique violations are conflicts and
+    foreign key violations mean that the referenced row is gone, SQLite reports them only in the message"""
+    code = getattr(err.orig, "pgcode", None)
+    message = str(err.orig)
+    if code == "23505" or message.startswith("UNIQUE constraint failed"):
+        return IdentifierConflictError(message) if IDENTIFIER_CONSTRAINT.search(message) else ConflictError(message)
+    if code == "23503" or message.startswith("FOREIGN KEY constraint failed"):
+        return NotFoundError(message)
+    return StorageError(message)
+
+
+def select_columns(query, model, columns, *required):
+    """return query of rows with only the primary key and given and required columns as attributes instead of model instances,
+    constructing instances costs more than reading the columns, all columns are loaded if columns is empty"""
+    if not columns:
+        return query
+    names = dict.fromkeys(("id",) + tuple(required) + tuple(columns))
+    return query.with_entities(*(getattr(model, name) for name in names))
+
+
+def fts_match_expression(text):
+    """quote each search term so that user input is not parsed as FTS5 query syntax, terms are AND'ed"""
+    return " ".join('"{}"'.format(term.replace('"', '""')) for term in text.split())
+
+
+class SQLAlchemyRepository(Repository):
+    """events and attendees in the database of the app, every write is committed in the session of the request"""
+
+    # compiled statements of baked queries are cached, building the eager loading query takes longer than running it
+    bakery = baked.bakery()
+
+    def init_schema(self):
+        init_db()
+
+    def event_query(self, time_from=None, time_to=None, columns=None):
+        """return query of events ordered by time, time ranges are scanned with the (time, id) index"""
+        # time is loaded for the cursors of the pages
+        query = select_columns(Event.query, Event, columns, "time").order_by(Event.time, Event.id)
+        if time_from is not None:
+            query = query.filter(Event.time >= time_from)
+        if time_to is not None:
+            query = query.filter(Event.time <= time_to)
+        return query
+
+    @translate_errors
+    def get_event(self, identifier):
+        return Event.query.filter_by(identifier=identifier).first()
+
+    @translate_errors
+    def get_event_version(self, identifier):
+        return db.session.query(Event.version).filter_by(identifier=identifier).scalar()
+
+    @translate_errors
+    def get_event_with_attendees(self, identifier, load_attendees=True):
+        if load_attendees:
+            # attendees are joined to the event row in the same SELECT
+            query = self.bakery(lambda session: session.query(Event).options(db.joinedload(Event.attendees)))
+        else:
+            # count of attendees as a correlated subquery of the event row, attendee rows are not read
+            query = self.bakery(lambda session: session.query(
+                Event, db.select([db.func.count(User.id)]).where(User.event_id == Event.id).as_scalar()))
+        # identifier is unique, so no LIMIT which would wrap the joined query in a subquery
+        query += lambda query: query.filter(Event.identifier == db.bindparam("identifier"))
+        result = query(db.session()).params(identifier=identifier).one_or_none()
+        if result is None:
+            return None
+        if load_attendees:
+            return result, len(result.attendees), list(result.attendees)
+        return result[0], result[1], None
+
+    @translate_errors
+    def list_events(self, time_from=None, time_to=None, after=None, limit=None, columns=None):
+        query = self.event_query(time_from, time_to, columns)
+        if after:
+            after_time, after_id = after
+            query = query.filter(db.or_(
+                Event.time > after_time,
+                db.and_(Event.time == after_time, Event.id > after_id)
+            ))
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    def iter_events(self, time_from=None, time_to=None, batch_size=500, columns=None):
+        # yield_per streams results, in PostgreSQL from a server-side cursor instead of loading all rows to the client
+        return self.event_query(time_from, time_to, columns).yield_per(batch_size)
+
+    @translate_errors
+    def search_events(self, text, limit, offset=0, columns=None):
+        if db.get_engine().dialect.name == "postgresql":
+            # each term is a phrase and terms are AND'ed like in the FTS5 query, the GIN index matches the vector expression
+            terms = {"term{}".format(i): term for i, term in enumerate(text.split())}
+            tsquery = " && ".join("phraseto_tsquery('simple', :{})".format(name) for name in terms)
+            query = (Event.query
+                .filter(db.text("{} @@ ({})".format(EVENT_SEARCH_VECTOR, tsquery)))
+                .params(**terms)
+                .order_by(db.text("ts_rank({}, {}) DESC".format(EVENT_SEARCH_VECTOR, tsquery)), Event.id))
+        else:
+            query = (Event.query
+                .join(event_fts, event_fts.c.rowid == Event.id)
+                .filter(db.text("event_fts MATCH :match"))
+                .params(match=fts_match_expression(text))
+                .order_by(event_fts.c.rank, Event.id))
+        return select_columns(query, Event, columns).limit(limit).offset(offset).all()
+
+    @translate_errors
+    def add_event(self, info):
+        # primary key is fetched with INSERT ... RETURNING in PostgreSQL, lastrowid in SQLite
+        event = Event(**info)
+        db.session.add(event)
+        db.session.commit()
+        return event
+
+    @translate_errors
+    def add_events(self, rows):
+        # rows are inserted with one executemany without the ORM, so version is set here
+        db.session.execute(Event.__table__.insert(), [dict(row, version=1) for row in rows])
+        db.session.commit()
+
+    @translate_errors
+    def event_ids(self, identifiers):
+        return dict(db.session.query(Event.identifier, Event.id).filter(Event.identifier.in_(identifiers)))
+
+    @translate_errors
+    def update_event(self, event, changes):
+        for key, value in changes.items():
+            setattr(event, key, value)
+        db.session.commit()
+        return event
+
+    @translate_errors
+    def delete_event(self, event):
+        # attendees are deleted by the foreign key
+        Event.query.filter_by(identifier=event.identifier).delete()
+        db.session.commit()
+
+    @translate_errors
+    def get_attendee(self, identifier):
+        return User.query.filter_by(user_identifier=identifier).first()
+
+    @translate_errors
+    def list_attendees(self, event_pk, columns=None):
+        return select_columns(User.query, User, columns).filter(User.event_id == event_pk).all()
+
+    @translate_errors
+    def taken_user_names(self, event_pk, names):
+        query = db.session.query(User.user_name).filter(User.event_id == event_pk, User.user_name.in_(names))
+        return {name for (name,) in query}
+
+    @translate_errors
+    def add_attendee(self, event_pk, info):
+        attendee = User(event_id=event_pk, **info)
+        db.session.add(attendee)
+        db.session.commit()
+        return attendee
+
+    @translate_errors
+    def add_attendees(self, event_pk, rows):
+        db.session.execute(User.__table__.insert(), [dict(row, event_id=event_pk, version=1) for row in rows])
+        db.session.commit()
+
+    @translate_errors
+    def add_attendees_of_events(self, rows):
+        db.session.execute(User.__table__.insert(), [dict(row, version=1) for row in rows])
+        db.session.commit()
+
+    @translate_errors
+    def update_attendee(self, attendee, changes):
+        for key, value in changes.items():
+            setattr(attendee, key, value)
+        db.session.commit()
+        return attendee
+
+    @translate_errors
+    def delete_attendee(self, attendee):
+        User.query.filter_by(user_identifier=attendee.user_identifier).delete()
+        db.session.commit()
+
+    @translate_errors
+    def hash_plaintext_tokens(self, hash_token):
+        count = 0
+        for table, column in ((Event.__table__, "creator_token"), (User.__table__, "user_token")):
+            rows = [{"row_id": row_id, "token": hash_token(token)}
+                    for row_id, token in db.session.execute(db.select([table.c.id, table.c[column]]))
+                    if not is_token_hash(token)]
+            if rows:
+                # version is not changed, tokens are not part of the representations
+                db.session.execute(table.update().where(table.c.id == db.bindparam("row_id")).values({column: db.bindparam("token")}), rows)
+            count += len(rows)
+        db.session.commit()
+        return count
+
+    @translate_errors
+    def convert_local_times(self, offset=None):
+        return convert_local_times(offset)
+
+
+EVENT_COLUMNS = tuple(column.name for column in Event.__table__.columns)
+USER_COLUMNS = tuple(column.name for column in User.__table__.columns)
+SEARCH_COLUMNS = ("title", "description", "location")
+
+def search_tokens(text):
+    """split text to lowercase words like the FTS5 unicode61 tokenizer"""
+    return re.findall(r"[^\W_]+", text.casefold()) if text else []
+
+def count_phrase(tokens, phrase):
+    """return number of times phrase (list of tokens) occurs in tokens"""
+    size = len(phrase)
+    return sum(1 for i in range(len(tokens) - size + 1) if tokens[i:i + size] == phrase)
+
+
+class MemoryRepository(Repository):
+    """events and attendees kept in dicts of this process, for tests and benchmarks without a database
+    events are indexed by identifier and by sorted (time, id) keys for range scans,
+    attendees by identifier and by event and username, all access is serialized with a lock"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._events = {}
+        self._events_by_id = {}
+        self._event_keys = []
+        self._event_tokens = {}
+        self._attendees = {}
+        self._attendees_by_event = {}
+        self._next_event_id = 1
+        self._next_attendee_id = 1
+
+    def init_schema(self):
+        pass
+
+    def _insert_event(self, info):
+        values = dict.fromkeys(EVENT_COLUMNS)
+        values.update(info, id=self._next_event_id, version=1)
+        # times are kept in UTC like in the database
+        values["time"] = to_utc(values["time"])
+        self._next_event_id += 1
+        event = SimpleNamespace(**values)
+        self._events[event.identifier] = event
+        self._events_by_id[event.id] = event
+        bisect.insort(self._event_keys, (event.time, event.id))
+        self._index_tokens(event)
+        self._attendees_by_event[event.id] = {}
+        return event
+
+    def _index_tokens(self, event):
+        self._event_tokens[event.id] = [search_tokens(getattr(event, column)) for column in SEARCH_COLUMNS]
+
+    def _remove_event_key(self, event):
+        index = bisect.bisect_left(self._event_keys, (event.time, event.id))
+        del self._event_keys[index]
+
+    def get_event(self, identifier):
+        with self._lock:
+            return self._events.get(identifier)
+
+    def get_event_with_attendees(self, identifier, load_attendees=True):
+        with self._lock:
+            event = self._events.get(identifier)
+            if event is None:
+                return None
+            attendees = self._attendees_by_event.get(event.id, {})
+            return event, len(attendees), (list(attendees.values()) if load_attendees else None)
+
+    def get_event_version(self, identifier):
+        with self._lock:
+            event = self._events.get(identifier)
+            return event.version if event else None
+
+    def list_events(self, time_from=None, time_to=None, after=None, limit=None, columns=None):
+        # records are in memory, so there is nothing to save by reading fewer columns
+        with self._lock:
+            time_from, time_to = to_utc(time_from), to_utc(time_to)
+            # (time,) sorts before all keys of that time and (time, inf) after them
+            start = 0 if time_from is None else bisect.bisect_left(self._event_keys, (time_from,))
+            if after:
+                start = max(start, bisect.bisect_right(self._event_keys, (to_utc(after[0]), after[1])))
+            end = len(self._event_keys) if time_to is None else bisect.bisect_right(self._event_keys, (time_to, float("inf")))
+            if limit is not None:
+                end = min(end, start + limit)
+            return [self._events_by_id[event_id] for time, event_id in self._event_keys[start:end]]
+
+    def iter_events(self, time_from=None, time_to=None, batch_size=500, columns=None):
+        return self.list_events(time_from, time_to)
+
+    def search_events(self, text, limit, offset=0, columns=None):
+        phrases = [search_tokens(term) for term in text.split()]
+        if not all(phrases):
+            return []
+        with self._lock:
+            # matches are ranked by number of occurrences of the terms, the FTS5 backend ranks with bm25
+            scored = []
+            for event_id, columns in self._event_tokens.items():
+                score = 0
+                for phrase in phrases:
+                    count = sum(count_phrase(tokens, phrase) for tokens in columns)
+                    if not count:
+                        break
+                    score += count
+                else:
+                    scored.append((-score, event_id))
+            scored.sort()
+            return [self._events_by_id[event_id] for score, event_id in scored[offset:offset + limit]]
+
+    def add_event(self, info):
+        with self._lock:
+            if info["identifier"] in self._events:
+                raise IdentifierConflictError("identifier is in use")
+            return self._insert_event(info)
+
+    def add_events(self, rows):
+        with self._lock:
+            identifiers = [row["identifier"] for row in rows]
+            if len(set(identifiers)) < len(identifiers) or any(identifier in self._events for identifier in identifiers):
+                raise IdentifierConflictError("identifier is in use")
+            for row in rows:
+                self._insert_event(row)
+
+    def event_ids(self, identifiers):
+        with self._lock:
+            return {identifier: self._events[identifier].id for identifier in identifiers if identifier in self._events}
+
+    def update_event(self, event, changes):
+        with self._lock:
+            if self._events_by_id.get(event.id) is not event:
+                raise ConcurrentUpdateError("event was deleted")
+            if "time" in changes:
+                self._remove_event_key(event)
+                changes = dict(changes, time=to_utc(changes["time"]))
+            for key, value in changes.items():
+                setattr(event, key, value)
+            if "time" in changes:
+                bisect.insort(self._event_keys, (event.time, event.id))
+            self._index_tokens(event)
+            event.version += 1
+            return event
+
+    def delete_event(self, event):
+        with self._lock:
+            if self._events_by_id.pop(event.id, None) is None:
+                return
+            del self._events[event.identifier]
+            del self._event_tokens[event.id]
+            self._remove_event_key(event)
+            for attendee in self._attendees_by_event.pop(event.id).values():
+                del self._attendees[attendee.user_identifier]
+
+    def get_attendee(self, identifier):
+        with self._lock:
+            return self._attendees.get(identifier)
+
+    def list_attendees(self, event_pk, columns=None):
+        with self._lock:
+            return list(self._attendees_by_event.get(event_pk, {}).values())
+
+    def taken_user_names(self, event_pk, names):
+        with self._lock:
+            return set(names) & self._attendees_by_event.get(event_pk, {}).keys()
+
+    def _check_attendees(self, event_pk, rows):
+        if event_pk not in self._attendees_by_event:
+            raise NotFoundError("event does not exist")
+        names = [row["user_name"] for row in rows]
+        identifiers = [row["user_identifier"] for row in rows]
+        if len(set(names)) < len(names) or self.taken_user_names(event_pk, names):
+            raise ConflictError("username is in use")
+        if len(set(identifiers)) < len(identifiers) or any(identifier in self._attendees for identifier in identifiers):
+            raise IdentifierConflictError("identifier is in use")
+
+    def _insert_attendee(self, event_pk, info):
+        values = dict.fromkeys(USER_COLUMNS)
+        values.update(info, id=self._next_attendee_id, event_id=event_pk, version=1)
+        self._next_attendee_id += 1
+        attendee = SimpleNamespace(**values)
+        self._attendees[attendee.user_identifier] = attendee
+        self._attendees_by_event[event_pk][attendee.user_name] = attendee
+        return attendee
+
+    def add_attendee(self, event_pk, info):
+        with self._lock:
+            self._check_attendees(event_pk, [info])
+            return self._insert_attendee(event_pk, info)
+
+    def add_attendees(self, event_pk, rows):
+        with self._lock:
+            self._check_attendees(event_pk, rows)
+            for row in rows:
+                self._insert_attendee(event_pk, row)
+
+    def add_attendees_of_events(self, rows):
+        with self._lock:
+            by_event = {}
+            for row in rows:
+                by_event.setdefault(row["event_id"], []).append(row)
+            for event_pk, event_rows in by_event.items():
+                self._check_attendees(event_pk, event_rows)
+            identifiers = [row["user_identifier"] for row in rows]
+            if len(set(identifiers)) < len(identifiers):
+                raise IdentifierConflictError("identifier is in use")
+            for row in rows:
+                self._insert_attendee(row["event_id"], row)
+
+    def update_attendee(self, attendee, changes):
+        with self._lock:
+            if self._attendees.get(attendee.user_identifier) is not attendee:
+                raise ConcurrentUpdateError("attendee was deleted")
+            by_name = self._attendees_by_event[attendee.event_id]
+            new_name = changes.get("user_name", attendee.user_name)
+            if new_name != attendee.user_name:
+                if new_name in by_name:
+                    raise ConflictError("username is in use")
+                del by_name[attendee.user_name]
+                by_name[new_name] = attendee
+            for key, value in changes.items():
+                setattr(attendee, key, value)
+            attendee.version += 1
+            return attendee
+
+    def delete_attendee(self, attendee):
+        with self._lock:
+            if self._attendees.pop(attendee.user_identifier, None) is not None:
+                del self._attendees_by_event[attendee.event_id][attendee.user_name]
+
+    def hash_plaintext_tokens(self, hash_token):
+        count = 0
+        with self._lock:
+            for rows, column in ((self._events.values(), "creator_token"), (self._attendees.values(), "user_token")):
+                for row in rows:
+                    if not is_token_hash(getattr(row, column)):
+                        setattr(row, column, hash_token(getattr(row, column)))
+                        count += 1
+        return count
+
+    def convert_local_times(self, offset=None):
+        # times are converted to UTC when events are added
+        return None
+
+
+# storage backends selectable with STORAGE_BACKEND in app config
+BACKENDS = {
+    "sqlalchemy": SQLAlchemyRepository,
+    "memory": MemoryRepository,
+}
+
+def create_repository(backend):
+    """create repository of given backend name, raises ValueError if backend is unknown"""
+    if backend not in BACKENDS:
+        raise ValueError("Unknown storage backend {!r}".format(backend))
+    return BACKENDS[backend]()
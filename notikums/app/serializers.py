@@ -0,0 +1,69 @@
+"""serialization of Event and User rows to API responses"""
+import json
+
+# orjson is optional, standard json is used if it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+# fields of the responses, named like the columns of the models
+EVENT_FIELDS = ("title", "identifier", "time", "location", "creator_name", "description", "image")
+USER_FIELDS = ("user_identifier", "user_name", "first_name", "last_name", "email", "phone")
+
+
+def format_time(value):
+    """format event time as used in requests and responses"""
+    return value.strftime(TIME_FORMAT)
+
+
+def select_fields(row, fields):
+    """return response dict of only the given fields, other columns of row are not read since they may not be loaded"""
+    return {field: format_time(row.time) if field == "time" else getattr(row, field) for field in fields}
+
+
+def event_to_dict(event, creator_token=None, fields=None):
+    """create response dict of event, creator_token is only given for the creator, only its hash is stored,
+    fields limits the response to the given fields"""
+    if fields:
+        data = select_fields(event, fields)
+    else:
+        data = {
+            "title": event.title,
+            "identifier": event.identifier,
+            "time": format_time(event.time),
+            "location": event.location,
+            "creator_name": event.creator_name,
+            "description": event.description,
+            "image": event.image
+        }
+    if creator_token:
+        data["creator_token"] = creator_token
+    return data
+
+
+def user_to_dict(user, user_token=None, fields=None):
+    """create response dict of attendee, user_token is only given for the attendee, only its hash is stored,
+    fields limits the response to the given fields"""
+    if fields:
+        data = select_fields(user, fields)
+    else:
+        data = {
+            "user_identifier": user.user_identifier,
+            "user_name": user.user_name,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "email": user.email,
+            "phone": user.phone
+        }
+    if user_token:
+        data["user_token"] = user_token
+    return data
+
+
+def dumps(data):
+    """encode data as JSON string, with orjson if available"""
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
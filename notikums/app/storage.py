@@ -0,0 +1,76 @@
+"""storage configuration, tunes SQLite and PostgreSQL connections and the connection pool from app config"""
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+# pragmas applied on every new SQLite connection, can be changed with SQLITE_PRAGMAS in app config
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # readers don't block writers and vice versa
+    "busy_timeout": 5000,  # milliseconds to wait for a lock instead of failing with "database is locked"
+    "synchronous": "NORMAL",  # safe with WAL, fsync only at checkpoints
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,  # negative value is in KiB
+    "foreign_keys": "ON",
+}
+
+
+def is_sqlite_file(sa_url):
+    return sa_url.drivername.startswith("sqlite") and sa_url.database not in (None, "", ":memory:")
+
+
+def is_postgresql(sa_url):
+    return sa_url.drivername.startswith("postgresql")
+
+
+class StorageSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension which applies storage settings of app config to the engine"""
+
+    def init_app(self, app):
+        app.config.setdefault("SQLITE_PRAGMAS", dict(SQLITE_PRAGMAS))
+        app.config.setdefault("SQLITE_POOL_SIZE", 5)
+        app.config.setdefault("SQLITE_MAX_OVERFLOW", 10)
+        app.config.setdefault("SQLITE_POOL_TIMEOUT", 30)
+        app.config.setdefault("POSTGRES_POOL_SIZE", 10)
+        app.config.setdefault("POSTGRES_MAX_OVERFLOW", 20)
+        app.config.setdefault("POSTGRES_POOL_TIMEOUT", 30)
+        app.config.setdefault("POSTGRES_POOL_RECYCLE", 1800)  # seconds, replaces connections dropped by the server or proxies
+        super().init_app(app)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        if is_sqlite_file(sa_url) and app.config["SQLITE_POOL_SIZE"]:
+            # keep connections open between requests so pragmas and page cache are not set up again,
+            # a connection is used by one thread at a time so it can be shared between threads,
+            # pool size 0 keeps the default of opening a new connection for every session
+            options["poolclass"] = QueuePool
+            options["pool_size"] = app.config["SQLITE_POOL_SIZE"]
+            options["max_overflow"] = app.config["SQLITE_MAX_OVERFLOW"]
+            options["pool_timeout"] = app.config["SQLITE_POOL_TIMEOUT"]
+            options.setdefault("connect_args", {})["check_same_thread"] = False
+        if is_postgresql(sa_url):
+            options["pool_size"] = app.config["POSTGRES_POOL_SIZE"]
+            options["max_overflow"] = app.config["POSTGRES_MAX_OVERFLOW"]
+            options["pool_timeout"] = app.config["POSTGRES_POOL_TIMEOUT"]
+            options["pool_recycle"] = app.config["POSTGRES_POOL_RECYCLE"]
+            options["pool_pre_ping"] = True
+            # executemany of bulk inserts is sent as multi-row INSERT ... VALUES instead of one statement per row
+            options["executemany_mode"] = "values"
+            # session time zone of UTC, timestamps with time zone are returned in UTC
+            options.setdefault("connect_args", {})["options"] = "-c timezone=UTC"
+        if sa_url.drivername.startswith("sqlite"):
+            # not an engine option, removed again in create_engine
+            options["sqlite_pragmas"] = app.config["SQLITE_PRAGMAS"]
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop("sqlite_pragmas", None)
+        engine = super().create_engine(sa_url, engine_opts)
+        if pragmas:
+            event.listen(engine, "connect", lambda dbapi_connection, connection_record: apply_pragmas(dbapi_connection, pragmas))
+        return engine
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute("PRAGMA {}={}".format(name, value))
+    cursor.close()
@@ -1,26 +1,21 @@
 import os
+import pstats
 import pytest
 import tempfile
 import app
-from unittest.mock import MagicMock
+from contextlib import contextmanager
+from urllib.parse import urlencode
 
-from app import User, Event
+from repository import EVENT_COLUMNS, USER_COLUMNS
 from datetime import datetime
-from sqlalchemy.engine import Engine
 from sqlalchemy import event
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import OperationalError
 
 @pytest.fixture
 def basic_setup():
     # put the re-occuring setups in here and use this with each test
     pass
 
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.close()
-
 # @pytest.fixture
 # def db_handle():
 #     db_fd, db_fname = tempfile.mkstemp()
@@ -39,6 +34,9 @@ test_events = []
 test_users = []
 EVENT_RESOURCE_URL = "/event"
 
+def event_search_url(text, **params):
+    return EVENT_RESOURCE_URL + "/search?" + urlencode(dict(q=text, **params))
+
 def event_url(event_id):
     return "/event/{}".format(event_id)
 
@@ -62,42 +60,71 @@ def event_time(event_id):
 
 def _populate_db():
     for i in range(1, 4):
-        event = Event(
-            title="test-event-{}".format(i),
-            time=datetime.utcnow(),
-            location="test-location{}".format(i),
-            creator_token="creator_token{}".format(i),
-            identifier="identifier{}".format(i)
-        )
-        user = User(
-            user_token="token{}".format(i),
-            user_name="user-name{}".format(i),
-            event=event,
-            event_id=event.identifier,
-            user_identifier="user-identifier-{}".format(i)
-        )
-        app.db.session.add(event)
-        app.db.session.add(user)
-        test_events.append(event.as_dict())
-        test_users.append(user.as_dict())
-    app.db.session.commit()
-
-
+        event_info = {
+            "title": "test-event-{}".format(i),
+            "time": datetime.utcnow(),
+            "location": "test-location{}".format(i),
+            "creator_token": app.token_hasher.hash("creator_token{}".format(i)),
+            "identifier": "event-{}".format(i)
+        }
+        user_info = {
+            "user_token": app.token_hasher.hash("token{}".format(i)),
+            "user_name": "user-name{}".format(i),
+            "user_identifier": "user-{}".format(i)
+        }
+        event = app.repository.add_event(event_info)
+        user = app.repository.add_attendee(event.id, user_info)
+        # tests authenticate with the tokens, the db has their hashes
+        test_events.append(dict({column: getattr(event, column) for column in EVENT_COLUMNS}, creator_token="creator_token{}".format(i)))
+        test_users.append(dict({column: getattr(user, column) for column in USER_COLUMNS}, user_token="token{}".format(i)))
+
+
+# PostgreSQL tests are run against a throwaway database given in this environment variable, tables are dropped after each test
+POSTGRES_URI = os.environ.get("NOTIKUMS_TEST_POSTGRES_URI")
+
+def _make_client(backend):
+    config = {"TESTING": True, "AUTO_INIT_DB": False, "STORAGE_BACKEND": "sqlalchemy"}
+    if backend == "sqlite":
+        db_fd, db_fname = tempfile.mkstemp()
+        config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
+    elif backend == "postgresql":
+        if not POSTGRES_URI:
+            pytest.skip("NOTIKUMS_TEST_POSTGRES_URI is not set")
+        config["SQLALCHEMY_DATABASE_URI"] = POSTGRES_URI
+    else:
+        config["STORAGE_BACKEND"] = backend
+    flask_app = app.create_app(config)
+
+    with flask_app.app_context():
+        app.repository.init_schema()
+        _populate_db()
+
+    yield flask_app.test_client()
+
+    if backend in ("sqlite", "postgresql"):
+        with flask_app.app_context():
+            app.db.session.remove()
+            if backend == "postgresql":
+                app.db.drop_all()
+            # close pooled connections so that WAL files can be removed too
+            app.db.get_engine().dispose()
+    if backend == "sqlite":
+        os.close(db_fd)
+        for fname in [db_fname, db_fname + "-wal", db_fname + "-shm"]:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+
+# API tests are run with each storage backend
+@pytest.fixture(scope="function", params=["sqlite", "postgresql", "memory"])
+def client(request):
+    yield from _make_client(request.param)
+
+
+# for tests of the SQLAlchemy backend with SQLite only
 @pytest.fixture(scope="function")
-def client():
-    db_fd, db_fname = tempfile.mkstemp()
-
-    app.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
-    app.app.config["TESTING"] = True
-
-    app.db.create_all()
-    _populate_db()
-
-    yield app.app.test_client()
-
-    app.db.session.remove()
-    os.close(db_fd)
-    os.unlink(db_fname)
+def sql_client():
+    yield from _make_client("sqlite")
 
 
 @pytest.fixture(scope="function")
@@ -105,10 +132,121 @@ def mock_general_error(mocker):
     # make queries etc. return KeyError which should be caught by all app methods and handled as 400
     # mocker.patch("app.db", side_effect=KeyError("mocked error"))
     mocker.patch("flask_sqlalchemy._QueryProperty.__get__", side_effect=KeyError("mocked error"))
+    # creating an event doesn't query anything, so make the commit fail too
+    mocker.patch.object(app.db.session, "commit", side_effect=OperationalError("mocked", None, "mocked error"))
     # mocker.patch("app.User", side_effect=KeyError("mocked error"))
 
 # tests
 
+def test_generate_token():
+    tokens = {app.generate_token(64) for i in range(100)}
+    assert len(tokens) == 100
+    for token in tokens:
+        assert len(token) == 64
+        assert set(token) <= set(app.TOKEN_ALPHABET)
+    assert len(app.generate_token(8)) == 8
+
+def test_init_db(tmp_path):
+    # schema is created on first request, or once with the init-db command
+    db_fname = str(tmp_path / "notikums.db")
+    flask_app = app.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname, "TESTING": True})
+    client = flask_app.test_client()
+    assert client.post(EVENT_RESOURCE_URL, json={"title": "eventti", "time": "2020-02-02T00:00:00+0200", "location": "Tellus"}).status_code == 201
+    assert client.get(event_search_url("eventti")).json[0]["title"] == "eventti"
+
+    flask_app = app.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname, "TESTING": True, "AUTO_INIT_DB": False})
+    result = flask_app.test_cli_runner().invoke(args=["init-db"])
+    assert result.exit_code == 0
+    assert flask_app.test_client().get(EVENT_RESOURCE_URL).json[0]["title"] == "eventti"
+    with flask_app.app_context():
+        app.db.get_engine().dispose()
+
+def test_tokens_are_hashed(client):
+    # only keyed hashes of the tokens are stored, the tokens work for authentication
+    created = client.post(EVENT_RESOURCE_URL, json={"title": "eventti", "time": "2020-02-02T00:00:00+0200", "location": "Tellus"}).json
+    joined = client.post(event_attendees_url(created["identifier"]), json={"user_name": "tester"}).json
+    with client.application.app_context():
+        event = app.repository.get_event(created["identifier"])
+        attendee = app.repository.get_attendee(joined["user_identifier"])
+        assert event.creator_token == app.token_hasher.hash(created["creator_token"])
+        assert attendee.user_token == app.token_hasher.hash(joined["user_token"])
+    url = event_specific_attendee_url(created["identifier"], joined["user_identifier"])
+    for token in [created["creator_token"], joined["user_token"]]:
+        assert client.get(url, headers={"Authorization": "Basic " + token}).status_code == 200
+    assert client.get(url, headers={"Authorization": "Basic " + event.creator_token}).status_code == 401
+    assert client.get(url).status_code == 401
+
+def test_hash_tokens_command(sql_client):
+    # tokens stored in plaintext by older versions are hashed once and keep working
+    flask_app = sql_client.application
+    with flask_app.app_context():
+        event = app.repository.add_event({"identifier": "event-p", "creator_token": "PLAINTOKEN", "title": "plain", "time": datetime.utcnow(), "location": "here"})
+        app.repository.add_attendee(event.id, {"user_identifier": "user-p", "user_token": "PLAINUSER", "user_name": "plain"})
+    result = flask_app.test_cli_runner().invoke(args=["hash-tokens"])
+    assert result.exit_code == 0
+    assert "Hashed 2 tokens" in result.output
+    assert flask_app.test_cli_runner().invoke(args=["hash-tokens"]).output.strip() == "Hashed 0 tokens"
+    with flask_app.app_context():
+        assert app.repository.get_event("event-p").creator_token == app.token_hasher.hash("PLAINTOKEN")
+    assert sql_client.get(event_specific_attendee_url("event-p", "user-p"), headers={"Authorization": "Basic PLAINUSER"}).status_code == 200
+
+def test_metrics(client):
+    client.get(event_url(test_events[0]["identifier"]))
+    client.get(event_url("nope"))
+    client.get(event_attendees_url(test_events[0]["identifier"]), headers={"Authorization": "Basic " + test_events[0]["creator_token"]})
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.content_type.startswith("text/plain")
+    lines = resp.get_data(as_text=True).splitlines()
+    assert 'notikums_requests_total{route="/event/<event_id>",method="GET",status="200"} 1' in lines
+    assert 'notikums_requests_total{route="/event/<event_id>",method="GET",status="404"} 1' in lines
+    assert 'notikums_request_duration_seconds_count{route="/event/<event_identifier>/attendees",method="GET"} 1' in lines
+    statements = [line for line in lines if line.startswith('notikums_sql_statements_total{route="/event/<event_identifier>/attendees"')]
+    assert len(statements) == 1
+    if client.application.config["STORAGE_BACKEND"] == "sqlalchemy":
+        assert int(statements[0].split()[-1]) > 0
+    # the attendee list found the event cached by the first request
+    assert "# TYPE notikums_cache_hits gauge" in lines
+    assert 'notikums_cache_hits{cache="event"} 1' in lines
+    assert 'notikums_cache_misses{cache="event"} 2' in lines
+    assert 'notikums_cache_size{cache="event"} 1' in lines
+
+def test_profile_request(tmp_path):
+    profile_dir = str(tmp_path / "profiles")
+    flask_app = app.create_app({"STORAGE_BACKEND": "memory", "TESTING": True, "PROFILE_SECRET": "admin-secret", "PROFILE_DIR": profile_dir})
+    client = flask_app.test_client()
+    result = client.post(EVENT_RESOURCE_URL, json={"title": "eventti", "time": "2020-02-02T00:00:00+0200", "location": "Tellus"})
+    # not profiled without the secret
+    assert "X-Profile-File" not in result.headers
+    assert not os.path.exists(profile_dir)
+    assert "X-Profile-File" not in client.get(EVENT_RESOURCE_URL, headers={"X-Profile": "wrong"}).headers
+
+    result = client.post(EVENT_RESOURCE_URL, json={"title": "eventti", "time": "2020-02-02T00:00:00+0200", "location": "Tellus"}, headers={"X-Profile": "admin-secret"})
+    assert result.status_code == 201
+    assert os.listdir(profile_dir) == [result.headers["X-Profile-File"]]
+    stats = pstats.Stats(os.path.join(profile_dir, result.headers["X-Profile-File"]))
+    assert any(name == "validate_json" for filename, line, name in stats.stats)
+
+    result = client.get(EVENT_RESOURCE_URL, headers={"X-Profile": "admin-secret", "X-Profile-Output": "text"})
+    assert result.content_type.startswith("text/plain")
+    assert "cumulative" in result.get_data(as_text=True)
+
+def test_profile_sampling(tmp_path):
+    profile_dir = str(tmp_path / "profiles")
+    flask_app = app.create_app({"STORAGE_BACKEND": "memory", "TESTING": True, "PROFILE_SAMPLE_RATE": 1.0, "PROFILE_DIR": profile_dir, "PROFILE_MAX_FILES": 3})
+    result = flask_app.test_client().get(EVENT_RESOURCE_URL)
+    assert result.status_code == 200
+    # sampled profiles are only written to files
+    assert "X-Profile-File" not in result.headers
+    assert len(os.listdir(profile_dir)) == 1
+    # the oldest profiles are removed
+    os.rename(os.path.join(profile_dir, os.listdir(profile_dir)[0]), os.path.join(profile_dir, "20000101T000000-oldest.prof"))
+    for i in range(4):
+        flask_app.test_client().get(EVENT_RESOURCE_URL)
+    names = os.listdir(profile_dir)
+    assert len(names) == 3
+    assert "20000101T000000-oldest.prof" not in names
+
 def test_get_root(client):
     resp = client.get("/")
     assert resp.status_code == 302
@@ -123,20 +261,227 @@ def test_get_event_collection_positive(client):
         assert "time" in item
         assert "location" in item
 
+def test_get_event_collection_paginated(client):
+    # walk all pages with limit of 1 and check every event is seen exactly once
+    seen = []
+    url = EVENT_RESOURCE_URL + "?limit=1"
+    while url:
+        resp = client.get(url)
+        assert resp.status_code == 200
+        assert len(resp.json) <= 1
+        seen.extend(item["identifier"] for item in resp.json)
+        url = None
+        if "Link" in resp.headers:
+            assert 'rel="next"' in resp.headers["Link"]
+            assert resp.headers["X-Next-Cursor"]
+            url = resp.headers["Link"].split(";")[0].strip("<>")
+    assert sorted(seen) == ["event-1", "event-2", "event-3"]
+
+def test_get_event_collection_paginated_negative(client):
+    assert client.get(EVENT_RESOURCE_URL + "?limit=0").status_code == 400
+    assert client.get(EVENT_RESOURCE_URL + "?limit=not-a-number").status_code == 400
+    assert client.get(EVENT_RESOURCE_URL + "?cursor=not-a-cursor").status_code == 400
+    # last page has no next link
+    resp = client.get(EVENT_RESOURCE_URL + "?limit=3")
+    assert len(resp.json) == 3
+    assert "Link" not in resp.headers
+
+def test_get_event_collection_time_filter(client):
+    for i, time in enumerate(["2030-01-01T10:00:00+0000", "2030-01-05T10:00:00+0000", "2030-02-01T10:00:00+0000"]):
+        client.post(EVENT_RESOURCE_URL, json={"title": "filtered-{}".format(i), "time": time, "location": "here"})
+    resp = client.get(EVENT_RESOURCE_URL + "?from=2030-01-01T00:00:00%2B0000&to=2030-01-31T00:00:00%2B0000")
+    assert resp.status_code == 200
+    assert [item["title"] for item in resp.json] == ["filtered-0", "filtered-1"]
+    # paging keeps the filters
+    resp = client.get(EVENT_RESOURCE_URL + "?from=2030-01-01T00:00:00+0000&limit=1")
+    assert [item["title"] for item in resp.json] == ["filtered-0"]
+    next_url = resp.headers["Link"].split(";")[0].strip("<>")
+    resp = client.get(next_url)
+    assert [item["title"] for item in resp.json] == ["filtered-1"]
+    # test events are created at the time of the test
+    resp = client.get(EVENT_RESOURCE_URL + "?upcoming=7")
+    assert resp.status_code == 200
+    assert "filtered-0" not in [item["title"] for item in resp.json]
+    resp = client.get(EVENT_RESOURCE_URL + "?upcoming=7&stream=1")
+    assert "filtered-0" not in [item["title"] for item in resp.json]
+
+def test_get_event_collection_time_filter_negative(client):
+    assert client.get(EVENT_RESOURCE_URL + "?from=yesterday").status_code == 400
+    assert client.get(EVENT_RESOURCE_URL + "?to=2030-01-01").status_code == 400
+    assert client.get(EVENT_RESOURCE_URL + "?upcoming=-1").status_code == 400
+    assert client.get(EVENT_RESOURCE_URL + "?upcoming=week").status_code == 400
+
+def test_get_event_collection_stream(client, monkeypatch):
+    # use small batches so the stream is written in several chunks
+    monkeypatch.setattr(app, "STREAM_BATCH_SIZE", 2)
+    resp = client.get(EVENT_RESOURCE_URL + "?stream=1")
+    assert resp.status_code == 200
+    assert resp.is_streamed
+    assert resp.mimetype == "application/json"
+    assert sorted(item["identifier"] for item in resp.json) == ["event-1", "event-2", "event-3"]
+
+def test_get_event_collection_fields(client):
+    resp = client.get(EVENT_RESOURCE_URL + "?fields=identifier,title,time")
+    assert resp.status_code == 200
+    assert [list(item) for item in resp.json] == [["identifier", "title", "time"]] * 3
+    assert resp.json[0]["title"] == "test-event-1"
+    # the fields are kept in the next page link
+    resp = client.get(EVENT_RESOURCE_URL + "?fields=identifier&limit=2")
+    next_url = resp.headers["Link"].split(";")[0].strip("<>")
+    assert client.get(next_url).json == [{"identifier": "event-3"}]
+    resp = client.get(EVENT_RESOURCE_URL + "?stream=1&fields=title")
+    assert sorted(item["title"] for item in resp.json) == ["test-event-1", "test-event-2", "test-event-3"]
+    assert all(list(item) == ["title"] for item in resp.json)
+
+    client.post(EVENT_RESOURCE_URL, json={"title": "Python meetup", "time": "2030-01-01T10:00:00+0000", "location": "Oulu"})
+    assert client.get(event_search_url("python", fields="title,location")).json == [{"title": "Python meetup", "location": "Oulu"}]
+
+    for url in [EVENT_RESOURCE_URL + "?fields=identifier,creator_token", EVENT_RESOURCE_URL + "?fields=",
+                EVENT_RESOURCE_URL + "?fields=id", event_search_url("python", fields="user_name")]:
+        assert client.get(url).status_code == 400
+
+def test_search_events(client):
+    client.post(EVENT_RESOURCE_URL, json={"title": "Python meetup", "time": "2030-01-01T10:00:00+0000", "location": "Oulu", "description": "talks about python"})
+    client.post(EVENT_RESOURCE_URL, json={"title": "Board games", "time": "2030-01-02T10:00:00+0000", "location": "Oulu library", "description": "bring a python if you want"})
+    resp = client.get(event_search_url("python"))
+    assert resp.status_code == 200
+    # more matches ranks higher
+    assert [item["title"] for item in resp.json] == ["Python meetup", "Board games"]
+    assert [item["title"] for item in client.get(event_search_url("oulu library")).json] == ["Board games"]
+    # paging
+    resp = client.get(event_search_url("python", limit=1))
+    assert len(resp.json) == 1
+    next_url = resp.headers["Link"].split(";")[0].strip("<>")
+    assert [item["title"] for item in client.get(next_url).json] == ["Board games"]
+    # FTS5 query syntax in search text is treated as plain text
+    assert client.get(event_search_url('"python* OR -')).status_code == 200
+
+def test_search_events_sync(client):
+    creator_token = test_events[0].get("creator_token")
+    client.put(event_url("event-1"), json={"title": "renamed event"}, headers={"Authorization": "Basic " + creator_token})
+    assert [item["identifier"] for item in client.get(event_search_url("renamed")).json] == ["event-1"]
+    assert client.get(event_search_url("test-event-1")).json == []
+    client.delete(event_url("event-1"), headers={"Authorization": "Basic " + creator_token})
+    assert client.get(event_search_url("renamed")).json == []
+
+def test_search_events_negative(client):
+    assert client.get(EVENT_RESOURCE_URL + "/search").status_code == 400
+    assert client.get(event_search_url("  ")).status_code == 400
+    assert client.get(event_search_url("python", offset=-1)).status_code == 400
+
 def test_get_event_positive(client):
-    resp = client.get(event_url("identifier1"))
+    resp = client.get(event_url("event-1"))
     assert resp.status_code == 200
     assert "identifier" in resp.json
     assert "title" in resp.json
     assert "time" in resp.json
     assert "location" in resp.json
 
+def test_get_event_etag(client):
+    for url in [event_url("event-1"), event_time("event-1"), event_location("event-1"),
+                event_description("event-1"), event_image("event-1")]:
+        resp = client.get(url)
+        etag = resp.headers["ETag"]
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.data == b""
+        assert resp.headers["ETag"] == etag
+        # If-None-Match uses the weak comparison
+        assert client.get(url, headers={"If-None-Match": "W/" + etag}).status_code == 304
+        assert client.get(url, headers={"If-None-Match": '"something-else"'}).status_code == 200
+
+    # updating the event changes the ETag
+    etag = client.get(event_url("event-1")).headers["ETag"]
+    client.put(
+        event_url("event-1"),
+        json={"title": "new-title"},
+        headers={"Authorization": "Basic " + test_events[0].get("creator_token")}
+    )
+    resp = client.get(event_url("event-1"), headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+    assert client.get(event_url("wrong_identifier"), headers={"If-None-Match": etag}).status_code == 404
+
+def test_get_event_cache(client):
+    client.get(event_url("event-1"))
+    client.get(event_time("event-1"))
+    stats = client.application.extensions["notikums_event_cache"].stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 1
+    # a conditional request of an uncached event is one miss
+    client.get(event_url("event-2"), headers={"If-None-Match": '"something-else"'})
+    stats = client.application.extensions["notikums_event_cache"].stats()
+    assert stats["misses"] == 2
+    assert stats["hits"] == 2
+    # modifying the event invalidates the cached snapshot
+    client.post(
+        event_image("event-1"),
+        json={"image": "http://newimagelocation.org"},
+        headers={"Authorization": "Basic " + test_events[0].get("creator_token")}
+    )
+    assert client.get(event_image("event-1")).json["image"] == "http://newimagelocation.org"
+    client.delete(event_url("event-1"), headers={"Authorization": "Basic " + test_events[0].get("creator_token")})
+    assert client.get(event_url("event-1")).status_code == 404
+
+def test_event_cache_per_app():
+    # apps with separate storages have separate caches although the identifiers are the same
+    clients = []
+    for title in ["first", "second"]:
+        flask_app = app.create_app({"TESTING": True, "STORAGE_BACKEND": "memory"})
+        with flask_app.app_context():
+            app.repository.add_event({"identifier": "event-1", "creator_token": "token", "title": title, "time": datetime.utcnow(), "location": "here"})
+        clients.append(flask_app.test_client())
+    assert [client.get(event_url("event-1")).json["title"] for client in clients] == ["first", "second"]
+
 def test_get_event_negative(client):
     resp = client.get(event_url("wrong_identifier"))
     assert resp.status_code == 404
 
+def test_get_event_expand(client):
+    # attendee count is public
+    resp = client.get(event_url("event-1") + "?expand=attendee_count")
+    assert resp.status_code == 200
+    assert resp.json["attendee_count"] == 1
+    assert resp.json["title"] == "test-event-1"
+    assert "attendees" not in resp.json
+    assert "ETag" not in resp.headers
+
+    # attendees need the creator token
+    url = event_url("event-1") + "?expand=attendees,attendee_count"
+    assert client.get(url).status_code == 401
+    assert client.get(url, headers={"Authorization": "Basic " + test_users[0]["user_token"]}).status_code == 401
+    resp = client.get(url, headers={"Authorization": "Basic " + test_events[0]["creator_token"]})
+    assert resp.status_code == 200
+    assert resp.json["attendee_count"] == 1
+    assert [attendee["user_identifier"] for attendee in resp.json["attendees"]] == [test_users[0]["user_identifier"]]
+    assert "user_token" not in resp.json["attendees"][0]
+
+    # new attendee shows up although the event itself didn't change
+    client.post(event_attendees_url("event-1"), json={"user_name": "expanded"})
+    assert client.get(event_url("event-1") + "?expand=attendee_count").json["attendee_count"] == 2
+
+def test_get_event_fields(client):
+    resp = client.get(event_url("event-1") + "?fields=title,time")
+    assert resp.status_code == 200
+    assert list(resp.json) == ["title", "time"]
+    assert client.get(event_url("event-1") + "?fields=title,title").json == {"title": "test-event-1"}
+    # same version of the event, so conditional requests work with fields too
+    resp = client.get(event_url("event-1") + "?fields=title", headers={"If-None-Match": resp.headers["ETag"]})
+    assert resp.status_code == 304
+    resp = client.get(event_url("event-1") + "?fields=identifier&expand=attendee_count")
+    assert resp.json == {"identifier": "event-1", "attendee_count": 1}
+    assert client.get(event_url("event-1") + "?fields=creator_token").status_code == 400
+    assert client.get(event_url("wrong_identifier") + "?fields=title").status_code == 404
+
+def test_get_event_expand_negative(client):
+    assert client.get(event_url("event-1") + "?expand=comments").status_code == 400
+    assert client.get(event_url("event-1") + "?expand=attendee_count,comments").status_code == 400
+    assert client.get(event_url("wrong_identifier") + "?expand=attendee_count").status_code == 404
+    headers = {"Authorization": "Basic " + test_events[0]["creator_token"]}
+    assert client.get(event_url("wrong_identifier") + "?expand=attendees", headers=headers).status_code == 404
+
 def test_get_event_image_positive(client):
-    resp = client.get(event_image("identifier1"))
+    resp = client.get(event_image("event-1"))
     assert resp.status_code == 200
     assert len(resp.json) == 1
     assert "image" in resp.json
@@ -146,7 +491,7 @@ def test_get_event_image_negative(client):
     assert resp.status_code == 404
 
 def test_get_event_desc_positive(client):
-    resp = client.get(event_description("identifier1"))
+    resp = client.get(event_description("event-1"))
     assert resp.status_code == 200
     assert len(resp.json) == 1
     assert "description" in resp.json
@@ -156,7 +501,7 @@ def test_get_event_desc_negative(client):
     assert resp.status_code == 404
 
 def test_get_event_location_positive(client):
-    resp = client.get(event_location("identifier1"))
+    resp = client.get(event_location("event-1"))
     assert resp.status_code == 200
     assert len(resp.json) == 1
     assert "location" in resp.json
@@ -166,7 +511,7 @@ def test_get_event_location_negative(client):
     assert resp.status_code == 404
 
 def test_get_event_time_positive(client):
-    resp = client.get(event_time("identifier1"))
+    resp = client.get(event_time("event-1"))
     assert resp.status_code == 200
     assert len(resp.json) == 1
     assert "time" in resp.json
@@ -193,6 +538,74 @@ def test_create_event_positive(client):
     for assumed in ["creator_token", "identifier", "title"]:
         assert assumed in result.json
 
+@contextmanager
+def count_statements(client):
+    """collect types of SQL statements executed on the engine while in the with block"""
+    statements = []
+    engine = app.db.get_engine(client.application)
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split()[0].upper())
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+def test_create_statements(sql_client):
+    client = sql_client
+    # each create is exactly one INSERT and no SELECT, event of the attendee is cached by the first GET
+    with count_statements(client) as statements:
+        result = client.post(EVENT_RESOURCE_URL, json={"title": "eventti", "time": "2020-02-02T00:00:00+0200", "location": "Tellus"})
+    assert result.status_code == 201
+    # times are returned in UTC
+    assert result.json["time"] == "2020-02-01T22:00:00+0000"
+    assert statements == ["INSERT"]
+
+    client.get(event_url(test_events[0]["identifier"]))
+    with count_statements(client) as statements:
+        result = client.post(event_attendees_url(test_events[0]["identifier"]), json={"user_name": "counted"})
+    assert result.status_code == 201
+    assert statements == ["INSERT"]
+
+    with count_statements(client) as statements:
+        result = client.post(
+            event_image(test_events[1]["identifier"]),
+            json={"image": "http://newimagelocation.org"},
+            headers={"Authorization": "Basic " + test_events[1]["creator_token"]}
+        )
+    assert result.status_code == 201
+    assert statements == ["SELECT", "UPDATE"]
+
+def test_expand_statements(sql_client):
+    client = sql_client
+    client.post(event_attendees_url("event-1"), json={"user_name": "expanded"})
+    headers = {"Authorization": "Basic " + test_events[0]["creator_token"]}
+    # event and its attendees or their count are read in one SELECT
+    for expand in ["attendees", "attendee_count", "attendees,attendee_count"]:
+        with count_statements(client) as statements:
+            resp = client.get(event_url("event-1") + "?expand=" + expand, headers=headers)
+        assert resp.status_code == 200
+        assert statements == ["SELECT"]
+    assert resp.json["attendee_count"] == len(resp.json["attendees"]) == 2
+
+def test_fields_statements(sql_client):
+    client = sql_client
+    statements = []
+    engine = app.db.get_engine(client.application)
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        client.get(EVENT_RESOURCE_URL + "?fields=identifier,title")
+        client.get(event_attendees_url("event-1") + "?fields=user_name", headers={"Authorization": "Basic " + test_events[0]["creator_token"]})
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    # only the requested columns, the key and the time of the cursor are selected
+    event_select, snapshot_select, attendee_select = statements
+    assert "event.title" in event_select and "event.time" in event_select
+    assert "event.description" not in event_select and "event.image" not in event_select
+    assert "user.user_name" in attendee_select and "user.email" not in attendee_select
+
 def test_create_event_negative(client):
     result = client.post(
         EVENT_RESOURCE_URL,
@@ -209,6 +622,85 @@ def test_create_event_negative(client):
     # what we assume we got in the response
     assert result.status_code == 415
 
+def test_create_event_schema_errors(client):
+    result = client.post(
+        EVENT_RESOURCE_URL,
+        json={
+            "title": "a" * 129,
+            "creator_name": "sakkoja"
+        }
+    )
+    assert result.status_code == 415
+    fields = [error["field"] for error in result.json["errors"]]
+    assert sorted(fields) == ["location", "time", "title"]
+
+def test_create_event_batch(client):
+    events = [
+        {"title": "batch-1", "time": "2030-01-01T10:00:00+0000", "location": "here"},
+        {"title": "batch-2", "location": "missing time"},
+        {"title": "batch-3", "time": "2030-01-01T10:00:00X0000", "location": "invalid time"},
+        {"title": "batch-4", "time": "2030-01-02T10:00:00+0000", "location": "here", "description": "described"},
+        None
+    ]
+    result = client.post(EVENT_RESOURCE_URL + "/batch", json=events)
+    # some of the events had errors
+    assert result.status_code == 207
+    assert len(result.json) == 5
+    # null is reported like other items that don't match the schema
+    assert result.json[4]["errors"][0]["message"] == "None is not of type 'object'"
+    assert [error["field"] for error in result.json[1]["errors"]] == ["time"]
+    assert [error["field"] for error in result.json[2]["errors"]] == ["time"]
+    for created, sent in [(result.json[0], events[0]), (result.json[3], events[3])]:
+        assert created["creator_token"]
+        resp = client.get(event_url(created["identifier"]))
+        assert resp.json["title"] == sent["title"]
+    # created events are searchable and can be modified with the creator token
+    assert [item["title"] for item in client.get(event_search_url("described")).json] == ["batch-4"]
+    resp = client.put(
+        event_url(result.json[0]["identifier"]),
+        json={"title": "batch-1-modified"},
+        headers={"Authorization": "Basic " + result.json[0]["creator_token"]}
+    )
+    assert resp.status_code == 200
+
+def test_create_event_batch_ndjson(client):
+    body = '{"title": "nd-1", "time": "2030-01-01T10:00:00+0000", "location": "here"}\n\nnot json\n{"title": "nd-2", "time": "2030-01-01T10:00:00+0000", "location": "here"}\nnull\n'
+    result = client.post(EVENT_RESOURCE_URL + "/batch", data=body, content_type="application/x-ndjson")
+    assert result.status_code == 207
+    assert len(result.json) == 4
+    assert "identifier" in result.json[0]
+    assert result.json[1]["errors"][0]["message"] == "Invalid JSON"
+    assert "identifier" in result.json[2]
+    assert result.json[3]["errors"][0]["message"] == "None is not of type 'object'"
+
+def test_create_event_batch_identifier_collision(client, monkeypatch):
+    taken = iter([test_events[0]["identifier"]] * 2)
+    generate_token = app.generate_token
+    def colliding_token(length):
+        return next(taken, None) or generate_token(length) if length == 8 else generate_token(length)
+    monkeypatch.setattr(app, "generate_token", colliding_token)
+    events = [{"title": "retried-{}".format(i), "time": "2030-01-01T10:00:00+0000", "location": "here"} for i in range(2)]
+    # the batch is inserted with new identifiers
+    result = client.post(EVENT_RESOURCE_URL + "/batch", json=events)
+    assert result.status_code == 201
+    assert test_events[0]["identifier"] not in [item["identifier"] for item in result.json]
+    for created, sent in zip(result.json, events):
+        assert client.get(event_url(created["identifier"])).json["title"] == sent["title"]
+    # until the retries run out
+    monkeypatch.setattr(app, "generate_token", lambda length: test_events[0]["identifier"] if length == 8 else generate_token(length))
+    assert client.post(EVENT_RESOURCE_URL + "/batch", json=events).status_code == 409
+
+def test_create_event_batch_negative(client, monkeypatch):
+    assert client.post(EVENT_RESOURCE_URL + "/batch", json={"title": "not an array"}).status_code == 415
+    assert client.post(EVENT_RESOURCE_URL + "/batch", data="title", content_type="text/plain").status_code == 415
+    assert client.post(EVENT_RESOURCE_URL + "/batch", json=[]).status_code == 400
+    # nothing is created if all events have errors
+    result = client.post(EVENT_RESOURCE_URL + "/batch", json=[{"title": "no time", "location": "here"}, None])
+    assert result.status_code == 400
+    assert all("errors" in item for item in result.json)
+    monkeypatch.setattr(app, "BATCH_SIZE_MAX", 1)
+    assert client.post(EVENT_RESOURCE_URL + "/batch", json=[{}, {}]).status_code == 413
+
 def test_update_event_positive(client):
     # import pdb;pdb.set_trace()
     result = client.put(
@@ -376,6 +868,103 @@ def test_register_attendee_negative(client):
     assert result.status_code == 409
 
 
+def test_register_attendee_deleted_event(client):
+    identifier = test_events[0]["identifier"]
+    assert client.get(event_url(identifier)).status_code == 200
+    # event is deleted behind the cached snapshot, e.g. by another worker
+    with client.application.app_context():
+        app.repository.delete_event(app.repository.get_event(identifier))
+        assert app.event_cache.get(identifier) is not None
+    result = client.post(event_attendees_url(identifier), json={"user_name": "late"})
+    assert result.status_code == 404
+    with client.application.app_context():
+        assert app.event_cache.get(identifier) is None
+
+
+def test_import_attendees_csv(client, monkeypatch):
+    monkeypatch.setattr(app, "IMPORT_BATCH_SIZE", 2)
+    body = "user_name,first_name,email\nimported-1,First,\nuser-name1,Taken,\nimported-2,,two@mail\nimported-1,Twice,\n,No name,\nimported-3,\"Quoted, name\",\n"
+    result = client.post(
+        event_attendees_url(test_events[0]["identifier"]) + "/import",
+        data=body,
+        content_type="text/csv",
+        headers={"Authorization": "Basic " + test_events[0]["creator_token"]}
+    )
+    assert result.status_code == 201
+    report = result.json
+    assert [row["row"] for row in report] == [1, 2, 3, 4, 5, 6]
+    assert [("errors" in row) for row in report] == [False, True, False, True, True, False]
+    assert report[4]["errors"][0]["field"] == "user_name"
+    # imported attendees can use their tokens
+    resp = client.get(
+        event_specific_attendee_url(test_events[0]["identifier"], report[5]["user_identifier"]),
+        headers={"Authorization": "Basic " + report[5]["user_token"]}
+    )
+    assert resp.json["first_name"] == "Quoted, name"
+    attendees = client.get(
+        event_attendees_url(test_events[0]["identifier"]),
+        headers={"Authorization": "Basic " + test_events[0]["creator_token"]}
+    ).json
+    assert sorted(user["user_name"] for user in attendees) == ["imported-1", "imported-2", "imported-3", "user-name1"]
+
+def test_import_attendees_ndjson(client):
+    body = '{"user_name": "nd-1"}\nnot json\n{"user_name": "nd-2", "phone": "12345"}\n'
+    result = client.post(
+        event_attendees_url(test_events[1]["identifier"]) + "/import",
+        data=body,
+        content_type="application/x-ndjson",
+        headers={"Authorization": "Basic " + test_events[1]["creator_token"]}
+    )
+    assert result.status_code == 201
+    assert [("user_token" in row) for row in result.json] == [True, False, True]
+
+def test_import_attendees_partial(client, monkeypatch):
+    monkeypatch.setattr(app, "IMPORT_BATCH_SIZE", 2)
+    # the first batch is committed before the invalid UTF-8 line is read
+    result = client.post(
+        event_attendees_url(test_events[0]["identifier"]) + "/import",
+        data=b"user_name\npartial-1\npartial-2\npartial-3\n\xff\xfe\n",
+        content_type="text/csv",
+        headers={"Authorization": "Basic " + test_events[0]["creator_token"]}
+    )
+    assert result.status_code == 400
+    report = result.json["report"]
+    assert [("user_token" in row) for row in report] == [True, True, False]
+    assert report[2]["errors"][0]["message"] == "Not imported"
+    resp = client.get(
+        event_specific_attendee_url(test_events[0]["identifier"], report[1]["user_identifier"]),
+        headers={"Authorization": "Basic " + report[1]["user_token"]}
+    )
+    assert resp.json["user_name"] == "partial-2"
+
+def test_import_attendees_identifier_collision(client, monkeypatch):
+    taken = iter([test_users[0]["user_identifier"]] * 2)
+    generate_token = app.generate_token
+    def colliding_token(length):
+        return next(taken, None) or generate_token(length) if length == 8 else generate_token(length)
+    monkeypatch.setattr(app, "generate_token", colliding_token)
+    headers = {"Authorization": "Basic " + test_events[1]["creator_token"]}
+    result = client.post(event_attendees_url(test_events[1]["identifier"]), json={"user_name": "collision"}, headers=headers)
+    assert result.status_code == 409
+    assert result.json == "Identifier collision, please retry"
+    # import is retried with a new identifier
+    result = client.post(event_attendees_url(test_events[1]["identifier"]) + "/import", data="user_name\ncollision\n",
+                         content_type="text/csv", headers=headers)
+    assert result.status_code == 201
+    assert result.json[0]["user_identifier"] != test_users[0]["user_identifier"]
+    resp = client.get(
+        event_specific_attendee_url(test_events[1]["identifier"], result.json[0]["user_identifier"]),
+        headers={"Authorization": "Basic " + result.json[0]["user_token"]}
+    )
+    assert resp.json["user_name"] == "collision"
+
+def test_import_attendees_negative(client):
+    url = event_attendees_url(test_events[0]["identifier"]) + "/import"
+    headers = {"Authorization": "Basic " + test_events[0]["creator_token"]}
+    assert client.post(url, json=[{"user_name": "json"}], headers=headers).status_code == 415
+    assert client.post(url, data="user_name\nx\n", content_type="text/csv", headers={"Authorization": "Basic wrong"}).status_code == 401
+    assert client.post(event_attendees_url("wrong-identifier") + "/import", data="user_name\nx\n", content_type="text/csv", headers=headers).status_code == 404
+
 def test_update_attendee_positive(client):
     result = client.put(
         event_specific_attendee_url(test_events[0].get("identifier"), test_users[0].get("user_identifier")),
@@ -394,7 +983,17 @@ def test_update_attendee_positive(client):
     print(result.json)
     # what we assume we got in the response
     assert result.status_code == 200
-    assert result.json
+    assert result.json["user_token"] == test_users[0]["user_token"]
+
+    # the creator can update the attendee but doesn't get the user_token
+    result = client.put(
+        event_specific_attendee_url(test_events[0]["identifier"], test_users[0]["user_identifier"]),
+        json={"first_name": "by-creator"},
+        headers={"Authorization": "Basic " + test_events[0]["creator_token"]}
+    )
+    assert result.status_code == 200
+    assert result.json["first_name"] == "by-creator"
+    assert "user_token" not in result.json
 
 
 def test_update_attendee_negative(client):
@@ -466,6 +1065,7 @@ def test_update_attendee_negative(client):
     )
     print(result)
     print(result.json)
+    # attendee of another event can't be modified through this event
     result = client.put(
         event_specific_attendee_url(test_events[0].get("identifier"), test_users[1].get("user_identifier")),
         json={
@@ -477,8 +1077,48 @@ def test_update_attendee_negative(client):
     )
     print(result)
     print(result.json)
+    assert result.status_code == 404
+    # not even by the creator of this event
+    headers = {"Authorization": "Basic " + test_events[0].get("creator_token")}
+    url = event_specific_attendee_url(test_events[0].get("identifier"), test_users[1].get("user_identifier"))
+    assert client.get(url, headers=headers).status_code == 404
+    assert client.put(url, json={"user_name": "testing"}, headers=headers).status_code == 404
+    assert client.delete(url, headers=headers).status_code == 404
+    assert client.get(
+        event_specific_attendee_url(test_events[1].get("identifier"), test_users[1].get("user_identifier")),
+        headers={"Authorization": "Basic " + test_users[1].get("user_token")}
+    ).json["user_name"] == test_users[1]["user_name"]
+    # usernames are unique within event, so another attendee of the same event can't take the name
+    other = client.post(
+        event_attendees_url(test_events[0].get("identifier")),
+        json={
+            "user_name": "other-tester"
+        }
+    ).json
+    result = client.put(
+        event_specific_attendee_url(test_events[0].get("identifier"), other["user_identifier"]),
+        json={
+            "user_name": "testing"
+        },
+        headers={
+            "Authorization": "Basic " + other["user_token"]
+        }
+    )
+    print(result)
+    print(result.json)
     # what we assume we got in the response
     assert result.status_code == 409
+    # the same username is fine in another event
+    result = client.put(
+        event_specific_attendee_url(test_events[1].get("identifier"), test_users[1].get("user_identifier")),
+        json={
+            "user_name": "testing"
+        },
+        headers={
+            "Authorization": "Basic " + test_users[1].get("user_token")
+        }
+    )
+    assert result.status_code == 200
 
 def test_delete_attendee_positive(client):
     # with user_token
@@ -554,6 +1194,27 @@ def test_get_single_attendee_positive(client):
         assert item in test_users[-1]
 
 
+def test_get_attendee_fields(client):
+    headers = {"Authorization": "Basic " + test_events[0]["creator_token"]}
+    resp = client.get(event_attendees_url("event-1") + "?fields=user_identifier,user_name", headers=headers)
+    assert resp.status_code == 200
+    assert resp.json == [{"user_identifier": "user-1", "user_name": "user-name1"}]
+    resp = client.get(event_specific_attendee_url("event-1", "user-1") + "?fields=email", headers=headers)
+    assert resp.status_code == 200
+    assert list(resp.json) == ["email"]
+    for url in [event_attendees_url("event-1") + "?fields=user_token", event_specific_attendee_url("event-1", "user-1") + "?fields=title"]:
+        assert client.get(url, headers=headers).status_code == 400
+
+
+def test_get_single_attendee_etag(client):
+    url = event_specific_attendee_url(test_events[-1]["identifier"], test_users[-1]["user_identifier"])
+    headers = {"Authorization": "Basic " + test_users[-1]["user_token"]}
+    etag = client.get(url, headers=headers).headers["ETag"]
+    assert client.get(url, headers=dict(headers, **{"If-None-Match": etag})).status_code == 304
+    assert client.get(url, headers=dict(headers, **{"If-None-Match": '"other", W/' + etag})).status_code == 304
+    # authentication is checked before the ETag
+    assert client.get(url, headers={"Authorization": "Basic wrong-token", "If-None-Match": etag}).status_code == 401
+
 def test_get_single_attendee_negative(client):
     result = client.get(
         event_specific_attendee_url(test_events[-1]["identifier"], test_users[-1]["user_identifier"]),
@@ -704,7 +1365,8 @@ def test_delete_image_negative(client):
     assert result.status_code == 404
 
 
-def test_general_error(client, mock_general_error):
+def test_general_error(sql_client, mock_general_error):
+    client = sql_client
     # get all events
     assert client.get(EVENT_RESOURCE_URL).status_code == 400
     # create event
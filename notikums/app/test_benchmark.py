@@ -0,0 +1,26 @@
+import json
+import pytest
+import benchmark
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "memory"])
+def test_benchmark_cases(tmp_path, backend):
+    # every case runs and gets its expected status
+    output = str(tmp_path / "results.json")
+    args = ["--backend", backend, "--events", "20", "--attendees", "3,5", "--repeat", "2", "--warmup", "1", "--output", output]
+    assert benchmark.main(args) == 0
+    with open(output) as f:
+        results = json.load(f)
+    assert results["meta"]["events"] == 20
+    assert "attendee_list_5" in results["results"]
+    for name, result in results["results"].items():
+        assert result["status"] == {str(result["expected_status"]): 2}, name
+
+
+def test_benchmark_compare():
+    baseline = {"results": {"event_get": {"p50_us": 100.0}, "event_list": {"p50_us": 100.0}}}
+    results = {"results": {"event_get": {"p50_us": 110.0}, "event_list": {"p50_us": 150.0}, "new_case": {"p50_us": 1.0}}}
+    rows, regressions = benchmark.compare(results, baseline, 0.2)
+    assert [row[0] for row in rows] == ["event_get", "event_list"]
+    assert regressions == ["event_list"]
+
@@ -0,0 +1,57 @@
+from cache import LRUCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # b is least recently used and gets evicted
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 3
+    assert stats["misses"] == 1
+    assert stats["size"] == 2
+
+
+def test_ttl_expiration(monkeypatch):
+    cache = LRUCache(maxsize=2, ttl=10)
+    now = [100.0]
+    monkeypatch.setattr("cache.time.monotonic", lambda: now[0])
+    cache.set("a", 1)
+    now[0] = 105.0
+    assert cache.get("a") == 1
+    now[0] = 111.0
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_invalidate_and_disabled_cache():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.invalidate("a")
+    cache.invalidate("not-cached")
+    assert cache.get("a") is None
+    disabled = LRUCache(maxsize=0)
+    disabled.set("a", 1)
+    assert disabled.get("a") is None
+
+
+def test_invalidate_during_load():
+    cache = LRUCache(maxsize=2, ttl=60)
+
+    # a write invalidates the key while the old value is being loaded, so it is returned but not cached
+    def stale_load():
+        cache.invalidate("a")
+        return "old"
+    assert cache.get_or_load("a", stale_load) == "old"
+    assert cache.get("a") is None
+    assert cache.get_or_load("a", lambda: "new") == "new"
+    assert cache.get_or_load("a", lambda: "other") == "new"
+    # missing values are not cached
+    assert cache.get_or_load("b", lambda: None) is None
+    assert cache.stats()["size"] == 1
@@ -3,10 +3,10 @@ import pytest
 import tempfile
 import app
 
-from app import User, Event
-from datetime import datetime
-from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from models import User, Event
+from repository import SQLAlchemyRepository
+from datetime import datetime, timezone
+from sqlalchemy import inspect
 from sqlalchemy.exc import IntegrityError
 
 @pytest.fixture
@@ -14,26 +14,26 @@ def basic_setup():
     # put the re-occuring setups in here and use this with each test
     pass
 
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.close()
-
 @pytest.fixture
 def db_handle():
     db_fd, db_fname = tempfile.mkstemp()
-    app.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
-    app.app.config["TESTING"] = True
-
-    with app.app.app_context():
-        app.db.create_all()
-
-    yield app.db
-
-    app.db.session.remove()
+    flask_app = app.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "AUTO_INIT_DB": False
+    })
+
+    with flask_app.app_context():
+        app.repository.init_schema()
+        yield app.db
+
+        app.db.session.remove()
+        # close pooled connections so that WAL files can be removed too
+        app.db.get_engine().dispose()
     os.close(db_fd)
-    os.unlink(db_fname)
+    for fname in [db_fname, db_fname + "-wal", db_fname + "-shm"]:
+        if os.path.exists(fname):
+            os.unlink(fname)
 
 # tests    
 
@@ -124,4 +124,125 @@ def test_create_event_attendee(db_handle):
 #     # db_handle.session.add(event)
 #     # db_handle.session.add(attendee)
 #     # db_handle.session.commit()
-#     assert Event.query.first().attendees[0] == attendee
\ No newline at end of file
+#     assert Event.query.first().attendees[0] == attendee
+
+
+def test_create_event_attendee_duplicate_name(db_handle):
+    events = [
+        Event(creator_token="token", title="test event", time=datetime.utcnow(), location="here", identifier="1234567" + str(i))
+        for i in range(2)
+    ]
+    # same username in different events is allowed
+    for i, event in enumerate(events):
+        db_handle.session.add(User(user_token="token", user_name="user_name", user_identifier="user_" + str(i), event=event))
+    db_handle.session.commit()
+    with pytest.raises(IntegrityError):
+        db_handle.session.add(User(user_token="token", user_name="user_name", user_identifier="user_2", event=events[0]))
+        db_handle.session.commit()
+    db_handle.session.rollback()
+
+
+def test_event_time_range_uses_index(db_handle):
+    query = SQLAlchemyRepository().event_query(datetime(2030, 1, 1), datetime(2030, 1, 31))
+    statement = query.statement.compile(compile_kwargs={"literal_binds": True})
+    plan = db_handle.session.execute("EXPLAIN QUERY PLAN " + str(statement)).fetchall()
+    assert "ix_event_time_id" in " ".join(str(row) for row in plan)
+
+
+def test_sqlite_pragmas(db_handle):
+    assert db_handle.session.execute("PRAGMA journal_mode").scalar() == "wal"
+    assert db_handle.session.execute("PRAGMA foreign_keys").scalar() == 1
+    assert db_handle.session.execute("PRAGMA synchronous").scalar() == 1  # NORMAL
+    assert db_handle.session.execute("PRAGMA busy_timeout").scalar() == 5000
+
+
+def test_postgres_pool_options():
+    pytest.importorskip("psycopg2")
+    flask_app = app.create_app({
+        "SQLALCHEMY_DATABASE_URI": "postgresql://notikums@localhost/notikums",
+        "POSTGRES_POOL_SIZE": 3,
+        "POSTGRES_MAX_OVERFLOW": 7,
+        "AUTO_INIT_DB": False,
+        "TOKEN_HASH_KEY": "key"
+    })
+    # engine is created without connecting
+    with flask_app.app_context():
+        engine = app.db.get_engine()
+        assert engine.pool.size() == 3
+        assert engine.pool._max_overflow == 7
+        assert engine.pool._pre_ping
+        # bulk inserts are sent as multi-row INSERTs
+        assert engine.dialect.executemany_mode is not None
+
+
+def _create_old_tables():
+    # tables of a database created before rows had versions, with an event time stored without offset
+    app.db.session.execute("CREATE TABLE event (id INTEGER PRIMARY KEY, identifier VARCHAR(8) NOT NULL UNIQUE, creator_name VARCHAR(64), "
+                           "creator_token VARCHAR(64) NOT NULL, title VARCHAR(128) NOT NULL, description VARCHAR(256), time DATETIME NOT NULL, "
+                           "location VARCHAR(64) NOT NULL, image VARCHAR(256))")
+    app.db.session.execute('CREATE TABLE "user" (id INTEGER PRIMARY KEY, event_id INTEGER REFERENCES event (id) ON DELETE CASCADE, '
+                           "user_identifier VARCHAR(8) NOT NULL UNIQUE, user_token VARCHAR(64) NOT NULL, user_name VARCHAR(64) NOT NULL, "
+                           "first_name VARCHAR(64), last_name VARCHAR(64), email VARCHAR(64), phone VARCHAR(16))")
+    app.db.session.execute("INSERT INTO event (identifier, creator_token, title, time, location) VALUES ('old', 'token', 'old', '2030-01-01 00:00:00', 'here')")
+    app.db.session.commit()
+
+def test_init_db_adds_version_columns():
+    db_fd, db_fname = tempfile.mkstemp()
+    flask_app = app.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname, "TESTING": True, "AUTO_INIT_DB": False})
+    with flask_app.app_context():
+        _create_old_tables()
+        # usernames were unique only by the check in the app
+        for identifier in ["dup-1", "dup-2"]:
+            app.db.session.execute("INSERT INTO \"user\" (event_id, user_identifier, user_token, user_name) VALUES (1, :identifier, 'token', 'twice')",
+                                   {"identifier": identifier})
+        app.db.session.commit()
+        app.repository.init_schema()
+        app.repository.init_schema()
+
+        inspector = inspect(app.db.get_engine())
+        assert "ix_event_time_id" in {index["name"] for index in inspector.get_indexes("event")}
+        assert "ix_user_event_user_name" in {index["name"] for index in inspector.get_indexes("user")}
+        assert app.repository.get_attendee("dup-1").user_name == "twice"
+        assert app.repository.get_attendee("dup-2").user_name == "twice-dup-2"
+        event = app.repository.get_event("old")
+        assert event.version == 1
+        app.repository.update_event(event, {"title": "new"})
+        assert app.repository.get_event_version("old") == 2
+        assert app.repository.add_attendee(event.id, {"user_identifier": "user", "user_token": "token", "user_name": "name"}).version == 1
+        app.db.session.remove()
+    client = flask_app.test_client()
+    assert client.post("/event/old/attendees", json={"user_name": "joined"}).status_code == 201
+    assert client.post("/event/old/attendees", json={"user_name": "joined"}).status_code == 409
+    with flask_app.app_context():
+        app.db.get_engine().dispose()
+    os.close(db_fd)
+    for fname in [db_fname, db_fname + "-wal", db_fname + "-shm"]:
+        if os.path.exists(fname):
+            os.unlink(fname)
+
+def test_utc_times_command(tmp_path):
+    flask_app = app.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "old.db"), "TESTING": True, "AUTO_INIT_DB": False})
+    runner = flask_app.test_cli_runner()
+    with flask_app.app_context():
+        _create_old_tables()
+        app.repository.init_schema()
+        app.db.session.remove()
+    assert runner.invoke(args=["utc-times", "--offset", "2 hours"]).exit_code != 0
+    result = runner.invoke(args=["utc-times", "--offset", "+02:00"])
+    assert result.exit_code == 0
+    assert "Converted 1 event times" in result.output
+    # times are converted only once
+    assert runner.invoke(args=["utc-times"]).output.strip() == "Event times are already in UTC"
+    with flask_app.app_context():
+        event = app.repository.get_event("old")
+        assert event.time == datetime(2029, 12, 31, 22, tzinfo=timezone.utc)
+        assert event.version == 2
+        app.db.get_engine().dispose()
+
+    # new databases have UTC times from the start
+    flask_app = app.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "new.db"), "TESTING": True, "AUTO_INIT_DB": False})
+    runner = flask_app.test_cli_runner()
+    runner.invoke(args=["init-db"])
+    assert runner.invoke(args=["utc-times"]).output.strip() == "Event times are already in UTC"
+    with flask_app.app_context():
+        app.db.get_engine().dispose()
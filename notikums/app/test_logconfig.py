@@ -0,0 +1,35 @@
+import logging
+import logconfig
+
+from logconfig import SamplingFilter, setup_logging
+
+
+def make_record(level):
+    return logging.LogRecord("test", level, __file__, 1, "message", None, None)
+
+
+def test_sampling_filter():
+    assert SamplingFilter(0).filter(make_record(logging.INFO)) is False
+    assert SamplingFilter(1).filter(make_record(logging.INFO)) is True
+    # warnings and errors are never dropped
+    assert SamplingFilter(0).filter(make_record(logging.WARNING)) is True
+    passed = sum(SamplingFilter(0.5).filter(make_record(logging.DEBUG)) for i in range(1000))
+    assert 350 < passed < 650
+
+
+def test_setup_logging(tmp_path, monkeypatch):
+    log_file = tmp_path / "test.log"
+    monkeypatch.setenv("NOTIKUMS_SQL_LOG_LEVEL", "INFO")
+    try:
+        setup_logging({"LOG_FILE": str(log_file), "LOG_LEVEL": "WARNING", "VALIDATION_LOG_SAMPLE_RATE": 0})
+        assert logging.getLogger("sqlalchemy.engine").level == logging.INFO
+        logging.getLogger("notikums").info("not logged")
+        logging.getLogger("notikums").warning("logged")
+        logging.getLogger("notikums.validation").warning("validation warning")
+        logconfig.stop_logging()
+        lines = log_file.read_text().splitlines()
+        assert len(lines) == 2
+        assert lines[0].endswith("notikums - WARNING - logged")
+    finally:
+        monkeypatch.delenv("NOTIKUMS_SQL_LOG_LEVEL")
+        setup_logging({})
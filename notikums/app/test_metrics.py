@@ -0,0 +1,30 @@
+from metrics import RequestMetrics, Histogram
+
+
+def test_histogram_buckets():
+    histogram = Histogram(buckets=(0.1, 1.0))
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        histogram.observe(value)
+    # bounds are inclusive
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.sum == 2.65
+
+
+def test_render():
+    metrics = RequestMetrics(buckets=(0.1, 1.0))
+    metrics.observe("/event/<event_id>", "GET", 200, 0.05, db_seconds=0.01, statements=2)
+    metrics.observe("/event/<event_id>", "GET", 404, 0.5, db_seconds=0.02, statements=1)
+    metrics.observe('/odd"route', "POST", 201, 0.01)
+    lines = metrics.render().splitlines()
+    assert 'notikums_requests_total{route="/event/<event_id>",method="GET",status="200"} 1' in lines
+    assert 'notikums_requests_total{route="/event/<event_id>",method="GET",status="404"} 1' in lines
+    # buckets are cumulative
+    assert 'notikums_request_duration_seconds_bucket{route="/event/<event_id>",method="GET",le="0.1"} 1' in lines
+    assert 'notikums_request_duration_seconds_bucket{route="/event/<event_id>",method="GET",le="1.0"} 2' in lines
+    assert 'notikums_request_duration_seconds_bucket{route="/event/<event_id>",method="GET",le="+Inf"} 2' in lines
+    assert 'notikums_request_duration_seconds_count{route="/event/<event_id>",method="GET"} 2' in lines
+    assert 'notikums_request_db_seconds_sum{route="/event/<event_id>",method="GET"} 0.03' in lines
+    assert 'notikums_sql_statements_total{route="/event/<event_id>",method="GET"} 3' in lines
+    # label values are escaped
+    assert 'notikums_sql_statements_total{route="/odd\\"route",method="POST"} 0' in lines
+    assert "# TYPE notikums_request_duration_seconds histogram" in lines
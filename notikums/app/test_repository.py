@@ -0,0 +1,98 @@
+import pytest
+from datetime import datetime
+
+from repository import Repository, MemoryRepository, ConflictError, ConcurrentUpdateError, IdentifierConflictError, NotFoundError, create_repository
+
+
+def add_event(repository, identifier, day, **info):
+    values = {"identifier": identifier, "creator_token": "token", "title": "event " + identifier, "time": datetime(2030, 1, day), "location": "here"}
+    values.update(info)
+    return repository.add_event(values)
+
+
+def add_attendee(repository, event, identifier, user_name):
+    return repository.add_attendee(event.id, {"user_identifier": identifier, "user_token": "token", "user_name": user_name})
+
+
+def test_memory_list_events():
+    repository = MemoryRepository()
+    for identifier, day in [("c", 3), ("a", 1), ("b", 2), ("b2", 2)]:
+        add_event(repository, identifier, day)
+    assert [event.identifier for event in repository.list_events()] == ["a", "b", "b2", "c"]
+    assert [event.identifier for event in repository.list_events(time_from=datetime(2030, 1, 2))] == ["b", "b2", "c"]
+    assert [event.identifier for event in repository.list_events(time_to=datetime(2030, 1, 2))] == ["a", "b", "b2"]
+    # keyset page after the first event of day 2
+    first = repository.get_event("b")
+    assert [event.identifier for event in repository.list_events(after=(first.time, first.id), limit=1)] == ["b2"]
+
+    repository.update_event(first, {"time": datetime(2030, 1, 4)})
+    assert [event.identifier for event in repository.iter_events()] == ["a", "b2", "c", "b"]
+    assert repository.get_event_version("b") == 2
+
+
+def test_memory_search_events():
+    repository = MemoryRepository()
+    add_event(repository, "a", 1, title="Python meetup", description="talks about python")
+    add_event(repository, "b", 2, title="Board games", description="bring a python")
+    add_event(repository, "c", 3, title="test-event-1")
+    assert [event.identifier for event in repository.search_events("PYTHON", 10)] == ["a", "b"]
+    assert [event.identifier for event in repository.search_events("python board", 10)] == ["b"]
+    assert [event.identifier for event in repository.search_events("python", 10, offset=1)] == ["b"]
+    # terms with punctuation match as phrases
+    assert [event.identifier for event in repository.search_events("test-event-1", 10)] == ["c"]
+    assert repository.search_events("event-1-test", 10) == []
+
+
+def test_memory_conflicts():
+    repository = MemoryRepository()
+    event = add_event(repository, "a", 1)
+    with pytest.raises(ConflictError):
+        add_event(repository, "a", 2)
+    with pytest.raises(ConflictError):
+        repository.add_events([{"identifier": "b", "creator_token": "token", "title": "b", "time": datetime(2030, 1, 1), "location": "here"}] * 2)
+    assert repository.get_event("b") is None
+
+    first = add_attendee(repository, event, "u1", "name")
+    with pytest.raises(ConflictError):
+        add_attendee(repository, event, "u2", "name")
+    with pytest.raises(IdentifierConflictError):
+        add_attendee(repository, event, "u1", "free")
+    second = add_attendee(repository, event, "u2", "other")
+    with pytest.raises(ConflictError):
+        repository.update_attendee(second, {"user_name": "name"})
+    assert repository.taken_user_names(event.id, ["name", "other", "free"]) == {"name", "other"}
+
+    repository.delete_event(event)
+    assert repository.get_attendee("u1") is None
+    assert repository.list_attendees(event.id) == []
+    with pytest.raises(ConcurrentUpdateError):
+        repository.update_attendee(first, {"first_name": "First"})
+    with pytest.raises(NotFoundError):
+        add_attendee(repository, event, "u3", "late")
+
+
+def test_memory_bulk_attendees():
+    repository = MemoryRepository()
+    first = add_event(repository, "a", 1)
+    second = add_event(repository, "b", 2)
+    assert repository.event_ids(["a", "b", "missing"]) == {"a": first.id, "b": second.id}
+    rows = [{"event_id": first.id, "user_identifier": "u1", "user_token": "token", "user_name": "name"},
+            {"event_id": second.id, "user_identifier": "u2", "user_token": "token", "user_name": "name"}]
+    repository.add_attendees_of_events(rows)
+    assert [attendee.user_identifier for attendee in repository.list_attendees(second.id)] == ["u2"]
+    # nothing is inserted if one of the rows conflicts
+    with pytest.raises(ConflictError):
+        repository.add_attendees_of_events([dict(rows[0], user_identifier="u3", user_name="other"), dict(rows[1], user_identifier="u4")])
+    assert repository.get_attendee("u3") is None
+
+
+def test_create_repository():
+    assert isinstance(create_repository("memory"), MemoryRepository)
+    with pytest.raises(ValueError):
+        create_repository("redis")
+    # a backend missing methods of the interface can't be created
+    class PartialRepository(Repository):
+        def get_event(self, identifier):
+            return None
+    with pytest.raises(TypeError):
+        PartialRepository()
@@ -0,0 +1,60 @@
+import random
+import pytest
+import app
+import seed
+from models import User, Event
+
+
+def test_skewed_attendee_counts():
+    counts = seed.skewed_attendee_counts(1000, 10000, 1.1, random.Random(0))
+    assert len(counts) == 1000
+    assert abs(sum(counts) - 10000) < 200
+    # a few huge events and many small ones
+    assert counts[0] == max(counts) and counts[0] > 1000
+    assert sum(1 for count in counts if count <= 10) > 800
+    assert counts == seed.skewed_attendee_counts(1000, 10000, 1.1, random.Random(0))
+    assert seed.skewed_attendee_counts(100, 1000, 0, random.Random(0)) == [10] * 100
+
+
+def test_seeded_identifier():
+    assert seed.event_identifier(0) == "E0000000"
+    assert seed.user_identifier(36 + 35) == "U000001Z"
+    with pytest.raises(ValueError):
+        seed.event_identifier(36 ** 7)
+
+
+def test_seed_is_deterministic():
+    datasets = []
+    for i in range(2):
+        with app.create_app({"TESTING": True, "STORAGE_BACKEND": "memory"}).app_context():
+            assert seed.seed(app.repository, 30, [5, 0, 3], seed_value=1, batch_size=4) == 8
+            events = [vars(event).copy() for event in app.repository.list_events()]
+            attendees = [vars(attendee).copy() for event in events for attendee in app.repository.list_attendees(event["id"])]
+        datasets.append((events, attendees))
+    assert datasets[0] == datasets[1]
+    assert len(datasets[0][0]) == 30 and len(datasets[0][1]) == 8
+
+
+def test_seed_main(tmp_path, capsys, monkeypatch):
+    uri = "sqlite:///" + str(tmp_path / "seed.db")
+    # tokens must be hashed with the key of the server
+    assert seed.main(["--database-uri", uri, "--events", "5"]) == 2
+    monkeypatch.setenv("NOTIKUMS_TOKEN_HASH_KEY", "seed key")
+    assert seed.main(["--database-uri", uri, "--events", "50", "--attendees", "300", "--batch-size", "16", "--seed", "3"]) == 0
+    counts = seed.skewed_attendee_counts(50, 300, 1.1, random.Random(3))
+
+    flask_app = app.create_app({"TESTING": True, "SQLALCHEMY_DATABASE_URI": uri, "AUTO_INIT_DB": False})
+    with flask_app.app_context():
+        assert User.query.count() == sum(counts)
+        assert Event.query.count() == 50
+    # the largest event is the first one and its token is derived from the seed
+    identifier = seed.event_identifier(0)
+    assert identifier in capsys.readouterr().out
+    response = flask_app.test_client().get("/event/{}/attendees".format(identifier),
+                                           headers={"Authorization": "Basic " + seed.seeded_token(3, identifier)})
+    assert response.status_code == 200
+    assert len(response.json) == counts[0]
+    # seeding again conflicts with the existing dataset
+    assert seed.main(["--database-uri", uri, "--events", "50", "--attendees", "300", "--seed", "3"]) == 1
+    with flask_app.app_context():
+        app.db.get_engine().dispose()
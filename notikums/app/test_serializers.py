@@ -0,0 +1,36 @@
+import pytest
+import serializers
+
+from models import User, Event
+from datetime import datetime
+
+
+def test_event_to_dict():
+    event = Event(creator_token="hash", title="test event", time=datetime(2020, 2, 2, 12, 30), location="here", identifier="12345678")
+    data = serializers.event_to_dict(event)
+    assert data["time"] == "2020-02-02T12:30:00"
+    assert data["identifier"] == "12345678"
+    assert "creator_token" not in data
+    # the stored hash is never returned, only the token given to the serializer
+    assert serializers.event_to_dict(event, creator_token="token")["creator_token"] == "token"
+    # with fields only those are read from the row
+    row = type("Row", (), {"title": "test event", "time": datetime(2020, 2, 2, 12, 30)})()
+    assert serializers.event_to_dict(row, fields=["time", "title"]) == {"time": "2020-02-02T12:30:00", "title": "test event"}
+
+
+def test_user_to_dict():
+    user = User(user_token="hash", user_name="user_name", user_identifier="user_identifier")
+    data = serializers.user_to_dict(user)
+    assert data["user_name"] == "user_name"
+    assert data["first_name"] is None
+    assert "user_token" not in data
+    assert serializers.user_to_dict(user, user_token="token")["user_token"] == "token"
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(serializers, "orjson", None)
+    elif serializers.orjson is None:
+        pytest.skip("orjson is not installed")
+    assert serializers.dumps({"image": None, "title": "ä"}) in ('{"image":null,"title":"ä"}', '{"image": null, "title": "\\u00e4"}')
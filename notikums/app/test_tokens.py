@@ -0,0 +1,40 @@
+import hmac, hashlib
+import pytest
+import tokens
+
+
+def test_hash_is_keyed():
+    hasher = tokens.TokenHasher("key")
+    digest = hasher.hash("TOKEN")
+    assert digest == "h1$" + hmac.new(b"key", b"TOKEN", hashlib.sha256).hexdigest()
+    assert tokens.is_token_hash(digest)
+    assert not tokens.is_token_hash("A" * 64)
+    # plaintext tokens which look like hex digits are not taken for hashes
+    assert not tokens.is_token_hash(hashlib.sha256(b"TOKEN").hexdigest())
+    assert tokens.TokenHasher("other key").hash("TOKEN") != digest
+
+
+def test_verify():
+    hasher = tokens.TokenHasher("key")
+    creator, user = hasher.hash("CREATOR"), hasher.hash("USER")
+    assert hasher.verify("USER", creator, user)
+    assert hasher.verify("CREATOR", creator, user)
+    assert not hasher.verify("WRONG", creator, user)
+    # missing stored tokens are skipped
+    assert not hasher.verify("USER", creator, None)
+    assert not hasher.verify("USER")
+
+
+def test_settings_from_environment(monkeypatch):
+    config = {"TESTING": True}
+    assert tokens.TokenHasher.from_config(config).hash("T") == tokens.TokenHasher(tokens.DEVELOPMENT_KEY).hash("T")
+    monkeypatch.setenv("NOTIKUMS_TOKEN_HASH_KEY", "secret")
+    hasher = tokens.TokenHasher.from_config(config)
+    assert hasher.hash("T") == tokens.TokenHasher("secret").hash("T")
+
+
+def test_development_key_outside_development():
+    assert tokens.TokenHasher.from_config({"DEBUG": True}).hash("T") == tokens.TokenHasher(tokens.DEVELOPMENT_KEY).hash("T")
+    with pytest.raises(RuntimeError):
+        tokens.TokenHasher.from_config({"ENV": "production"})
+    assert tokens.TokenHasher.from_config({"ENV": "production", "TOKEN_HASH_KEY": "secret"}).hash("T") == tokens.TokenHasher("secret").hash("T")
@@ -0,0 +1,62 @@
+"""secret tokens of events and attendees are stored as keyed hashes (HMAC-SHA256), tokens of requests are hashed
+and compared to them in constant time, plaintext tokens are never kept in memory after the request"""
+import hashlib, hmac, logging, os
+
+# settings can be given in app config or overridden with NOTIKUMS_<KEY> environment variables
+DEFAULTS = {
+    "TOKEN_HASH_KEY": None,  # secret key of the hashes, must stay the same for stored tokens to stay valid
+}
+# used if TOKEN_HASH_KEY is not set in debug mode, development and tests, so that they work without configuration
+DEVELOPMENT_KEY = "notikums-development-key"
+# stored hashes are marked with the prefix, so that any plaintext token can be told apart from a hash
+HASH_PREFIX = "h1$"
+
+logger = logging.getLogger("notikums.tokens")
+
+
+def get_settings(config):
+    """return token settings from config and environment"""
+    return {key: os.environ.get("NOTIKUMS_" + key, config.get(key, default)) for key, default in DEFAULTS.items()}
+
+
+def is_token_hash(value):
+    """return True if stored value is a hash, plaintext tokens of older versions have no prefix"""
+    return value.startswith(HASH_PREFIX)
+
+
+class TokenHasher:
+    """keyed hashing of tokens and verification of tokens against stored hashes"""
+
+    def __init__(self, key):
+        # the key is set up once, hashing a token copies the keyed state
+        self._mac = hmac.new(key.encode(), digestmod=hashlib.sha256)
+
+    @classmethod
+    def from_config(cls, config):
+        """create hasher from app config, raises RuntimeError if TOKEN_HASH_KEY is not set outside of
+        debug mode, development and tests, since stored tokens would be hashed with a publicly known key"""
+        settings = get_settings(config)
+        key = settings["TOKEN_HASH_KEY"]
+        if not key:
+            if not (config.get("TESTING") or config.get("DEBUG") or config.get("ENV") == "development"):
+                raise RuntimeError("TOKEN_HASH_KEY is not set, set it in app config or NOTIKUMS_TOKEN_HASH_KEY")
+            if not config.get("TESTING"):
+                logger.warning("TOKEN_HASH_KEY is not set, tokens are hashed with the development key")
+            key = DEVELOPMENT_KEY
+        return cls(key)
+
+    def hash(self, token):
+        """return keyed hash of token as prefixed hex digits"""
+        mac = self._mac.copy()
+        mac.update(token.encode())
+        return HASH_PREFIX + mac.hexdigest()
+
+    def verify(self, token, *stored_hashes):
+        """return True if token matches one of the stored hashes, token is hashed once for all of them"""
+        digest = self.hash(token)
+        verified = False
+        # every hash is compared so that the time doesn't tell which one matched
+        for stored in stored_hashes:
+            if stored and hmac.compare_digest(digest, stored):
+                verified = True
+        return verified